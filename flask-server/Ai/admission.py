@@ -0,0 +1,106 @@
+# Admission control for the async analyze routes.
+#
+# Each model gets an AdmissionLimiter: at most max_inflight analyses run at
+# once, at most max_queue more wait for a slot, and none waits longer than
+# queue_timeout. Anything beyond that is turned away immediately with
+# Overloaded (-> 429, or 503 for a queue timeout) plus a Retry-After, instead
+# of piling up until the client's own timeout fires. All bookkeeping happens on
+# the event loop thread, so plain counters are enough.
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class Overloaded(Exception):
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    def __init__(self, name: str, max_inflight: int, max_queue: int, queue_timeout: float,
+                 retry_after: float = 5.0):
+        self.name = name
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = asyncio.Semaphore(max_inflight)
+
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    def capacity(self) -> int:
+        """How many more analyses would be admitted (run or queued) right now."""
+        return (self.max_inflight - self.inflight) + (self.max_queue - self.waiting)
+
+    def reject_if_over(self, count: int):
+        """Raise Overloaded (429) unless ``count`` more analyses fit."""
+        if count > self.capacity():
+            self.rejected_queue_full += count
+            raise Overloaded(429, f"{self.name} queue is full", self.retry_after)
+
+    async def _acquire(self) -> bool:
+        """
+        Take a slot within queue_timeout; False if none freed up. Unlike
+        wait_for() on Python <= 3.11, never loses a permit that was handed over
+        just as the timeout fired.
+        """
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=self.queue_timeout)
+        except BaseException:
+            self._abandon(acquire)
+            raise
+        if acquire.done():
+            return True
+        self._abandon(acquire)
+        return False
+
+    def _abandon(self, acquire):
+        if acquire.done() and not acquire.cancelled():
+            # got the slot after all, as we gave up on it
+            self._slots.release()
+        else:
+            # a cancelled Semaphore.acquire passes on a permit it was already handed
+            acquire.cancel()
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.inflight >= self.max_inflight and self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise Overloaded(429, f"{self.name} queue is full", self.retry_after)
+
+        self.waiting += 1
+        try:
+            acquired = await self._acquire()
+        finally:
+            self.waiting -= 1
+        if not acquired:
+            self.rejected_timeout += 1
+            raise Overloaded(503, f"Timed out waiting for {self.name}", self.retry_after)
+
+        self.inflight += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
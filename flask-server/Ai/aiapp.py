@@ -1,22 +1,67 @@
-import os
+import asyncio
 import json
-import re
+import os
 import traceback
+from collections import namedtuple
+from typing import List
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from huggingface_hub import InferenceClient
 
-HF_TOKEN = os.getenv("HUGGINGFACE_API_TOKEN")
-MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+from admission import AdmissionLimiter, Overloaded
+from analysis_cache import AnalysisCache, content_key
+from backends import backend_for, is_fallback, make_backend, models_of
+from batching import Coalescer
+from chunking import MAX_CHUNKS, reduce_analyses, split_chunks
+from compaction import Compacted, CompactionStats, compact, count_tokens
+
+# most items per /api/analyze/batch request
+BATCH_MAX_ITEMS = int(os.getenv("AI_BATCH_MAX_ITEMS", "200"))
+
+# admission control, per model: analyses running at once (for the LLM: concurrent HF
+# calls), how many more may wait for a slot, and for how long, before requests are
+# turned away with 429 / 503
+MAX_INFLIGHT = {
+    "remote": int(os.getenv("AI_BATCH_WORKERS", "8")),
+    "local": int(os.getenv("AI_LOCAL_MAX_INFLIGHT", "64")),
+}
+MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))
+RETRY_AFTER = float(os.getenv("AI_RETRY_AFTER", "5"))
+
+# the local classifier's request coalescing: the most items per forward pass and how
+# long the first item of a batch may wait for more
+LOCAL_BATCH_SIZE = int(os.getenv("AI_LOCAL_BATCH_SIZE", "32"))
+LOCAL_BATCH_WAIT = float(os.getenv("AI_LOCAL_BATCH_WAIT_MS", "10")) / 1000
+
+# analysis cache; hf_cache/ is the persistent volume in compose.yaml
+CACHE_PATH = os.getenv("AI_CACHE_PATH", "hf_cache/analysis_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "50000"))
+
+# AI_BACKEND=remote (HF Inference API, default) | local (CPU classifier) | hybrid;
+# local models are loaded here, once, before the app starts serving
+backend = make_backend()
+
+app = FastAPI(title="AI-Service", version="3.0")
 
-if not HF_TOKEN:
-    raise ValueError("Missing Hugging Face API key in environment variables")
+limiters = {
+    model.name: AdmissionLimiter(model.name, MAX_INFLIGHT[model.name], MAX_QUEUE, QUEUE_TIMEOUT, RETRY_AFTER)
+    for model in models_of(backend)
+}
 
-# Use HF Inference API instead of loading model locally
-client = InferenceClient(model=MODEL_ID, token=HF_TOKEN)
-print(f"🔹 Using HF Inference API model: {MODEL_ID}")
+# the LLM is called straight from the event loop; the classifier is CPU work, so its
+# analyses are coalesced into batched forward passes on a worker thread
+coalescers = {
+    model.name: Coalescer(model.analyze_batch, LOCAL_BATCH_SIZE, LOCAL_BATCH_WAIT, name=f"coalesce-{model.name}")
+    for model in models_of(backend) if model.name == "local"
+}
 
-app = FastAPI(title="AI-Service", version="3.0")
+analysis_cache = AnalysisCache(CACHE_PATH, CACHE_MAX_ENTRIES) if CACHE_MAX_ENTRIES > 0 else None
+compaction_stats = CompactionStats()
+
+# lookup_analysis result: payload is the request with its content compacted, which is
+# what the model sees and what the cache is keyed on
+Lookup = namedtuple("Lookup", "model key cached payload compacted")
 
 
 class AnalysisRequest(BaseModel):
@@ -25,131 +70,297 @@ class AnalysisRequest(BaseModel):
     file: str = "unknown"
 
 
+class BatchAnalysisRequest(BaseModel):
+    items: List[AnalysisRequest]
+
+
 @app.get("/")
 def root():
     return {"status": "ok", "service": "ai-service"}
 
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    if analysis_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **analysis_cache.stats()}
+
+
+@app.get("/api/backend")
+def backend_stats():
+    return {
+        **backend.stats(),
+        "admission": {name: limiter.stats() for name, limiter in limiters.items()},
+        "coalescing": {name: c.stats() for name, c in coalescers.items()},
+        "compaction": compaction_stats.stats(),
+    }
+
+
+def overloaded_response(e: Overloaded):
+    return JSONResponse(
+        status_code=e.status,
+        content={"detail": e.reason},
+        headers={"Retry-After": str(int(e.retry_after))},
+    )
+
+
+async def lookup_analysis(payload: AnalysisRequest, compacted: Compacted = None) -> Lookup:
+    """
+    Compact payload's content (unless that's been done: ``compacted``), then
+    find its model, cache key, and cached analysis (or None).
+    """
+    model = backend_for(backend, payload.type)
+    if compacted is None:
+        compacted = await asyncio.to_thread(compact, payload.content)
+    compaction_stats.record(compacted)
+    payload = AnalysisRequest(type=payload.type, content=compacted.text, file=payload.file)
+    if analysis_cache is None:
+        return Lookup(model, None, None, payload, compacted)
+    key = content_key(model.model_id, model.prompt_version, payload.type, payload.content)
+    cached = await asyncio.to_thread(analysis_cache.get, key)
+    if cached is not None:
+        # the file name isn't part of the key; it's only echoed back
+        cached["file"] = payload.file
+    return Lookup(model, key, cached, payload, compacted)
+
+
+async def infer(model, key, payload: AnalysisRequest) -> dict:
+    """Run the model on payload once admitted; raises Overloaded if it isn't."""
+    async with limiters[model.name].slot():
+        if model.name in coalescers:
+            item = (payload.type, payload.content, payload.file)
+            structured = await asyncio.wrap_future(coalescers[model.name].submit(item))
+        else:
+            structured = await model.analyze(payload.type, payload.content, payload.file)
+
+    # unparseable output is worth retrying next time, so only cache real answers
+    if key is not None and not is_fallback(structured):
+        await asyncio.to_thread(analysis_cache.put, key, structured)
+    return structured
+
+
+def analysis_result(lookup: Lookup, structured: dict, cached: bool) -> dict:
+    compacted = lookup.compacted
+    return {
+        "model": lookup.model.model_id,
+        "success": True,
+        "cached": cached,
+        "data": structured,
+        "insight": convert_to_dashboard_format(structured),
+        "tokens": {
+            "original": compacted.original_tokens,
+            "prompt": compacted.tokens,
+            "dropped_files": compacted.dropped_files,
+            "truncated": compacted.truncated,
+        },
+    }
+
+
+async def run_analysis(payload: AnalysisRequest) -> dict:
+    """One analysis: from the cache, else from the model; parsed, validated JSON."""
+    lookup = await lookup_analysis(payload)
+    if lookup.cached is not None:
+        return analysis_result(lookup, lookup.cached, True)
+    return analysis_result(lookup, await infer(lookup.model, lookup.key, lookup.payload), False)
+
+
 @app.post("/api/analyze")
-def analyze(payload: AnalysisRequest):
+async def analyze(payload: AnalysisRequest):
     try:
-
-        system_msg = (
-            "You are an AI that analyzes GitHub pull requests, comments, or code "
-            "and returns ONLY JSON in a fixed schema. Do not include markdown or text "
-            "outside the JSON object."
-        )
-
-        user_prompt = build_prompt(payload.type, payload.content, payload.file)
-
-        resp = client.chat_completion(
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_prompt},
-            ],
-            max_tokens=300,
-            temperature=0.6,
-            top_p=0.9,
-        )
-
-        # HF returns an object; extract the text
-        raw_output = resp.choices[0].message["content"]
-        print("🔹 HF output (truncated):", repr(raw_output)[:200])
-
-        structured = parse_ai_response(raw_output)
-        dashboard_obj = convert_to_dashboard_format(structured)
-
-        return {
-            "model": MODEL_ID,
-            "success": True,
-            "data": structured,
-            "insight": dashboard_obj,
-        }
+        return await run_analysis(payload)
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         print("Error in /api/analyze:", repr(e))
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"HF error: {e}")
 
 
-def build_prompt(data_type: str, content: str, file: str = "unknown") -> str:
-    return f"""
-You are an AI that analyzes GitHub {data_type}s. Pr's, and Comments. Please give us explanations of PR reviews and
-how to better right PR's/ Handle issues. Look at code syntax for error analysis on code basis in PR's.
-
-Return ONLY valid JSON in exactly this schema and value ranges:
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-{{
-  "summary": "short explanation (string)",
-  "sentiment": "positive" | "neutral" | "negative",
-  "category": "feature" | "bugfix" | "refactor" | "documentation" | "other",
-  "constructiveness_score": number between 0 and 1,
-  "suggestions": ["1-3 short actionable suggestions (strings)"],
-  "confidence": number between 0 and 1,
-  "file": "{file}"
-}}
 
-Do not include any extra keys. Do not include markdown or explanation outside the JSON.
-
-Content:
-\"\"\" 
-{content}
-\"\"\" 
-"""
-
-
-def parse_ai_response(output: str) -> dict:
-    match = re.search(r"\{.*\}", output, re.DOTALL)
+async def stream_analysis(lookup: Lookup):
+    """SSE body: "start", then "token"s as the LLM writes, then "result" (or "error")."""
+    model, key, payload = lookup.model, lookup.key, lookup.payload
+    yield sse("start", {"model": model.model_id, "cached": False})
+    try:
+        if hasattr(model, "analyze_stream"):
+            async with limiters[model.name].slot():
+                async for kind, value in model.analyze_stream(payload.type, payload.content, payload.file):
+                    if kind == "token":
+                        yield sse("token", {"text": value})
+                    else:
+                        structured = value
+            if key is not None and not is_fallback(structured):
+                await asyncio.to_thread(analysis_cache.put, key, structured)
+        else:
+            # the classifier has no tokens to show; it's fast enough to just wait for
+            structured = await infer(model, key, payload)
+        yield sse("result", analysis_result(lookup, structured, False))
+    except Overloaded as e:
+        yield sse("error", {"status": e.status, "detail": e.reason})
+    except Exception as e:
+        print("Error in /api/analyze/stream:", repr(e))
+        traceback.print_exc()
+        yield sse("error", {"status": 500, "detail": f"HF error: {e}"})
 
-    def fallback_json(reason: str):
-        return {
-            "summary": reason,
-            "sentiment": "neutral",
-            "category": "other",
-            "constructiveness_score": 0.5,
-            "suggestions": ["No valid output generated."],
-            "confidence": 0.5,
-            "file": "unknown",
-        }
 
-    if not match:
-        return fallback_json("Unable to parse model output")
+@app.post("/api/analyze/stream")
+async def analyze_stream(payload: AnalysisRequest):
+    """
+    /api/analyze as server-sent events, so the caller sees output within
+    milliseconds instead of after the whole completion: "start" right away,
+    "token" events ({"text": ...}) as the LLM generates, and a terminal
+    "result" event with the same body /api/analyze returns (or "error").
+    """
+    try:
+        lookup = await lookup_analysis(payload)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"HF error: {e}")
 
+    if lookup.cached is not None:
+        async def cached_events():
+            yield sse("start", {"model": lookup.model.model_id, "cached": True})
+            yield sse("result", analysis_result(lookup, lookup.cached, True))
+        body = cached_events()
+    else:
+        # turn overload away with a proper status while we still can, before the 200 goes out
+        try:
+            limiters[lookup.model.name].reject_if_over(1)
+        except Overloaded as e:
+            return overloaded_response(e)
+        body = stream_analysis(lookup)
+
+    return StreamingResponse(body, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/api/analyze/chunked")
+async def analyze_chunked(payload: AnalysisRequest):
+    """
+    Map-reduce analysis for big PRs: the diff in ``content`` is split into
+    per-file (or per-hunk) chunks that are analyzed concurrently and reduced
+    into one result in the /api/analyze schema, plus an insight per file in
+    "insights". Chunks hit the cache and admission limits like single
+    analyses; if they don't all fit in the queue the request gets a 429.
+    """
+    model = backend_for(backend, payload.type)
+    limiter = limiters[model.name]
     try:
-        parsed = json.loads(match.group())
+        chunks, dropped = await asyncio.to_thread(
+            split_chunks, payload.content, min(MAX_CHUNKS, limiter.max_inflight))
+        lookups = await asyncio.gather(*(
+            lookup_analysis(
+                AnalysisRequest(type=payload.type, content=chunk.compacted.text,
+                                file=chunk.files[0] if len(chunk.files) == 1 and chunk.files[0] else payload.file),
+                chunk.compacted,
+            )
+            for chunk in chunks
+        ))
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"HF error: {e}")
 
-        raw_sentiment = parsed.get("sentiment", "neutral")
-        raw_category = parsed.get("category", "other")
-        raw_construct = parsed.get("constructiveness_score")
-        raw_confidence = parsed.get("confidence", 0.5)
+    try:
+        limiter.reject_if_over(sum(1 for lookup in lookups if lookup.cached is None))
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    async def resolve(lookup):
+        if lookup.cached is not None:
+            return lookup.cached
+        return await infer(lookup.model, lookup.key, lookup.payload)
+
+    outcomes = await asyncio.gather(*(resolve(lookup) for lookup in lookups), return_exceptions=True)
+    parts = [(chunk, outcome) for chunk, outcome in zip(chunks, outcomes) if not isinstance(outcome, Exception)]
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    for e in errors:
+        print("Error in /api/analyze/chunked chunk:", repr(e))
+    if not parts:
+        if isinstance(errors[0], Overloaded):
+            return overloaded_response(errors[0])
+        raise HTTPException(status_code=500, detail=f"HF error: {errors[0]}")
+
+    structured = reduce_analyses(parts, payload.file)
+    return {
+        "model": model.model_id,
+        "success": True,
+        "cached": all(lookup.cached is not None for lookup in lookups),
+        "data": structured,
+        "insight": convert_to_dashboard_format(structured),
+        "insights": [
+            convert_to_dashboard_format({**analysis, "file": path or payload.file})
+            for chunk, analysis in parts for path in chunk.files
+        ],
+        "chunks": {"count": len(chunks), "failed": len(errors)},
+        "tokens": {
+            "original": count_tokens(payload.content),
+            "prompt": sum(chunk.compacted.tokens for chunk in chunks),
+            "largest_chunk": max(chunk.compacted.tokens for chunk in chunks),
+            "dropped_files": dropped,
+            "truncated": any(chunk.compacted.truncated for chunk in chunks),
+        },
+    }
 
-        if raw_sentiment not in {"positive", "neutral", "negative"}:
-            raw_sentiment = "neutral"
 
-        if raw_category not in {"feature", "bugfix", "refactor", "documentation", "other"}:
-            raw_category = "other"
+@app.post("/api/analyze/batch")
+async def analyze_batch(payload: BatchAnalysisRequest):
+    """
+    Analyze many items in one round-trip. Cache misses run concurrently, under
+    the same admission limits as single analyses; results come back in request
+    order, one per item, and a failed item only fails itself:
+    {"success": false, "error": "..."}. A batch whose misses don't fit in the
+    queue is rejected as a whole with 429.
+    """
+    if len(payload.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    # identical items in one batch are analyzed once
+    unique = {}
+    for item in payload.items:
+        unique.setdefault((item.type, item.content, item.file), item)
+    keys = list(unique)
+    lookups = await asyncio.gather(*(lookup_analysis(unique[k]) for k in keys), return_exceptions=True)
+
+    misses = {}
+    for lookup in lookups:
+        if not isinstance(lookup, Exception) and lookup.cached is None:
+            misses[lookup.model.name] = misses.get(lookup.model.name, 0) + 1
+    try:
+        for name, count in misses.items():
+            limiters[name].reject_if_over(count)
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    async def resolve(lookup):
+        if isinstance(lookup, Exception):
+            raise lookup
+        if lookup.cached is not None:
+            return analysis_result(lookup, lookup.cached, True)
+        return analysis_result(lookup, await infer(lookup.model, lookup.key, lookup.payload), False)
+
+    outcomes = await asyncio.gather(*(resolve(lookup) for lookup in lookups), return_exceptions=True)
+    by_key = dict(zip(keys, outcomes))
+
+    results = []
+    for i, item in enumerate(payload.items):
+        outcome = by_key[(item.type, item.content, item.file)]
+        if isinstance(outcome, Exception):
+            print(f"Error in /api/analyze/batch item {i}:", repr(outcome))
+            model_id = backend_for(backend, item.type).model_id
+            results.append({"model": model_id, "success": False, "error": f"HF error: {outcome}"})
+        else:
+            results.append(outcome)
 
-        try:
-            constructiveness = float(raw_construct)
-        except (TypeError, ValueError):
-            constructiveness = 0.5
-        constructiveness = max(0.0, min(1.0, constructiveness))
+    return {
+        "backend": backend.name,
+        "count": len(results),
+        "failed": sum(1 for r in results if not r["success"]),
+        "results": results,
+    }
 
-        try:
-            confidence = float(raw_confidence)
-        except (TypeError, ValueError):
-            confidence = 0.5
-        confidence = max(0.0, min(1.0, confidence))
-
-        return {
-            "summary": parsed.get("summary", ""),
-            "sentiment": raw_sentiment,
-            "category": raw_category,
-            "constructiveness_score": constructiveness,
-            "suggestions": parsed.get("suggestions", []),
-            "confidence": confidence,
-            "file": parsed.get("file", "unknown"),
-        }
-    except Exception:
-        return fallback_json("Invalid JSON returned from model")
 
 def convert_to_dashboard_format(ai_json: dict) -> dict:
     type_map = {
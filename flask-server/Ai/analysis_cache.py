@@ -0,0 +1,97 @@
+# Content-hash cache for model analyses.
+#
+# The same PR titles and comment bodies get re-analyzed on every score refresh.
+# A result only depends on the model, the prompt template and the content, so
+# it's stored on disk under a hash of exactly those and reused across restarts.
+# Bump PROMPT_VERSION in backends.py whenever the prompt changes to start fresh.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def content_key(model: str, prompt_version: str, data_type: str, content: str) -> str:
+    raw = json.dumps([model, prompt_version, data_type, content], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """SQLite-backed LRU cache: key -> parsed analysis dict."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analyses_lru ON analyses (accessed_at);")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM analyses;").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM analyses WHERE key = ?;", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analyses SET accessed_at = ? WHERE key = ?;", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: dict):
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO analyses (key, result, created_at, accessed_at) VALUES (?, ?, ?, ?);",
+                (key, json.dumps(result), now, now),
+            )
+            if cur.rowcount:
+                self._size += 1
+                self.stores += 1
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                cur = self._conn.execute(
+                    "DELETE FROM analyses WHERE key IN "
+                    "(SELECT key FROM analyses ORDER BY accessed_at ASC LIMIT ?);",
+                    (overflow,),
+                )
+                self._size -= cur.rowcount
+                self.evictions += cur.rowcount
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": self._size,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
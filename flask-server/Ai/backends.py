@@ -0,0 +1,359 @@
+# Analysis backends.
+#
+# Every backend turns one AnalysisRequest-like item (type, content, file) into
+# the structured analysis dict (summary, sentiment, category,
+# constructiveness_score, suggestions, confidence, file):
+#   * RemoteLLMBackend prompts Llama 3.1 through the HF Inference API -- slow
+#     and rate limited, but writes real summaries and suggestions. Its analyze()
+#     is a coroutine (AsyncInferenceClient), so waiting on HF costs no thread;
+#   * LocalClassifierBackend runs the codereviewai text classifier on the CPU
+#     in-process. It only rates sentiment/constructiveness, but takes
+#     milliseconds and never leaves the box.
+# The local backend's analyze_batch() runs several items in one forward pass;
+# aiapp.py feeds it through a batching.Coalescer.
+# AI_BACKEND picks remote, local, or hybrid (comments local, PRs/code remote).
+
+import os
+
+from json_extract import JSONExtractor, extract_json
+
+REMOTE_MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+LOCAL_MODEL_ID = os.getenv("AI_LOCAL_MODEL", "Akirk1213/codereviewai")
+
+# part of the analysis cache key: bump it whenever build_prompt or the system message
+# changes, so results produced with the old prompt stop being served
+PROMPT_VERSION = "1"
+
+SYSTEM_MSG = (
+    "You are an AI that analyzes GitHub pull requests, comments, or code "
+    "and returns ONLY JSON in a fixed schema. Do not include markdown or text "
+    "outside the JSON object."
+)
+
+
+def build_prompt(data_type: str, content: str, file: str = "unknown") -> str:
+    return f"""
+You are an AI that analyzes GitHub {data_type}s. Pr's, and Comments. Please give us explanations of PR reviews and
+how to better right PR's/ Handle issues. Look at code syntax for error analysis on code basis in PR's.
+
+Return ONLY valid JSON in exactly this schema and value ranges:
+
+{{
+  "summary": "short explanation (string)",
+  "sentiment": "positive" | "neutral" | "negative",
+  "category": "feature" | "bugfix" | "refactor" | "documentation" | "other",
+  "constructiveness_score": number between 0 and 1,
+  "suggestions": ["1-3 short actionable suggestions (strings)"],
+  "confidence": number between 0 and 1,
+  "file": "{file}"
+}}
+
+Do not include any extra keys. Do not include markdown or explanation outside the JSON.
+
+Content:
+\"\"\" 
+{content}
+\"\"\" 
+"""
+
+
+# the analysis schema as JSON Schema, for grammar-constrained decoding (AI_JSON_GRAMMAR=1);
+# needs a provider that supports response_format, such as TGI
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "sentiment": {"type": "string", "enum": ["positive", "neutral", "negative"]},
+        "category": {"type": "string", "enum": ["feature", "bugfix", "refactor", "documentation", "other"]},
+        "constructiveness_score": {"type": "number", "minimum": 0, "maximum": 1},
+        "suggestions": {"type": "array", "items": {"type": "string"}, "maxItems": 3},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "file": {"type": "string"},
+    },
+    "required": ["summary", "sentiment", "category", "constructiveness_score", "suggestions", "confidence", "file"],
+    "additionalProperties": False,
+}
+JSON_GRAMMAR = os.getenv("AI_JSON_GRAMMAR", "0") == "1"
+
+FALLBACK_SUGGESTIONS = ["No valid output generated."]
+
+
+def is_fallback(structured: dict) -> bool:
+    """True if parse_ai_response couldn't get anything out of the model output."""
+    return structured.get("suggestions") == FALLBACK_SUGGESTIONS
+
+
+def fallback_json(reason: str) -> dict:
+    return {
+        "summary": reason,
+        "sentiment": "neutral",
+        "category": "other",
+        "constructiveness_score": 0.5,
+        "suggestions": list(FALLBACK_SUGGESTIONS),
+        "confidence": 0.5,
+        "file": "unknown",
+    }
+
+
+def parse_ai_response(output: str) -> dict:
+    return normalize_analysis(extract_json(output))
+
+
+def normalize_analysis(parsed) -> dict:
+    """The analysis schema, with defaults and clamping, from the object the model produced (or None)."""
+    if parsed is None:
+        return fallback_json("Unable to parse model output")
+
+    try:
+        raw_sentiment = parsed.get("sentiment", "neutral")
+        raw_category = parsed.get("category", "other")
+        raw_construct = parsed.get("constructiveness_score")
+        raw_confidence = parsed.get("confidence", 0.5)
+
+        if raw_sentiment not in {"positive", "neutral", "negative"}:
+            raw_sentiment = "neutral"
+
+        if raw_category not in {"feature", "bugfix", "refactor", "documentation", "other"}:
+            raw_category = "other"
+
+        try:
+            constructiveness = float(raw_construct)
+        except (TypeError, ValueError):
+            constructiveness = 0.5
+        constructiveness = max(0.0, min(1.0, constructiveness))
+
+        try:
+            confidence = float(raw_confidence)
+        except (TypeError, ValueError):
+            confidence = 0.5
+        confidence = max(0.0, min(1.0, confidence))
+
+        return {
+            "summary": parsed.get("summary", ""),
+            "sentiment": raw_sentiment,
+            "category": raw_category,
+            "constructiveness_score": constructiveness,
+            "suggestions": parsed.get("suggestions", []),
+            "confidence": confidence,
+            "file": parsed.get("file", "unknown"),
+        }
+    except Exception:
+        return fallback_json("Invalid JSON returned from model")
+
+
+class RemoteLLMBackend:
+    name = "remote"
+    # the analysis cache is keyed by model and prompt version
+    prompt_version = PROMPT_VERSION
+
+    def __init__(self, token: str, model_id: str = REMOTE_MODEL_ID):
+        from huggingface_hub import AsyncInferenceClient
+
+        self.model_id = model_id
+        self.client = AsyncInferenceClient(model=model_id, token=token)
+        print(f"🔹 Using HF Inference API model: {model_id}")
+
+    def _chat_args(self, data_type, content, file):
+        args = {
+            "messages": [
+                {"role": "system", "content": SYSTEM_MSG},
+                {"role": "user", "content": build_prompt(data_type, content, file)},
+            ],
+            "max_tokens": 300,
+            "temperature": 0.6,
+            "top_p": 0.9,
+        }
+        if JSON_GRAMMAR:
+            args["response_format"] = {"type": "json", "value": ANALYSIS_SCHEMA}
+        return args
+
+    async def analyze(self, data_type: str, content: str, file: str = "unknown") -> dict:
+        resp = await self.client.chat_completion(**self._chat_args(data_type, content, file))
+
+        # HF returns an object; extract the text
+        raw_output = resp.choices[0].message["content"]
+        print("🔹 HF output (truncated):", repr(raw_output)[:200])
+        return parse_ai_response(raw_output)
+
+    async def analyze_stream(self, data_type: str, content: str, file: str = "unknown"):
+        """
+        Yield ("token", text) as the model generates, then ("result", parsed
+        analysis). Generation is cut off as soon as the JSON object is complete.
+        """
+        extractor = JSONExtractor()
+        stream = await self.client.chat_completion(**self._chat_args(data_type, content, file), stream=True)
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield "token", delta
+                    if extractor.feed(delta) is not None:
+                        # whatever the model says after the object is thrown away anyway
+                        break
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+
+        print("🔹 HF output (truncated):", repr(extractor.text)[:200])
+        yield "result", normalize_analysis(extractor.finish())
+
+    def stats(self):
+        return {"name": self.name, "model": self.model_id}
+
+
+# how much each kind of label counts towards constructiveness_score
+_LABEL_WEIGHTS = (
+    ("non-constructive", 0.0), ("unconstructive", 0.0), ("toxic", 0.0), ("neg", 0.0),
+    ("constructive", 1.0), ("pos", 1.0),
+    ("neu", 0.5),
+)
+
+
+def _parse_label_weights(spec: str) -> dict:
+    """AI_LOCAL_LABEL_WEIGHTS: "LABEL_0=0,LABEL_1=1"; a key is a label name or a class id."""
+    weights = {}
+    for pair in filter(None, (part.strip() for part in spec.split(","))):
+        label, sep, weight = pair.rpartition("=")
+        if not sep or not label.strip():
+            raise ValueError(f"AI_LOCAL_LABEL_WEIGHTS: expected label=weight, got {pair!r}")
+        weights[label.strip()] = float(weight)
+    return weights
+
+
+def resolve_label_weights(id2label: dict, configured: dict) -> dict:
+    """
+    {label: weight} for every label the model outputs. A configured weight (by
+    name or class id) wins, then the names in _LABEL_WEIGHTS. If nothing
+    matches a two-label model with generic names (LABEL_0/LABEL_1), class 0
+    is taken as negative and class 1 as positive. Anything else counts as
+    neutral, with a warning.
+    """
+    weights, unmatched = {}, []
+    for class_id, label in sorted(id2label.items()):
+        weight = configured.get(label, configured.get(str(class_id)))
+        if weight is None:
+            weight = next((w for needle, w in _LABEL_WEIGHTS if needle in label.lower()), None)
+        if weight is None:
+            unmatched.append((class_id, label))
+        else:
+            weights[label] = weight
+
+    if unmatched and not weights and len(id2label) == 2:
+        print(f"⚠️ Local classifier labels {sorted(id2label.values())} say nothing about constructiveness; "
+              "taking class 0 as negative and class 1 as positive (set AI_LOCAL_LABEL_WEIGHTS to override)")
+        return {label: float(class_id) for class_id, label in unmatched}
+    if unmatched:
+        print(f"⚠️ No weight for local classifier labels {[label for _, label in unmatched]}; scoring them "
+              "as neutral (set AI_LOCAL_LABEL_WEIGHTS)")
+        weights.update((label, 0.5) for _, label in unmatched)
+    return weights
+
+
+class LocalClassifierBackend:
+    """codereviewai (or AI_LOCAL_MODEL) on the CPU, loaded once when the service starts."""
+
+    name = "local"
+
+    def __init__(self, model_id: str = LOCAL_MODEL_ID, max_length: int = 512, threads: int = 0):
+        import torch
+        from transformers import pipeline
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model_id = model_id
+        self.max_length = max_length
+        self.pipe = pipeline("text-classification", model=model_id, device=-1, top_k=None)
+        id2label = {int(class_id): label for class_id, label in self.pipe.model.config.id2label.items()}
+        self.label_weights = resolve_label_weights(
+            id2label, _parse_label_weights(os.getenv("AI_LOCAL_LABEL_WEIGHTS", ""))
+        )
+        # no prompt involved; the label -> score mapping is what decides the results instead
+        self.prompt_version = "local-2:" + ",".join(f"{label}={w}" for label, w in sorted(self.label_weights.items()))
+        print(f"🔹 Loaded local classifier: {model_id} (label weights {self.label_weights})")
+
+    def analyze(self, data_type: str, content: str, file: str = "unknown") -> dict:
+        return self.analyze_batch([(data_type, content, file)])[0]
+
+    def analyze_batch(self, items):
+        # one forward pass for the whole batch; long inputs are cut at the model's window
+        texts = [content for _, content, _ in items]
+        outputs = self.pipe(texts, batch_size=len(texts), truncation=True, max_length=self.max_length)
+        return [self._to_analysis(scores, file) for (_, _, file), scores in zip(items, outputs)]
+
+    def _to_analysis(self, scores, file):
+        # scores: [{"label": ..., "score": ...}, ...] over all labels
+        top = max(scores, key=lambda s: s["score"])
+        constructiveness = sum(s["score"] * self.label_weights.get(s["label"], 0.5) for s in scores)
+        top_weight = self.label_weights.get(top["label"], 0.5)
+        return {
+            "summary": f"Classified as {top['label']}",
+            "sentiment": "positive" if top_weight >= 0.75 else "negative" if top_weight <= 0.25 else "neutral",
+            "category": "other",
+            "constructiveness_score": max(0.0, min(1.0, constructiveness)),
+            "suggestions": [],
+            "confidence": float(top["score"]),
+            "file": file,
+        }
+
+    def stats(self):
+        return {"name": self.name, "model": self.model_id}
+
+
+class HybridBackend:
+    """Routes item types in ``local_types`` to the local classifier, everything else to the LLM."""
+
+    name = "hybrid"
+
+    def __init__(self, local: LocalClassifierBackend, remote: RemoteLLMBackend, local_types):
+        self.local = local
+        self.remote = remote
+        self.local_types = set(local_types)
+
+    def models(self):
+        return [self.local, self.remote]
+
+    def for_type(self, data_type: str):
+        return self.local if data_type in self.local_types else self.remote
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "local_types": sorted(self.local_types),
+            "local": self.local.stats(),
+            "remote": self.remote.stats(),
+        }
+
+
+def make_backend():
+    """Build the backend from AI_BACKEND / AI_LOCAL_* env vars."""
+    kind = os.getenv("AI_BACKEND", "remote").lower()
+
+    def remote():
+        token = os.getenv("HUGGINGFACE_API_TOKEN")
+        if not token:
+            raise ValueError("Missing Hugging Face API key in environment variables")
+        return RemoteLLMBackend(token)
+
+    def local():
+        return LocalClassifierBackend(threads=int(os.getenv("AI_LOCAL_THREADS", "0")))
+
+    if kind == "remote":
+        return remote()
+    if kind == "local":
+        return local()
+    if kind == "hybrid":
+        local_types = [t.strip() for t in os.getenv("AI_LOCAL_TYPES", "comment").split(",") if t.strip()]
+        return HybridBackend(local(), remote(), local_types)
+    raise ValueError(f"Unknown AI_BACKEND: {kind}")
+
+
+def backend_for(backend, data_type: str):
+    """The single-model backend that handles data_type."""
+    return backend.for_type(data_type) if isinstance(backend, HybridBackend) else backend
+
+
+def models_of(backend):
+    """Every single-model backend behind ``backend``."""
+    return backend.models() if isinstance(backend, HybridBackend) else [backend]
@@ -0,0 +1,121 @@
+# Request coalescing.
+#
+# Every analysis -- from /api/analyze or one item of /api/analyze/batch -- is
+# submitted to its backend's Coalescer instead of calling the model directly.
+# A worker thread collects whatever has queued up, waiting at most max_latency
+# after the first item or until max_batch items are in, and runs them through
+# the backend's analyze_batch() in one call. Each caller gets its own result
+# (or exception) back through a Future.
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+# batch-size histogram buckets (upper bounds, inclusive)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# how many recent queue waits the percentiles are computed over
+WAIT_WINDOW = 1000
+
+
+class Coalescer:
+    def __init__(self, fn, max_batch: int, max_latency: float, workers: int = 1, name: str = "coalescer"):
+        """
+        ``fn(items)`` must return one entry per item, in order; an entry that is
+        an Exception fails only that item. ``workers`` batches run at once.
+        """
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._histogram = {b: 0 for b in BATCH_SIZE_BUCKETS}
+        self._overflow = 0
+        self._waits = deque(maxlen=WAIT_WINDOW)
+
+        for i in range(workers):
+            threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+
+            try:
+                results = self.fn([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{self.name}: got {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                results = [e] * len(batch)
+
+            errors = 0
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    errors += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+            self._record(len(batch), [started - queued_at for _, _, queued_at in batch], errors)
+
+    def _record(self, size, waits, errors):
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._errors += errors
+            self._waits.extend(waits)
+            for bound in BATCH_SIZE_BUCKETS:
+                if size <= bound:
+                    self._histogram[bound] += 1
+                    break
+            else:
+                self._overflow += 1
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            histogram = {f"<={b}": n for b, n in self._histogram.items()}
+            histogram[f">{BATCH_SIZE_BUCKETS[-1]}"] = self._overflow
+            batches, items, errors = self._batches, self._items, self._errors
+
+        def pct(p):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1)
+
+        return {
+            "max_batch": self.max_batch,
+            "max_latency_ms": round(self.max_latency * 1000, 1),
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "batches": batches,
+            "items": items,
+            "errors": errors,
+            "avg_batch_size": round(items / batches, 2) if batches else 0.0,
+            "batch_size_histogram": histogram,
+            "queue_wait_p50_ms": pct(0.50),
+            "queue_wait_p95_ms": pct(0.95),
+        }
@@ -0,0 +1,100 @@
+# Micro-benchmark: getting the analysis JSON out of model output.
+#
+#   python bench/parse_bench.py [corpus.jsonl] [--rounds N]
+#
+# Compares the old greedy-regex extraction with json_extract, with and without
+# orjson, over a corpus of model outputs ({"shape", "output"} per line; the
+# default is bench/ai_outputs.jsonl). Reports how many outputs each one gets a
+# JSON object out of and the time per output, plus, for the streaming scanner,
+# how much of the output it had to see before the object was complete.
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import json_extract  # noqa: E402
+from json_extract import JSONExtractor, extract_json  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai_outputs.jsonl")
+# characters per streamed "token" in the streaming run
+TOKEN_CHARS = 4
+
+
+def greedy_regex(output):
+    # what parse_ai_response used to do
+    match = re.search(r"\{.*\}", output, re.DOTALL)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group())
+    except ValueError:
+        return None
+
+
+def streamed(output):
+    extractor = JSONExtractor()
+    for i in range(0, len(output), TOKEN_CHARS):
+        if extractor.feed(output[i:i + TOKEN_CHARS]) is not None:
+            return extractor.value, i + TOKEN_CHARS
+    return extractor.finish(), len(output)
+
+
+def bench(fn, outputs, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for output in outputs:
+            fn(output)
+        best = min(best, time.perf_counter() - started)
+    return best / len(outputs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", default=DEFAULT_CORPUS)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    outputs = [s["output"] for s in samples]
+    print(f"{len(outputs)} outputs, {sum(map(len, outputs)) / len(outputs):.0f} chars on average, "
+          f"orjson {'available' if json_extract.orjson else 'not installed'}\n")
+
+    orjson = json_extract.orjson
+    runs = [("greedy regex + json", greedy_regex, False), ("extract_json, json", extract_json, False)]
+    if orjson is not None:
+        runs.append(("extract_json, orjson", extract_json, True))
+    runs.append((f"JSONExtractor, {TOKEN_CHARS}-char tokens", streamed, orjson is not None))
+
+    print(f"{'':32}{'parsed':>8}{'us/output':>12}")
+    for name, fn, use_orjson in runs:
+        json_extract.orjson = orjson if use_orjson else None
+        parsed = sum(1 for output in outputs if _value(fn(output)) is not None)
+        print(f"{name:32}{parsed:>5}/{len(outputs):<3}{bench(fn, outputs, args.rounds):>11.1f}")
+    json_extract.orjson = orjson
+
+    print("\nby shape (greedy regex / extract_json):")
+    shapes = Counter(s["shape"] for s in samples)
+    for shape in shapes:
+        group = [s["output"] for s in samples if s["shape"] == shape]
+        old = sum(1 for output in group if greedy_regex(output) is not None)
+        new = sum(1 for output in group if extract_json(output) is not None)
+        print(f"  {shape:20}{old:>4} /{new:>3}  of {len(group)}")
+
+    seen = [streamed(output)[1] / len(output) for output in outputs if _value(streamed(output)) is not None]
+    print(f"\nstreaming: object complete after {sum(seen) / len(seen):.0%} of the output on average")
+
+
+def _value(result):
+    return result[0] if isinstance(result, tuple) else result
+
+
+if __name__ == "__main__":
+    main()
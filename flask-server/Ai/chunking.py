@@ -0,0 +1,134 @@
+# Map-reduce analysis of big PRs.
+#
+# /api/analyze/chunked splits a diff into one piece per file -- per hunk for a
+# file that doesn't fit in one prompt even after compaction -- and analyzes the
+# pieces concurrently. The per-piece analyses are then reduced into a single
+# one in the usual schema, so latency follows the largest piece rather than the
+# size of the whole PR. When there are more pieces than the model can take at
+# once, neighbouring pieces are packed together so the PR still goes out in a
+# single wave.
+
+import os
+from collections import namedtuple
+
+from backends import is_fallback
+from compaction import (
+    PROMPT_MAX_TOKENS, Compacted, compact, count_tokens, is_skipped_file, looks_generated, split_files,
+    split_hunks,
+)
+
+# most pieces one PR is analyzed in; also capped by the model's AI_BATCH_WORKERS / AI_LOCAL_MAX_INFLIGHT
+MAX_CHUNKS = int(os.getenv("AI_MAX_CHUNKS", "16"))
+# suggestions kept in the reduced analysis (the prompt asks for 1-3)
+MAX_SUGGESTIONS = 3
+# per-piece summaries quoted in the reduced summary
+MAX_SUMMARIES = 3
+
+# files: the paths in the chunk (None for text before the first file, e.g. a PR description)
+Chunk = namedtuple("Chunk", "files compacted")
+
+
+def _pieces(content: str, budget: int):
+    pieces, dropped = [], []
+    for path, lines in split_files(content):
+        if path is not None and (is_skipped_file(path) or looks_generated(lines)):
+            dropped.append(path)
+            continue
+        whole = compact("\n".join(lines), budget)
+        if not whole.truncated or path is None:
+            pieces.append(Chunk([path], whole))
+            continue
+        preamble, hunks = split_hunks(lines)
+        hunk_pieces = [Chunk([path], compact("\n".join(preamble + hunk), budget)) for hunk in hunks]
+        pieces.extend(hunk_pieces or [Chunk([path], whole)])
+    return pieces, dropped
+
+
+def _merge(chunks, budget: int):
+    text = "\n".join(chunk.compacted.text for chunk in chunks)
+    tokens = count_tokens(text)
+    truncated = any(chunk.compacted.truncated for chunk in chunks)
+    if tokens > budget:
+        # more pieces than chunks: no chunk gets a bigger prompt than a single analysis would
+        fitted = compact(text, budget)
+        text, tokens, truncated = fitted.text, fitted.tokens, truncated or fitted.truncated
+    original_tokens = sum(chunk.compacted.original_tokens for chunk in chunks)
+    compacted = Compacted(text, original_tokens, tokens, [], truncated)
+    return Chunk([path for chunk in chunks for path in chunk.files], compacted)
+
+
+def _pack(pieces, max_chunks: int, budget: int):
+    """Group consecutive pieces into at most max_chunks chunks of similar size."""
+    if len(pieces) <= max_chunks:
+        return pieces
+    total = sum(piece.compacted.tokens for piece in pieces)
+    capacity = max(-(-total // max_chunks), max(piece.compacted.tokens for piece in pieces))
+    while True:
+        groups, current, size = [], [], 0
+        for piece in pieces:
+            if current and size + piece.compacted.tokens > capacity:
+                groups.append(current)
+                current, size = [], 0
+            current.append(piece)
+            size += piece.compacted.tokens
+        groups.append(current)
+        if len(groups) <= max_chunks:
+            return [group[0] if len(group) == 1 else _merge(group, budget) for group in groups]
+        capacity = capacity * 5 // 4 + 1
+
+
+def split_chunks(content: str, max_chunks: int = MAX_CHUNKS, budget: int = PROMPT_MAX_TOKENS):
+    """(chunks, dropped file paths): content cut into at most max_chunks compacted chunks."""
+    pieces, dropped = _pieces(content, budget)
+    if not pieces:
+        # nothing but lockfiles and the like; analyze what compaction makes of it
+        pieces = [Chunk([None], compact(content, budget))]
+    return _pack(pieces, max(1, max_chunks), budget), dropped
+
+
+def reduce_analyses(parts, file: str = "unknown") -> dict:
+    """
+    One analysis from [(chunk, analysis)]: sentiment and category by vote,
+    scores averaged, both weighted by the tokens each chunk had; the worst-rated
+    chunks' suggestions first.
+    """
+    # chunks the model gave no usable answer for don't get a say, unless that's all of them
+    usable = [(chunk, analysis) for chunk, analysis in parts if not is_fallback(analysis)] or parts
+    if len(usable) == 1:
+        return {**usable[0][1], "file": file}
+
+    weights = [max(chunk.compacted.tokens, 1) for chunk, _ in usable]
+    total = sum(weights)
+
+    def vote(field):
+        tally = {}
+        for weight, (_, analysis) in zip(weights, usable):
+            tally[analysis[field]] = tally.get(analysis[field], 0) + weight
+        return max(tally, key=tally.get)
+
+    def mean(field):
+        return sum(weight * analysis[field] for weight, (_, analysis) in zip(weights, usable)) / total
+
+    suggestions, seen = [], set()
+    for _, analysis in sorted(usable, key=lambda part: part[1]["constructiveness_score"]):
+        for suggestion in analysis["suggestions"] or []:
+            if isinstance(suggestion, str) and suggestion.lower() not in seen:
+                seen.add(suggestion.lower())
+                suggestions.append(suggestion)
+
+    biggest = sorted(zip(weights, usable), key=lambda w_part: w_part[0], reverse=True)
+    # the model sometimes answers with a list or an object here; those are skipped like odd suggestions
+    summaries = list(dict.fromkeys(analysis["summary"] for _, (_, analysis) in biggest
+                                   if isinstance(analysis["summary"], str) and analysis["summary"]))
+    files = {path for chunk, _ in usable for path in chunk.files if path}
+    summary = f"Reviewed {len(files)} files in {len(usable)} parts. " + " ".join(summaries[:MAX_SUMMARIES])
+
+    return {
+        "summary": summary.strip(),
+        "sentiment": vote("sentiment"),
+        "category": vote("category"),
+        "constructiveness_score": mean("constructiveness_score"),
+        "suggestions": suggestions[:MAX_SUGGESTIONS],
+        "confidence": mean("confidence"),
+        "file": file,
+    }
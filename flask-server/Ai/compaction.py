@@ -0,0 +1,249 @@
+# Content reduction before prompting.
+#
+# PR content can be a whole diff (get_pr_details files), and build_prompt used
+# to paste it in verbatim. compact() shrinks it to what the model needs:
+#   * diffs are split per file; lockfiles, generated, minified, vendored and
+#     binary files are dropped;
+#   * inside each hunk only changed lines and a few lines of context around
+#     them are kept;
+#   * a hunk that's identical to one already kept (the same header added to
+#     twenty files, say) is replaced by a one-line reference, and long runs of
+#     identical lines are collapsed;
+#   * the result is fitted into a token budget, sharing it fairly between
+#     files, and cut head+tail as a last resort.
+# Plain text (comments, titles) only gets the run-collapsing and the budget.
+
+import fnmatch
+import os
+import re
+import threading
+from collections import namedtuple
+
+PROMPT_MAX_TOKENS = int(os.getenv("AI_PROMPT_MAX_TOKENS", "2000"))
+DIFF_CONTEXT_LINES = int(os.getenv("AI_DIFF_CONTEXT_LINES", "3"))
+# optional: a HF tokenizer (e.g. the LLM's) for exact counts instead of the estimate
+TOKENIZER = os.getenv("AI_TOKENIZER", "")
+
+# identical consecutive lines beyond this are collapsed into one marker
+MAX_REPEATED_LINES = 3
+
+SKIPPED_FILES = (
+    # lockfiles
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json", "poetry.lock",
+    "Pipfile.lock", "Cargo.lock", "Gemfile.lock", "composer.lock", "go.sum", "*.lock",
+    # generated / minified / build output
+    "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py", "*_pb2_grpc.py", "*.generated.*",
+    "*.snap", "*/__snapshots__/*", "dist/*", "build/*", "*/dist/*", "*/build/*",
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*",
+    # binaries
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.pdf", "*.woff", "*.woff2", "*.ttf", "*.zip",
+)
+GENERATED_MARKERS = ("@generated", "DO NOT EDIT", "auto-generated", "autogenerated")
+
+Compacted = namedtuple("Compacted", "text original_tokens tokens dropped_files truncated")
+
+_FILE_HEADER = re.compile(r"^diff --git a/(\S+) b/(\S+)", re.MULTILINE)
+_HUNK_HEADER = re.compile(r"^@@ .* @@")
+_SKIP_MARKER = re.compile(r"^ \.\.\. (\d+) unchanged lines$")
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """Tokens in text: exact with AI_TOKENIZER, otherwise an estimate (words + punctuation, or chars/4)."""
+    global _tokenizer
+    if TOKENIZER:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import AutoTokenizer
+
+                _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER)
+        return len(_tokenizer.encode(text, add_special_tokens=False))
+    return max(len(_TOKEN_PIECES.findall(text)), len(text) // 4)
+
+
+def is_skipped_file(path: str) -> bool:
+    name = path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in SKIPPED_FILES)
+
+
+def looks_generated(lines) -> bool:
+    head = "\n".join(lines[:20])
+    return any(marker in head for marker in GENERATED_MARKERS)
+
+
+def collapse_repeats(lines):
+    out = []
+    i = 0
+    while i < len(lines):
+        j = i
+        while j < len(lines) and lines[j] == lines[i]:
+            j += 1
+        run = j - i
+        if run > MAX_REPEATED_LINES:
+            out.extend(lines[i:i + MAX_REPEATED_LINES])
+            out.append(f"... (previous line repeated {run - MAX_REPEATED_LINES} more times)")
+        else:
+            out.extend(lines[i:j])
+        i = j
+    return out
+
+
+def trim_hunk(lines, context: int):
+    """Keep a hunk's header, its +/- lines, and ``context`` unchanged lines around each change."""
+    header, body = lines[0], lines[1:]
+    changed = [i for i, line in enumerate(body) if line[:1] in ("+", "-")]
+    keep = set()
+    for i in changed:
+        keep.update(range(max(0, i - context), min(len(body), i + context + 1)))
+
+    out = [header]
+    skipped = 0
+    for i, line in enumerate(body):
+        if i in keep:
+            if skipped:
+                out.append(f" ... {skipped} unchanged lines")
+                skipped = 0
+            out.append(line)
+        else:
+            # already-trimmed input (a chunk compacted again) keeps its counts
+            marker = _SKIP_MARKER.match(line)
+            skipped += int(marker.group(1)) if marker else 1
+    if skipped:
+        out.append(f" ... {skipped} unchanged lines")
+    return out
+
+
+def split_files(text: str):
+    """[(path, lines)] for a `git diff`; a single (None, lines) for anything else."""
+    starts = [m.start() for m in _FILE_HEADER.finditer(text)]
+    if not starts:
+        return [(None, text.splitlines())]
+    files = []
+    if text[:starts[0]].strip():
+        files.append((None, text[:starts[0]].splitlines()))
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        chunk = text[start:end]
+        files.append((_FILE_HEADER.match(chunk).group(2), chunk.splitlines()))
+    return files
+
+
+def split_hunks(lines):
+    """(preamble lines, [hunk lines, ...]); every hunk starts with its @@ header."""
+    preamble, hunks = [], []
+    for line in lines:
+        if _HUNK_HEADER.match(line):
+            hunks.append([line])
+        elif hunks:
+            hunks[-1].append(line)
+        else:
+            preamble.append(line)
+    return preamble, hunks
+
+
+def fit_lines(lines, budget: int):
+    """The longest prefix of lines that fits in budget tokens, plus an omission marker."""
+    kept, used = [], 0
+    for i, line in enumerate(lines):
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            kept.append(f"... {len(lines) - i} more lines omitted")
+            return kept, True
+        kept.append(line)
+        used += cost
+    return kept, False
+
+
+def cut_middle(text: str, budget: int) -> str:
+    """Head and tail of text within budget tokens (by the chars/token ratio of text itself)."""
+    chars = int(len(text) * budget / max(count_tokens(text), 1))
+    head, tail = text[: chars * 2 // 3], text[-(chars // 3):] if chars >= 3 else ""
+    return f"{head}\n... [truncated] ...\n{tail}"
+
+
+def compact(content: str, max_tokens: int = PROMPT_MAX_TOKENS, context: int = DIFF_CONTEXT_LINES) -> Compacted:
+    original_tokens = count_tokens(content)
+    dropped = []
+    seen_hunks = {}
+    sections = []  # (path, lines)
+
+    for path, lines in split_files(content):
+        if path is not None and (is_skipped_file(path) or looks_generated(lines)):
+            dropped.append(path)
+            continue
+        preamble, hunks = split_hunks(lines)
+        out = collapse_repeats(preamble)
+        for hunk in hunks:
+            body = "\n".join(line for line in hunk[1:] if line[:1] in ("+", "-"))
+            if body and body in seen_hunks:
+                out.append(hunk[0])
+                out.append(f" ... same change as in {seen_hunks[body]}")
+                continue
+            if body:
+                seen_hunks[body] = path or "an earlier hunk"
+            out.extend(collapse_repeats(trim_hunk(hunk, context)))
+        sections.append((path, out))
+
+    if dropped:
+        sections.append((None, [f"(skipped lockfiles/generated files: {', '.join(dropped)})"]))
+
+    # share the budget: small sections keep everything, big ones split what's left
+    truncated = False
+    costs = [sum(count_tokens(line) + 1 for line in lines) for _, lines in sections]
+    remaining = max_tokens
+    fitted = [None] * len(sections)
+    for n, i in enumerate(sorted(range(len(sections)), key=lambda k: costs[k])):
+        share = remaining // (len(sections) - n)
+        if costs[i] <= share:
+            fitted[i] = sections[i][1]
+            remaining -= costs[i]
+        else:
+            fitted[i], cut = fit_lines(sections[i][1], share)
+            truncated = truncated or cut
+            remaining -= share
+
+    text = "\n".join(line for lines in fitted for line in lines)
+    tokens = count_tokens(text)
+    if tokens > max_tokens:
+        # one huge line (minified code, a pasted log) that line-based fitting can't split
+        text = cut_middle(text, max_tokens)
+        tokens = count_tokens(text)
+        truncated = True
+
+    return Compacted(text, original_tokens, tokens, dropped, truncated)
+
+
+class CompactionStats:
+    """Running token totals for /api/backend."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.original_tokens = 0
+        self.tokens = 0
+        self.truncated = 0
+        self.dropped_files = 0
+
+    def record(self, c: Compacted):
+        with self._lock:
+            self.requests += 1
+            self.original_tokens += c.original_tokens
+            self.tokens += c.tokens
+            self.truncated += int(c.truncated)
+            self.dropped_files += len(c.dropped_files)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_tokens": PROMPT_MAX_TOKENS,
+                "context_lines": DIFF_CONTEXT_LINES,
+                "tokenizer": TOKENIZER or "estimate",
+                "requests": self.requests,
+                "original_tokens": self.original_tokens,
+                "prompt_tokens": self.tokens,
+                "saved_ratio": round(1 - self.tokens / self.original_tokens, 3) if self.original_tokens else 0.0,
+                "truncated": self.truncated,
+                "dropped_files": self.dropped_files,
+            }
@@ -0,0 +1,199 @@
+# Pulling the JSON object out of model output.
+#
+# The model is asked for bare JSON but often wraps it in prose or a ```json
+# fence, sometimes with braces of its own in the prose ("hope {this} helps"),
+# and with max_tokens it can be cut off mid-object. A greedy \{.*\} regex
+# grabs from the first "{" to the last "}" and fails on all of those.
+#
+# extract_json() tries to decode an object at each "{" in turn with the C
+# scanner's raw_decode, which stops at the object's closing brace and ignores
+# whatever follows; a "{" in prose fails within a few characters.
+#
+# JSONExtractor does the same for text that arrives in pieces: it tracks
+# brackets and strings (a whole string is skipped with one regex match, so
+# braces inside values don't count) and reports the object as soon as its
+# closing brace arrives, so the rest of a streamed generation can be dropped.
+# Its finish() also repairs an object cut off by max_tokens.
+#
+# orjson, when installed, parses output that is nothing but the object.
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+
+def loads(text: str):
+    """json.loads, through orjson when available. Raises ValueError on bad JSON."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+_decoder = json.JSONDecoder()
+
+_OPENERS = {"{": "}", "[": "]"}
+# a "{" that can start an object: a key or "}" comes next (or nothing yet, when streaming)
+_OBJECT_START = re.compile(r'\{\s*(?:["}]|\Z)')
+_STRUCTURAL = re.compile(r'[{}\[\]"]')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_IN_STRING = re.compile(r'["\\]')
+
+
+class JSONExtractor:
+    """Finds the first JSON object in text that arrives in pieces."""
+
+    def __init__(self):
+        self.value = None
+        self._chunks = []
+        self._buf = ""         # the unscanned tail, from the current candidate's "{" on
+        self._pos = 0          # next index of _buf to scan
+        self._start = None     # where in _buf the current candidate object began
+        self._stack = []       # closers owed by the current candidate
+        self._in_string = False
+
+    @property
+    def text(self) -> str:
+        """Everything fed so far."""
+        return "".join(self._chunks)
+
+    def feed(self, text: str):
+        """Scan text appended to what came before; the object once found, else None."""
+        self._chunks.append(text)
+        if self.value is not None:
+            return self.value
+        buf = self._buf + text
+        pos = self._pos
+
+        while True:
+            if self._in_string:
+                # a string split across feeds: step through its escapes to the closing quote
+                m = _IN_STRING.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == "\\":
+                    if m.end() >= len(buf):
+                        # the escaped character hasn't arrived yet
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                self._in_string = False
+                pos = m.end()
+                continue
+
+            if self._start is None:
+                m = _OBJECT_START.search(buf, pos)
+                if m is None:
+                    # keep a trailing "{" whose next character is still to come
+                    pos = len(buf) - 1 if buf.endswith("{") else len(buf)
+                    break
+                self._start = pos = m.start()
+                self._stack = ["}"]
+                pos += 1
+                continue
+
+            m = _STRUCTURAL.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            char, pos = m.group(), m.end()
+            if char == '"':
+                # usually the whole string is there already: skip it in one go
+                string = _STRING.match(buf, m.start())
+                if string is None:
+                    self._in_string = True
+                else:
+                    pos = string.end()
+            elif char in _OPENERS:
+                self._stack.append(_OPENERS[char])
+            elif char == self._stack[-1]:
+                self._stack.pop()
+                if not self._stack:
+                    if self._accept(buf[self._start:pos]):
+                        break
+                    # "{this}" in prose and the like: look again from just after its "{"
+                    pos = self._start + 1
+                    self._start = None
+            else:
+                # mismatched bracket: not JSON after all
+                pos = self._start + 1
+                self._start = None
+
+        # only the open candidate (if any) needs keeping, so scanning long prose stays linear
+        keep = pos if self._start is None else self._start
+        self._buf = buf[keep:]
+        self._pos = pos - keep
+        if self._start is not None:
+            self._start = 0
+        return self.value
+
+    def _accept(self, candidate: str) -> bool:
+        try:
+            value = loads(candidate)
+        except ValueError:
+            return False
+        if isinstance(value, dict):
+            self.value = value
+            return True
+        return False
+
+    def finish(self):
+        """The object, or a best-effort repair of one cut off at the end of the output (else None)."""
+        if self.value is not None or self._start is None:
+            return self.value
+        candidate = self._buf[self._start:]
+        if self._in_string:
+            if candidate.endswith("\\") and not candidate.endswith("\\\\"):
+                candidate = candidate[:-1]
+            candidate += '"'
+        closers = "".join(reversed(self._stack))
+        # as it stands, then without the half-written member after the last comma
+        attempts = [candidate.rstrip().rstrip(",:")]
+        if "," in candidate:
+            attempts.append(candidate[:candidate.rfind(",")])
+        for attempt in attempts:
+            try:
+                value = loads(attempt + closers)
+            except ValueError:
+                continue
+            # "{" and nothing after it isn't an answer
+            if isinstance(value, dict) and value:
+                self.value = value
+                return value
+        return None
+
+
+def extract_json(output: str):
+    """The first JSON object in output, or None."""
+    stripped = output.strip()
+    if stripped.startswith("{") and stripped.endswith("}"):
+        # fast path: the model did as it was told
+        try:
+            value = loads(stripped)
+        except ValueError:
+            value = None
+        if isinstance(value, dict):
+            return value
+
+    first = None
+    for m in _OBJECT_START.finditer(output):
+        if first is None:
+            first = m.start()
+        try:
+            value, _ = _decoder.raw_decode(output, m.start())
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    if first is None:
+        return None
+
+    # no complete object anywhere; maybe the output stopped in the middle of one
+    extractor = JSONExtractor()
+    extractor.feed(output[first:])
+    return extractor.finish()
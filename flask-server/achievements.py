@@ -0,0 +1,258 @@
+# Automatic achievements.
+#
+# A row in achievement_rules ties an award to a metric and a threshold ("prs
+# >= 1", "constructive_comments >= 100", "overall_rank <= 10"). Rules aren't
+# checked by scanning users: each metric declares which score fields ("code",
+# "comment") can move it, and the score event compactor hands every batch it
+# folds in to evaluate_rules() with the users whose fields changed. Only the
+# rules indexed under those fields run, each as one statement restricted to
+# those users, in the compactor's transaction -- an award is granted exactly
+# when the scores that earn it land in users.
+#
+# Rank rules look at the current top N instead (an index walk of N rows): a
+# user whose score didn't change can still move up when someone else's drops.
+# N is capped at MAX_PAGE_SIZE, as deep as a leaderboard page goes.
+#
+# Awards are granted, never taken back. A new rule is evaluated once against
+# every user (backfill_rules); so are rules created by a migration, on startup.
+
+import os
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from db import get_db
+from leaderboard import MAX_PAGE_SIZE
+
+# how long a process keeps its rule index before re-reading achievement_rules (seconds)
+ACHIEVEMENT_RULES_TTL = float(os.getenv("ACHIEVEMENT_RULES_TTL", "30"))
+# a comment counts as constructive from this compute_score score on (0-100)
+CONSTRUCTIVE_SCORE = int(os.getenv("ACHIEVEMENT_CONSTRUCTIVE_SCORE", "60"))
+
+Rule = namedtuple("Rule", "id award_id metric threshold")
+
+_RANK_QUERY = "SELECT id FROM users ORDER BY {column} DESC, id DESC LIMIT %(threshold)s"
+_COUNT_QUERY = "SELECT userId FROM scored_items WHERE {kinds} GROUP BY userId HAVING count(*) >= %(threshold)s"
+
+# metric -> (score fields it depends on, query for the ids of the users who qualify)
+METRICS = {
+    "code_score": (("code",), "SELECT id FROM users WHERE code_score >= %(threshold)s"),
+    "comment_score": (("comment",), "SELECT id FROM users WHERE comment_score >= %(threshold)s"),
+    "total_score": (("code", "comment"), "SELECT id FROM users WHERE total_score >= %(threshold)s"),
+    # scored PRs / comments (scored_items), not counting plain /api/analyze calls
+    "prs": (("code",), _COUNT_QUERY.format(kinds="item_kind = 'pr'")),
+    "comments": (("comment",), _COUNT_QUERY.format(kinds="item_kind <> 'pr'")),
+    "constructive_comments": (
+        ("comment",),
+        _COUNT_QUERY.format(kinds="item_kind <> 'pr' AND score >= %(constructive)s"),
+    ),
+    "code_rank": (("code",), _RANK_QUERY.format(column="code_score")),
+    "comment_rank": (("comment",), _RANK_QUERY.format(column="comment_score")),
+    "overall_rank": (("code", "comment"), _RANK_QUERY.format(column="total_score")),
+}
+RANK_METRICS = ("code_rank", "comment_rank", "overall_rank")
+
+
+def _grant(cur, rule: Rule, users=None) -> int:
+    """Give rule's award to everyone who qualifies (among users, if given). Returns how many got it."""
+    query = METRICS[rule.metric][1]
+    # Postgres pushes the id filter down into the metric query, so only these users' rows are read
+    where = "" if users is None or rule.metric in RANK_METRICS else "WHERE q.id = ANY(%(users)s)"
+    cur.execute(
+        f"""
+        INSERT INTO user_awards (userId, awardId)
+        SELECT q.id, %(award)s FROM ({query}) AS q (id) {where}
+        ON CONFLICT (userId, awardId) DO NOTHING;
+        """,
+        {"award": rule.award_id, "threshold": rule.threshold, "users": users, "constructive": CONSTRUCTIVE_SCORE},
+    )
+    return cur.rowcount
+
+
+# ---------------- rule index ----------------
+
+_index = {}          # score field -> [Rule]
+_index_loaded = 0.0
+_index_lock = threading.Lock()
+
+
+def _load_index(cur):
+    cur.execute("SELECT id, awardId, metric, threshold FROM achievement_rules;")
+    index = {}
+    for rule in map(Rule._make, cur.fetchall()):
+        if rule.metric not in METRICS:
+            continue  # defined by a newer server
+        for field in METRICS[rule.metric][0]:
+            index.setdefault(field, []).append(rule)
+    return index
+
+
+def rules_for(cur, fields):
+    """The rules that depend on any of the given score fields."""
+    global _index, _index_loaded
+    with _index_lock:
+        if time.monotonic() - _index_loaded > ACHIEVEMENT_RULES_TTL:
+            _index = _load_index(cur)
+            _index_loaded = time.monotonic()
+        index = _index
+    return {rule for field in fields for rule in index.get(field, [])}
+
+
+def invalidate_rules():
+    """Re-read achievement_rules on the next evaluation (this process; others within ACHIEVEMENT_RULES_TTL)."""
+    global _index_loaded
+    with _index_lock:
+        _index_loaded = 0.0
+
+
+# ---------------- evaluation ----------------
+
+_granted_total = 0
+
+
+def evaluate_rules(cur, changed) -> int:
+    """
+    Grant the awards earned by {field: [user ids]} whose field just changed,
+    on the caller's cursor and transaction. Returns how many were granted.
+    """
+    global _granted_total
+    granted = 0
+    for rule in sorted(rules_for(cur, [field for field, users in changed.items() if users])):
+        fields = METRICS[rule.metric][0]
+        users = sorted({user for field in fields for user in changed.get(field, ())})
+        if users:
+            granted += _grant(cur, rule, users)
+    _granted_total += granted
+    return granted
+
+
+def evaluate_rules_isolated(cur, changed) -> int:
+    """
+    evaluate_rules() in a savepoint: if any rule fails, the error is logged and
+    its grants are rolled back, and the caller's own writes still go through.
+    """
+    cur.execute("SAVEPOINT achievements;")
+    try:
+        granted = evaluate_rules(cur, changed)
+    except Exception:
+        traceback.print_exc()
+        cur.execute("ROLLBACK TO SAVEPOINT achievements;")
+        return 0
+    cur.execute("RELEASE SAVEPOINT achievements;")
+    return granted
+
+
+def backfill_rules(rule_ids=None, everything: bool = False) -> dict:
+    """
+    Evaluate rules against all users: the given ones, every rule (everything=True,
+    e.g. after editing users by hand), or by default those never backfilled. Returns {rule id: granted}.
+    """
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            if rule_ids is not None:
+                cur.execute("SELECT id, awardId, metric, threshold FROM achievement_rules WHERE id = ANY(%s);",
+                            (list(rule_ids),))
+            elif everything:
+                cur.execute("SELECT id, awardId, metric, threshold FROM achievement_rules;")
+            else:
+                cur.execute("SELECT id, awardId, metric, threshold FROM achievement_rules WHERE backfilled_at IS NULL;")
+            rules = [rule for rule in map(Rule._make, cur.fetchall()) if rule.metric in METRICS]
+        conn.commit()
+
+    granted = {}
+    for rule in rules:
+        # one transaction per rule, so a long backfill doesn't hold everything up
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                granted[rule.id] = _grant(cur, rule)
+                cur.execute("UPDATE achievement_rules SET backfilled_at = now() WHERE id = %s;", (rule.id,))
+            conn.commit()
+    return granted
+
+
+def start_backfill():
+    """Backfill rules that never were (e.g. added by a migration) on a background thread."""
+
+    def run():
+        try:
+            backfill_rules()
+        except Exception:
+            traceback.print_exc()
+
+    thread = threading.Thread(target=run, name="achievement-backfill", daemon=True)
+    thread.start()
+    return thread
+
+
+# ---------------- rule management ----------------
+
+def list_rules():
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT r.id, r.awardId, a.awardname, r.metric, r.threshold, r.backfilled_at,
+                       (SELECT count(*) FROM user_awards ua WHERE ua.awardId = r.awardId)
+                FROM achievement_rules r
+                JOIN awards a ON a.id = r.awardId
+                ORDER BY r.id;
+                """
+            )
+            rows = cur.fetchall()
+    return [
+        {"id": r[0], "awardId": r[1], "awardname": r[2], "metric": r[3], "threshold": r[4],
+         "backfilled_at": r[5].isoformat() if r[5] else None, "holders": r[6]}
+        for r in rows
+    ]
+
+
+def add_rule(award_id: int, metric: str, threshold: int):
+    """
+    Create or replace the rule for award_id and grant it to everyone who already
+    qualifies. Returns (rule id, users granted), or None if there's no such award.
+    Raises ValueError for an unknown metric or a bad threshold.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}; one of: {', '.join(METRICS)}")
+    if not isinstance(threshold, int) or isinstance(threshold, bool) or threshold < (1 if metric in RANK_METRICS else 0):
+        raise ValueError("threshold must be a non-negative integer (at least 1 for rank metrics)")
+    # every batch of score changes re-reads the top N of a rank rule
+    if metric in RANK_METRICS and threshold > MAX_PAGE_SIZE:
+        raise ValueError(f"threshold for a rank metric must be at most {MAX_PAGE_SIZE}")
+
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO achievement_rules (awardId, metric, threshold)
+                SELECT id, %s, %s FROM awards WHERE id = %s
+                ON CONFLICT (awardId) DO UPDATE
+                    SET metric = EXCLUDED.metric, threshold = EXCLUDED.threshold, backfilled_at = NULL
+                RETURNING id;
+                """,
+                (metric, threshold, award_id),
+            )
+            row = cur.fetchone()
+        conn.commit()
+    if row is None:
+        return None
+    invalidate_rules()
+    return row[0], backfill_rules([row[0]]).get(row[0], 0)
+
+
+def delete_rule(rule_id: int) -> bool:
+    """Stop granting a rule's award automatically; users who have it keep it."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM achievement_rules WHERE id = %s RETURNING id;", (rule_id,))
+            deleted = cur.fetchone()
+        conn.commit()
+    invalidate_rules()
+    return deleted is not None
+
+
+def achievement_stats():
+    with _index_lock:
+        rules = len({rule for rules in _index.values() for rule in rules})
+    return {"rules_loaded": rules, "granted_by_this_process": _granted_total}
@@ -0,0 +1,58 @@
+import os
+import time
+
+import requests
+
+from http_client import HttpClient
+
+AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://ai-service:8000/api")
+
+# keep-alive pool to the AI service; scoring runs hit it from several threads at once
+ai_http = HttpClient(
+    "ai-service",
+    AI_SERVICE_URL,
+    pool_size=int(os.getenv("AI_HTTP_POOL_SIZE", "16")),
+    timeout=float(os.getenv("AI_HTTP_TIMEOUT", "60")),
+)
+
+# items per /analyze/batch call while scoring, and how long one batch may take
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "100"))
+AI_BATCH_TIMEOUT = float(os.getenv("AI_BATCH_TIMEOUT", "300"))
+# retries of a batch the AI service turned away as overloaded (429/503), after its Retry-After
+AI_BATCH_RETRIES = int(os.getenv("AI_BATCH_RETRIES", "3"))
+
+OVERLOADED = (429, 503)
+
+
+def retry_after(resp, default: float = 5.0) -> float:
+    try:
+        return min(float(resp.headers.get("Retry-After", default)), 60.0)
+    except ValueError:
+        return default
+
+
+def analyze_batch(items: list) -> list:
+    """
+    Analyze items ({"type", "content", "file"}) with one call to the AI service's
+    batch endpoint. Always returns one result per item, in order; if the whole call
+    fails every item comes back as {"success": False, "error": ...}.
+    """
+    if not items:
+        return []
+    try:
+        for attempt in range(AI_BATCH_RETRIES + 1):
+            resp = ai_http.post("/analyze/batch", json={"items": items}, timeout=AI_BATCH_TIMEOUT)
+            if resp.status_code not in OVERLOADED or attempt == AI_BATCH_RETRIES:
+                break
+            wait = retry_after(resp)
+            print(f"AI service overloaded ({resp.status_code}), retrying batch in {wait:.0f}s")
+            time.sleep(wait)
+        resp.raise_for_status()
+        results = resp.json()["results"]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print("AI batch request failed:", e)
+        return [{"success": False, "error": str(e)} for _ in items]
+    if len(results) != len(items):
+        print("AI batch returned", len(results), "results for", len(items), "items")
+        return [{"success": False, "error": "result count mismatch"} for _ in items]
+    return results
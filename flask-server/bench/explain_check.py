@@ -0,0 +1,158 @@
+# Query-plan regression check for the hot lookups.
+#
+#   DATABASE_URL=... python bench/explain_check.py [--users N] [--keep]
+#
+# Builds the schema (init.sql + migrations/) in a scratch "explain_check"
+# schema, fills it with --users users (default 1M), a couple of awards each
+# and a hundred awards, vacuums and analyzes it, then runs EXPLAIN ANALYZE on
+# the achievement and leaderboard queries the server runs. Every scan of users
+# and user_awards has to be an index-only scan with no heap fetches; anything
+# else (a sequential scan, a missing covering column) fails the check and the
+# script exits 1. The scratch schema is dropped afterwards unless --keep.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from migrate import apply_migrations  # noqa: E402
+
+SCHEMA = "explain_check"
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "init.sql")
+AWARDS = 100
+# tables whose scans must be index-only; awards is a hundred rows and may be read any way
+INDEX_ONLY = ("users", "user_awards")
+
+# (name, query, parameters) -- the SQL as server.py / leaderboard.py run it
+QUERIES = [
+    (
+        "achievements_by_nickname",
+        """
+        SELECT a.id, a.awardname, a.description
+        FROM awards a
+        JOIN user_awards ua ON a.id = ua.awardId
+        JOIN users u ON u.id = ua.userId
+        WHERE u.githubId = %s;
+        """,
+        lambda users: (f"user{users // 2}",),
+    ),
+    (
+        "get_user_achievements",
+        """
+        SELECT a.id, a.awardname, a.description
+        FROM awards a
+                 JOIN user_awards ua ON a.id = ua.awardId
+        WHERE ua.userId = %s;
+        """,
+        lambda users: (users // 2,),
+    ),
+    (
+        "award_holders",
+        "SELECT userId FROM user_awards WHERE awardId = %s;",
+        lambda users: (AWARDS // 2,),
+    ),
+    (
+        "leaderboard_first_page",
+        "SELECT id, githubId, total_score FROM users ORDER BY total_score DESC, id DESC LIMIT 100;",
+        lambda users: (),
+    ),
+    (
+        "leaderboard_next_page",
+        """
+        SELECT id, githubId, code_score FROM users
+        WHERE (code_score, id) < (%s, %s)
+        ORDER BY code_score DESC, id DESC
+        LIMIT 100;
+        """,
+        lambda users: (500, users // 2),
+    ),
+]
+
+
+def scans(plan):
+    """Every node in the plan tree that reads a table."""
+    if "Relation Name" in plan:
+        yield plan
+    for child in plan.get("Plans", []):
+        yield from scans(child)
+
+
+def build(cur, users: int):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path = {SCHEMA};")
+    with open(SCHEMA_FILE) as f:
+        cur.execute(f.read())
+    cur.execute(
+        """
+        INSERT INTO users (githubId, comment_score, code_score)
+        SELECT 'user' || i, (i::bigint * 7919) %% 1000, (i::bigint * 104729) %% 1000
+        FROM generate_series(1, %s) i;
+
+        INSERT INTO awards (awardname, description)
+        SELECT 'award' || i, 'description of award ' || i FROM generate_series(1, %s) i;
+
+        INSERT INTO user_awards (userId, awardId)
+        SELECT u.id, 1 + (u.id * k) %% %s
+        FROM users u, generate_series(1, 2) k
+        ON CONFLICT DO NOTHING;
+        """,
+        (users, AWARDS, AWARDS),
+    )
+
+
+def check(cur, users: int) -> bool:
+    ok = True
+    for name, query, params in QUERIES:
+        cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params(users))
+        plan = cur.fetchone()[0][0]
+        problems = []
+        for node in scans(plan["Plan"]):
+            table = node["Relation Name"]
+            if table not in INDEX_ONLY:
+                continue
+            if node["Node Type"] != "Index Only Scan":
+                problems.append(f"{node['Node Type']} on {table}")
+            elif node.get("Heap Fetches", 0):
+                problems.append(f"{node['Heap Fetches']} heap fetches on {table} ({node['Index Name']})")
+        indexes = ", ".join(node.get("Index Name", node["Node Type"]) for node in scans(plan["Plan"]))
+        status = "ok  " if not problems else "FAIL"
+        print(f"{status} {name:26}{plan['Execution Time']:>9.3f} ms  {indexes}")
+        for problem in problems:
+            print(f"       {problem}")
+        ok = ok and not problems
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--keep", action="store_true", help=f"Leave the {SCHEMA} schema behind for poking at.")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            build(cur, args.users)
+            conn.commit()
+            applied = apply_migrations(conn)
+            # autovacuum hasn't been round yet: set the visibility map and statistics by hand
+            conn.autocommit = True
+            for table in ("users", "awards", "user_awards"):
+                cur.execute(f"VACUUM ANALYZE {table};")
+            print(f"{args.users} users, migrations {json.dumps(applied)}, built in "
+                  f"{time.perf_counter() - started:.1f}s\n")
+            ok = check(cur, args.users)
+            if not args.keep:
+                cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE;")
+    finally:
+        conn.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
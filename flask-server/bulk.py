@@ -0,0 +1,388 @@
+# Bulk import and export through COPY.
+#
+# Onboarding an organisation one addUser / give_user_achievement call per row
+# means a request and a pooled connection per member. import_rows() instead
+# streams a whole CSV or NDJSON file into a temporary table with a single
+# COPY ... FROM STDIN and upserts it from there in one transaction, so the
+# file is never held in Python memory and 5k rows cost a handful of
+# statements. Rows are matched on their natural keys (githubId, awardname), so
+# files exported from one database import into another:
+#   users       githubId, comment_score, code_score
+#   awards      awardname, description
+#   user_awards githubId, awardname
+# Existing rows get the values the file has; a missing column or empty cell
+# keeps what's there (0 / NULL for new rows). The last row wins when a key is
+# repeated, and user_awards rows naming an unknown user or award are skipped.
+#
+# export_rows() runs COPY (SELECT ...) TO STDOUT on a thread of its own and
+# hands the output over through a small bounded queue, so a response streams
+# as fast as the client reads it however big the leaderboard gets.
+
+import csv
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+
+from achievements import evaluate_rules_isolated
+from db import get_db
+from leaderboard import LEADERBOARD_COLUMNS
+
+FORMATS = ("csv", "ndjson")
+# bytes of COPY output collected before handing them to the response
+EXPORT_CHUNK = 64 * 1024
+# chunks buffered ahead of a slow client
+EXPORT_QUEUE = 16
+# seconds the export thread waits on a reader that takes nothing before dropping the COPY
+EXPORT_STALL_TIMEOUT = float(os.getenv("EXPORT_STALL_TIMEOUT", "60"))
+
+
+class BulkError(ValueError):
+    """A file that can't be imported; the message says why."""
+
+
+# table -> (columns in the file, key columns)
+IMPORTS = {
+    "users": (
+        [("githubId", "VARCHAR(50)"), ("comment_score", "INTEGER"), ("code_score", "INTEGER")],
+        ["githubId"],
+    ),
+    "awards": (
+        [("awardname", "VARCHAR(100)"), ("description", "TEXT")],
+        ["awardname"],
+    ),
+    "user_awards": (
+        [("githubId", "VARCHAR(50)"), ("awardname", "VARCHAR(100)")],
+        ["githubId", "awardname"],
+    ),
+}
+
+# upserts from the deduplicated temp table bulk_rows; each returns (inserted, updated), users'
+# also the ids whose code and comment scores it set
+_UPSERTS = {
+    "users": """
+        WITH updated AS (
+            UPDATE users u
+            SET comment_score = coalesce(t.comment_score, u.comment_score),
+                code_score = coalesce(t.code_score, u.code_score)
+            FROM bulk_rows t
+            WHERE u.githubId = t.githubid AND (t.comment_score IS NOT NULL OR t.code_score IS NOT NULL)
+            RETURNING u.id, t.code_score IS NOT NULL AS code, t.comment_score IS NOT NULL AS comment
+        ), inserted AS (
+            INSERT INTO users (githubId, comment_score, code_score)
+            SELECT githubid, coalesce(comment_score, 0), coalesce(code_score, 0) FROM bulk_rows
+            ON CONFLICT (githubId) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM updated),
+               -- whose code / comment score this import set, for the achievement rules
+               ARRAY(SELECT id FROM updated WHERE code UNION ALL SELECT id FROM inserted),
+               ARRAY(SELECT id FROM updated WHERE comment UNION ALL SELECT id FROM inserted);
+    """,
+    "awards": """
+        WITH updated AS (
+            UPDATE awards a
+            SET description = t.description
+            FROM bulk_rows t
+            WHERE a.awardname = t.awardname AND t.description IS NOT NULL
+            RETURNING a.id
+        ), inserted AS (
+            INSERT INTO awards (awardname, description)
+            SELECT awardname, description FROM bulk_rows
+            ON CONFLICT (awardname) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM updated);
+    """,
+    "user_awards": """
+        WITH inserted AS (
+            INSERT INTO user_awards (userId, awardId)
+            SELECT u.id, a.id
+            FROM bulk_rows t
+            JOIN users u ON u.githubId = t.githubid
+            JOIN awards a ON a.awardname = t.awardname
+            ON CONFLICT (userId, awardId) DO NOTHING
+            RETURNING 1
+        )
+        SELECT count(*), 0 FROM inserted;
+    """,
+}
+
+
+class _NDJSONAsCSV(io.RawIOBase):
+    """NDJSON objects read as the CSV that COPY expects, a line at a time."""
+
+    def __init__(self, lines, columns):
+        self._lines = iter(lines)
+        self._columns = columns
+        self._pending = b""
+        self._out = io.StringIO()
+        self._writer = csv.writer(self._out, lineterminator="\n")
+        self.line = 0
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def _next_row(self) -> bytes:
+        for raw in self._lines:
+            self.line += 1
+            if not raw.strip():
+                continue
+            try:
+                obj = json.loads(raw)
+            except ValueError:
+                obj = None
+            if not isinstance(obj, dict):
+                # psycopg2 reports exceptions from read() as a cancelled COPY; import_rows raises this instead
+                self.error = BulkError(f"line {self.line}: expected a JSON object")
+                raise self.error
+            lowered = {str(key).lower(): value for key, value in obj.items()}
+            # None -> empty unquoted field, which COPY reads as NULL
+            self._writer.writerow(["" if lowered.get(name.lower()) is None else lowered[name.lower()]
+                                   for name in self._columns])
+            row = self._out.getvalue().encode()
+            self._out.seek(0)
+            self._out.truncate()
+            return row
+        return b""
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = self._next_row()
+            if not self._pending:
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def _csv_columns(stream, table: str):
+    """Column names from the CSV header, checked against the table's."""
+    header = stream.readline()
+    if isinstance(header, bytes):
+        header = header.decode("utf-8-sig")
+    names = next(csv.reader([header]), [])
+    known = {name.lower(): name for name, _ in IMPORTS[table][0]}
+    columns = []
+    for name in names:
+        column = known.get(name.strip().lower())
+        if column is None:
+            raise BulkError(f"unknown column {name.strip()!r} for {table}")
+        columns.append(column)
+    missing = [key for key in IMPORTS[table][1] if key not in columns]
+    if missing:
+        raise BulkError(f"{table} needs the column(s): {', '.join(missing)}")
+    return columns
+
+
+def import_rows(table: str, stream, fmt: str = "csv") -> dict:
+    """
+    Upsert a CSV (with a header line) or NDJSON stream into users, awards or
+    user_awards. Returns {"table", "rows", "inserted", "updated", "skipped"}.
+    Raises BulkError for malformed files; nothing is written then.
+    """
+    if table not in IMPORTS:
+        raise BulkError(f"can't import into {table!r}; one of: {', '.join(IMPORTS)}")
+    if fmt not in FORMATS:
+        raise BulkError(f"unknown format {fmt!r}; one of: {', '.join(FORMATS)}")
+    all_columns, keys = IMPORTS[table]
+
+    if fmt == "csv":
+        columns = _csv_columns(stream, table)
+        source = stream
+    else:
+        columns = [name for name, _ in all_columns]
+        source = _NDJSONAsCSV(stream, columns)
+
+    key_list = ", ".join(keys)
+    with get_db() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "CREATE TEMP TABLE bulk_in (n BIGSERIAL, {}) ON COMMIT DROP;".format(
+                        ", ".join(f"{name} {kind}" for name, kind in all_columns)
+                    )
+                )
+                cur.copy_expert(
+                    f"COPY bulk_in ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')",
+                    source,
+                )
+                rows = cur.rowcount
+                # one row per key, the file's last; rows without a key don't count
+                cur.execute(
+                    f"""
+                    CREATE TEMP TABLE bulk_rows ON COMMIT DROP AS
+                    SELECT DISTINCT ON ({key_list}) * FROM bulk_in
+                    WHERE {" AND ".join(f"{key} <> ''" for key in keys)}
+                    ORDER BY {key_list}, n DESC;
+                    """
+                )
+                cur.execute(_UPSERTS[table])
+                inserted, updated, *changed = cur.fetchone()
+                if changed:
+                    # scores written directly skip score_events, so check the rules here
+                    evaluate_rules_isolated(cur, dict(zip(("code", "comment"), changed)))
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            if getattr(source, "error", None) is not None:
+                raise source.error
+            if isinstance(e, (psycopg2.DataError, psycopg2.IntegrityError)):
+                raise BulkError(str(e).strip().splitlines()[0])
+            raise
+
+    return {
+        "table": table,
+        "rows": rows,
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": rows - inserted - updated,
+    }
+
+
+# ---------------- export ----------------
+
+_EXPORT_QUERIES = {
+    "users": 'SELECT githubId AS "githubId", comment_score, code_score FROM users ORDER BY id',
+    "awards": "SELECT awardname, description FROM awards ORDER BY id",
+    "user_awards": """
+        SELECT u.githubId AS "githubId", a.awardname
+        FROM user_awards ua
+        JOIN users u ON u.id = ua.userId
+        JOIN awards a ON a.id = ua.awardId
+        ORDER BY ua.userId, ua.awardId
+    """,
+}
+EXPORTS = tuple(_EXPORT_QUERIES) + ("leaderboard",)
+
+
+def _leaderboard_query(leaderboard_type: str) -> str:
+    # the same (score DESC, id DESC) index walk as a leaderboard page, ranked as it goes
+    column = LEADERBOARD_COLUMNS[leaderboard_type]
+    return f"""
+        SELECT row_number() OVER (ORDER BY {column} DESC, id DESC) AS rank,
+               githubId AS "githubId", code_score, comment_score, total_score
+        FROM users
+        ORDER BY {column} DESC, id DESC
+    """
+
+
+class _Pipe:
+    """What COPY TO writes into on the export thread; chunks() yields the output on the reader's side."""
+
+    _DONE = object()
+
+    def __init__(self, transform=None):
+        self._queue = queue.Queue(EXPORT_QUEUE)
+        self._buffer = []
+        self._size = 0
+        self._transform = transform
+        self.closed = False
+        self.error = None
+
+    def _put(self, item):
+        # give up once the reader is gone or stops reading, rather than holding the
+        # connection and the COPY open forever
+        deadline = time.monotonic() + EXPORT_STALL_TIMEOUT
+        while not self.closed and time.monotonic() < deadline:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        self.closed = True
+        raise BrokenPipeError("export reader went away")
+
+    def write(self, data):
+        # COPY writes one row per call
+        if self._transform is not None:
+            data = self._transform(data)
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= EXPORT_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            chunk = b"".join(self._buffer)
+            self._buffer, self._size = [], 0
+            self._put(chunk)
+
+    def finish(self, error=None):
+        self.error = error
+        try:
+            if error is None:
+                self.flush()
+            self._put(self._DONE)
+        except BrokenPipeError:
+            pass
+
+    def chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is self._DONE:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+def _unescape_text(row: bytes) -> bytes:
+    # COPY's text format doubles backslashes; a row_to_json line has no other escapes
+    # (JSON already escapes newlines, tabs and control characters)
+    return row.replace(b"\\\\", b"\\")
+
+
+def export_rows(name: str, fmt: str = "csv", leaderboard_type: str = "overall"):
+    """
+    users, awards, user_awards (in the import format) or the leaderboard, as an
+    iterator of CSV (with a header line) or NDJSON bytes.
+    """
+    if fmt not in FORMATS:
+        raise BulkError(f"unknown format {fmt!r}; one of: {', '.join(FORMATS)}")
+    if name == "leaderboard":
+        if leaderboard_type not in LEADERBOARD_COLUMNS:
+            raise BulkError(f"unknown leaderboard type {leaderboard_type!r}")
+        query = _leaderboard_query(leaderboard_type)
+    elif name in _EXPORT_QUERIES:
+        query = _EXPORT_QUERIES[name]
+    else:
+        raise BulkError(f"can't export {name!r}; one of: {', '.join(EXPORTS)}")
+
+    if fmt == "csv":
+        copy = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')"
+        pipe = _Pipe()
+    else:
+        copy = f"COPY (SELECT row_to_json(r) FROM ({query}) r) TO STDOUT WITH (ENCODING 'UTF8')"
+        pipe = _Pipe(_unescape_text)
+
+    return _stream(name, copy, pipe)
+
+
+def _stream(name: str, copy: str, pipe: _Pipe):
+    # a generator, so the COPY only starts once the response is actually read, and
+    # close() (the WSGI server's, when the client goes away) stops it
+    def run():
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cur:
+                    cur.copy_expert(copy, pipe)
+                conn.rollback()
+        except BrokenPipeError:
+            return
+        except Exception as e:
+            pipe.finish(e)
+            return
+        pipe.finish()
+
+    threading.Thread(target=run, name=f"export-{name}", daemon=True).start()
+    try:
+        yield from pipe.chunks()
+    finally:
+        pipe.closed = True
@@ -0,0 +1,218 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# connections idle longer than this get a "SELECT 1" before being handed out
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))
+# idle connections above DB_POOL_MIN are closed after this many seconds
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Raised when no connection frees up within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe, blocking pool of psycopg2 connections.
+
+    Checkout blocks (up to ``timeout`` seconds) when ``maxconn`` connections
+    are already in use. Connections that sat idle for a while are pinged
+    before being reused so a restarted Postgres doesn't surface as a 500.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=10.0, check_idle=30.0, max_idle=300.0,
+                 dsn=None, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.max_idle = max_idle
+        self._dsn = dsn
+        self._connect_kwargs = connect_kwargs
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = deque()  # (conn, returned_at), most recently used on the right
+        self._in_use = 0
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        if self._dsn:
+            conn = psycopg2.connect(self._dsn, **self._connect_kwargs)
+        else:
+            conn = psycopg2.connect(**self._connect_kwargs)
+        with self._lock:
+            self._created += 1
+        return conn
+
+    def dedicated(self):
+        """A new connection with the pool's settings that doesn't take a slot and is never pooled.
+
+        For sessions that last longer than a request (e.g. holding an advisory
+        lock); the caller closes it.
+        """
+        if self._dsn:
+            return psycopg2.connect(self._dsn, **self._connect_kwargs)
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def warm(self):
+        """Open connections until ``minconn`` are idle in the pool."""
+        while True:
+            with self._lock:
+                if len(self._idle) + self._in_use >= self.minconn:
+                    return
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def getconn(self):
+        start = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self._waiting -= 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            if not acquired:
+                self._timeouts += 1
+        if not acquired:
+            raise PoolTimeout("no database connection available after %.1fs" % waited)
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn = self._connect()
+                    break
+                conn, returned_at = entry
+                if self._healthy(conn, returned_at):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return conn
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed:
+                status = conn.get_transaction_status()
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    conn.close()
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    # handler forgot to commit (or bailed out early) -> don't leak the txn
+                    conn.rollback()
+        except psycopg2.Error:
+            pass
+
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            self._in_use -= 1
+            if not conn.closed:
+                self._idle.append((conn, now))
+            else:
+                stale.append(conn)
+            while len(self._idle) > self.minconn and now - self._idle[0][1] > self.max_idle:
+                stale.append(self._idle.popleft()[0])
+        self._slots.release()
+
+        for c in stale:
+            self._discard(c)
+
+    def closeall(self):
+        with self._lock:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+        for c in idle:
+            self._discard(c)
+
+    def stats(self):
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "saturation": round(self._in_use / self.maxconn, 3),
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "connections_created": self._created,
+                "connections_discarded": self._discarded,
+                "wait_avg_ms": round(self._wait_total / checkouts * 1000, 3) if checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+
+if DATABASE_URL:
+    db_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                             check_idle=DB_POOL_CHECK_IDLE, max_idle=DB_POOL_MAX_IDLE,
+                             dsn=DATABASE_URL)
+else:
+    db_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                             check_idle=DB_POOL_CHECK_IDLE, max_idle=DB_POOL_MAX_IDLE,
+                             host="postgres", database="mydb", user="user", password="password")
+
+
+@contextmanager
+def get_db():
+    """Borrow a pooled connection: ``with get_db() as conn: ...``
+
+    Commit explicitly; anything left uncommitted is rolled back on return.
+    """
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    finally:
+        db_pool.putconn(conn)
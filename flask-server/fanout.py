@@ -0,0 +1,47 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# value is whatever the call returned, error is set (and value None) if it raised
+Outcome = namedtuple("Outcome", ["value", "error"])
+
+
+class FanOut:
+    """Runs blocking calls on a shared thread pool with a per-host concurrency cap.
+
+    ``map`` waits for every call and returns outcomes in submission order, so
+    the total latency is roughly that of the slowest call instead of the sum.
+    A failing call never takes the others down with it; it just comes back as
+    an Outcome with ``error`` set.
+    """
+
+    def __init__(self, max_workers: int, per_host: int):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fanout")
+        self._lock = threading.Lock()
+        self._host_slots = {}
+
+    def _slots(self, host):
+        with self._lock:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slots
+
+    def _run(self, host, fn, args, kwargs):
+        with self._slots(host):
+            try:
+                return Outcome(fn(*args, **kwargs), None)
+            except Exception as e:
+                print(f"Fan-out call to {host} failed:", repr(e))
+                return Outcome(None, str(e))
+
+    def submit(self, host, fn, *args, **kwargs):
+        return self._executor.submit(self._run, host, fn, args, kwargs)
+
+    def map(self, calls):
+        """calls: iterable of (host, fn, args) tuples. Returns [Outcome, ...] in the same order."""
+        futures = [self.submit(host, fn, *args) for host, fn, args in calls]
+        return [f.result() for f in futures]
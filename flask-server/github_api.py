@@ -0,0 +1,243 @@
+import itertools
+import os
+from urllib.parse import urlparse
+
+from fanout import FanOut
+from github_cache import cache_key, make_cache, token_scope
+from github_ratelimit import BULK, INTERACTIVE, GitHubScheduler, RateLimited, SchedulerBusy, resource_for
+from http_client import HttpClient
+
+GITHUB_API = "https://api.github.com"
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+GITHUB_HOST = urlparse(GITHUB_API).netloc
+
+# one keep-alive pool to api.github.com shared by every request thread and the fan-out
+github_http = HttpClient(
+    "github",
+    GITHUB_API,
+    pool_size=int(os.getenv("GITHUB_HTTP_POOL_SIZE", "16")),
+    timeout=float(os.getenv("GITHUB_HTTP_TIMEOUT", "30")),
+    headers={"Accept": "application/vnd.github+json"},
+)
+
+# ETag cache; GITHUB_CACHE_BACKEND=memory|sqlite|postgres|none
+github_cache = make_cache()
+
+# shared pool for the per-PR comment fetches; per-host cap keeps us polite to GitHub
+github_fanout = FanOut(
+    max_workers=int(os.getenv("GITHUB_FANOUT_WORKERS", "16")),
+    per_host=int(os.getenv("GITHUB_FANOUT_PER_HOST", "8")),
+)
+# bulk scoring gets its own threads, so bulk fetches parked on a rate-limit
+# reset never starve page loads of fan-out workers
+github_bulk_fanout = FanOut(
+    max_workers=int(os.getenv("GITHUB_BULK_FANOUT_WORKERS", "8")),
+    per_host=int(os.getenv("GITHUB_FANOUT_PER_HOST", "8")),
+)
+
+# rate-limit budgets per token; BULK callers leave GITHUB_BULK_RESERVE of each budget
+# to INTERACTIVE ones and wait for the reset, interactive ones fail fast instead
+github_scheduler = GitHubScheduler(
+    max_inflight=int(os.getenv("GITHUB_MAX_INFLIGHT", "16")),
+    bulk_reserve=float(os.getenv("GITHUB_BULK_RESERVE", "0.2")),
+    interactive_max_wait=float(os.getenv("GITHUB_INTERACTIVE_MAX_WAIT", "5")),
+    bulk_max_wait=float(os.getenv("GITHUB_BULK_MAX_WAIT", "900")),
+)
+# retries after a rate-limited response (only if the backoff fits the caller's max wait)
+GITHUB_RATE_LIMIT_RETRIES = int(os.getenv("GITHUB_RATE_LIMIT_RETRIES", "3"))
+
+# pagination: GitHub's max page size, a safety cap on pages per listing, and
+# how many PRs have their comment threads in flight at once while streaming
+GITHUB_PER_PAGE = int(os.getenv("GITHUB_PER_PAGE", "100"))
+GITHUB_MAX_PAGES = int(os.getenv("GITHUB_MAX_PAGES", "50"))
+GITHUB_PR_WINDOW = int(os.getenv("GITHUB_PR_WINDOW", "8"))
+
+
+class GitHubError(Exception):
+    """A page of a paginated listing failed; ``err`` is the same dict github_get returns."""
+
+    def __init__(self, err):
+        super().__init__(str(err))
+        self.err = err
+
+
+def github_get(endpoint: str, token: str | None = None, priority: int = INTERACTIVE):
+    data, _, err = _github_request(endpoint, token, priority)
+    return data, err
+
+
+def _github_request(endpoint: str, token: str | None = None, priority: int = INTERACTIVE):
+    """GET one page. Returns (data, next_endpoint, err); next_endpoint comes from Link: rel=next."""
+    # Default to app-level PAT
+    if token is None:
+        token = GITHUB_TOKEN
+
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    # Conditional request: a 304 costs no rate limit and we reuse the cached body
+    key = cached = None
+    if github_cache is not None:
+        key = cache_key(endpoint, token)
+        cached = github_cache.lookup(key)
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+    scope = token_scope(token)
+    resource = resource_for(endpoint)
+    for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+        try:
+            github_scheduler.acquire(scope, resource, priority)
+        except RateLimited as e:
+            print("GitHub rate limit:", e)
+            return None, None, {"error": "rate_limited", "resource": e.resource,
+                                "retry_after": round(e.retry_after)}
+        except SchedulerBusy as e:
+            # not a rate limit: the server already had GITHUB_MAX_INFLIGHT requests out
+            print("GitHub scheduler busy:", e)
+            return None, None, {"error": "busy", "detail": str(e)}
+
+        try:
+            r = github_http.get(endpoint, headers=headers)
+        except Exception as e:
+            github_scheduler.release(scope, resource)
+            # Network or request error → 500 from our API
+            print("GitHub request failed:", e)
+            return None, None, {"error": "request_failed", "detail": str(e)}
+
+        text = r.text if r.status_code in (403, 429) else ""
+        backoff = github_scheduler.release(scope, resource, r.status_code, r.headers, text)
+        if not backoff or attempt == GITHUB_RATE_LIMIT_RETRIES:
+            break
+        # acquire() on the next attempt sleeps out the backoff (or gives up if it's too long)
+        print(f"GitHub rate limited on {endpoint}, backing off {backoff:.0f}s")
+
+    if github_cache is not None:
+        github_cache.record(cached, r.status_code)
+        if r.status_code == 304 and cached:
+            github_cache.store(key, cached)
+            return cached["body"], cached.get("next"), None
+
+    try:
+        data = r.json()
+    except ValueError:
+        # Not JSON (e.g. HTML error page)
+        print("GitHub returned non-JSON:", r.status_code, r.text[:200])
+        return None, None, {
+            "error": "invalid_json",
+            "status": r.status_code,
+            "text": r.text,
+        }
+
+    if r.status_code != 200:
+        print("GitHub API error:", r.status_code, data)
+        return None, None, {"status": r.status_code, "body": data}
+
+    next_endpoint = r.links.get("next", {}).get("url")
+    if next_endpoint and next_endpoint.startswith(GITHUB_API):
+        next_endpoint = next_endpoint[len(GITHUB_API):]
+
+    if github_cache is not None and (r.headers.get("ETag") or r.headers.get("Last-Modified")):
+        github_cache.store(key, {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "next": next_endpoint,
+            "body": data,
+        })
+
+    return data, next_endpoint, None
+
+
+def github_paginate(endpoint: str, token: str | None = None, per_page: int = GITHUB_PER_PAGE,
+                    max_pages: int = GITHUB_MAX_PAGES, priority: int = INTERACTIVE):
+    """
+    Yield the items of every page of a GitHub listing, following Link: rel=next.
+
+    Only one page is held in memory at a time. Works for plain list endpoints
+    and for /search/* (whose pages wrap the list in "items"). Raises
+    GitHubError if a page can't be fetched.
+    """
+    sep = "&" if "?" in endpoint else "?"
+    next_endpoint = f"{endpoint}{sep}per_page={per_page}"
+    pages = 0
+    while next_endpoint and pages < max_pages:
+        data, next_endpoint, err = _github_request(next_endpoint, token, priority)
+        if err:
+            raise GitHubError(err)
+        pages += 1
+        if isinstance(data, dict):
+            yield from data.get("items", [])
+        else:
+            yield from data
+    if next_endpoint:
+        print(f"Stopped paginating {endpoint} after {max_pages} pages")
+
+
+def _user_comments(endpoint: str, username: str, priority: int):
+    return [c for c in github_paginate(endpoint, priority=priority)
+            if (c.get("user") or {}).get("login") == username]
+
+
+def iter_pr_comments(prs, username: str, failures: list, window: int = GITHUB_PR_WINDOW,
+                     priority: int = INTERACTIVE):
+    """
+    Stream username's conversation + review comments PR by PR.
+
+    prs can be any iterable of search items (e.g. a github_paginate generator);
+    PRs are pulled ``window`` at a time and their comment threads fetched
+    concurrently, so memory stays bounded by the window no matter how many PRs
+    or comments there are. Yields {"pr", "owner", "repo", "pr_number", "comments"}
+    in PR order; calls that fail are appended to ``failures`` instead.
+    """
+    prs = iter(prs)
+    while True:
+        batch = list(itertools.islice(prs, window))
+        if not batch:
+            return
+
+        calls = []
+        for pr in batch:
+            owner, repo = pr["repository_url"].split("/")[-2:]
+            pr_number = pr["number"]
+            # Conversation comments
+            calls.append((GITHUB_HOST, _user_comments, (f"/repos/{owner}/{repo}/issues/{pr_number}/comments", username, priority)))
+            # Review comments (inline)
+            calls.append((GITHUB_HOST, _user_comments, (f"/repos/{owner}/{repo}/pulls/{pr_number}/comments", username, priority)))
+
+        fanout = github_bulk_fanout if priority == BULK else github_fanout
+        outcomes = fanout.map(calls)
+
+        for i, pr in enumerate(batch):
+            owner, repo = pr["repository_url"].split("/")[-2:]
+            pr_number = pr["number"]
+            comments = []
+            for (_, _, (endpoint, _, _)), outcome in zip(calls[2 * i:2 * i + 2], outcomes[2 * i:2 * i + 2]):
+                if outcome.error:
+                    failures.append({"repo": f"{owner}/{repo}", "pr_number": pr_number,
+                                     "endpoint": endpoint, "error": outcome.error})
+                else:
+                    comments.extend(outcome.value)
+
+            yield {
+                "pr": pr,
+                "owner": owner,
+                "repo": repo,
+                "pr_number": pr_number,
+                "comments": comments,
+            }
+
+
+def pr_files_diff(files) -> str:
+    """A `git diff`-style text from a PR's /files list, for the AI service's chunked analysis."""
+    parts = []
+    for f in files:
+        name = f.get("filename", "unknown")
+        old = f.get("previous_filename", name)
+        # binary and very large files come without a patch
+        patch = f.get("patch") or f"Binary or large file, {f.get('changes', 0)} lines changed"
+        parts.append(f"diff --git a/{old} b/{name}\n--- a/{old}\n+++ b/{name}\n{patch}")
+    return "\n".join(parts)
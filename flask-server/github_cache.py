@@ -0,0 +1,283 @@
+# Conditional-request cache for GitHub API responses.
+#
+# github_get stores every 200 response together with its ETag / Last-Modified.
+# The next call for the same endpoint (and token) sends If-None-Match /
+# If-Modified-Since; GitHub answers 304 without a body and without charging the
+# rate limit, and we serve the stored body. Entries expire after a TTL and the
+# least recently used ones are evicted once the cache is full.
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_db
+
+
+def token_scope(token: str | None) -> str:
+    """Short, non-reversible id for a token (tokens themselves never get stored)."""
+    return hashlib.sha256(token.encode()).hexdigest()[:16] if token else "anon"
+
+
+def cache_key(endpoint: str, token: str | None) -> str:
+    """Responses depend on who asks (private repos), so the token scope is part of the key."""
+    return f"{token_scope(token)}:{endpoint}"
+
+
+class MemoryCacheBackend:
+    """Per-process LRU dict. Fast, but every worker process has its own copy."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, entry)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            stored_at, entry = item
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.time(), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SqliteCacheBackend:
+    """On-disk cache that survives restarts; shared by processes on the same host."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS github_cache (
+                key TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS github_cache_lru ON github_cache (accessed_at);")
+        self._conn.commit()
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT entry, stored_at FROM github_cache WHERE key = ?;", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM github_cache WHERE key = ?;", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE github_cache SET accessed_at = ? WHERE key = ?;", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key, entry):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO github_cache (key, entry, stored_at, accessed_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET entry = excluded.entry,
+                    stored_at = excluded.stored_at, accessed_at = excluded.accessed_at;
+                """,
+                (key, json.dumps(entry), now, now),
+            )
+            overflow = self._conn.execute("SELECT COUNT(*) FROM github_cache;").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM github_cache WHERE key IN "
+                    "(SELECT key FROM github_cache ORDER BY accessed_at ASC LIMIT ?);",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            self._conn.commit()
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM github_cache;").fetchone()[0]
+
+
+class PostgresCacheBackend:
+    """Cache in the app database (github_cache table), shared by every server instance."""
+
+    name = "postgres"
+
+    # trimming walks the LRU index, so only do it every N writes
+    EVICT_EVERY = 100
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE github_cache SET accessed_at = now()
+                    WHERE key = %s AND stored_at > now() - make_interval(secs => %s)
+                    RETURNING entry;
+                    """,
+                    (key, self.ttl),
+                )
+                row = cur.fetchone()
+            conn.commit()
+        return row[0] if row else None
+
+    def set(self, key, entry):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO github_cache (key, entry, stored_at, accessed_at)
+                    VALUES (%s, %s, now(), now())
+                    ON CONFLICT (key) DO UPDATE SET entry = EXCLUDED.entry,
+                        stored_at = EXCLUDED.stored_at, accessed_at = EXCLUDED.accessed_at;
+                    """,
+                    (key, json.dumps(entry)),
+                )
+                with self._lock:
+                    self._writes += 1
+                    trim = self._writes % self.EVICT_EVERY == 0
+                if trim:
+                    cur.execute(
+                        "DELETE FROM github_cache WHERE stored_at <= now() - make_interval(secs => %s);",
+                        (self.ttl,),
+                    )
+                    expired = cur.rowcount
+                    cur.execute(
+                        """
+                        DELETE FROM github_cache WHERE key IN (
+                            SELECT key FROM github_cache ORDER BY accessed_at DESC OFFSET %s
+                        );
+                        """,
+                        (self.max_entries,),
+                    )
+                    with self._lock:
+                        self.evictions += expired + cur.rowcount
+            conn.commit()
+
+    def size(self):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM github_cache;")
+                return cur.fetchone()[0]
+
+
+class GitHubCache:
+    """Backend plus hit/miss bookkeeping. A broken backend never breaks github_get."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0          # served from cache after a 304
+        self.misses = 0        # nothing cached (or expired) -> full download
+        self.refreshes = 0     # cached, but GitHub sent a new 200
+        self.upstream_errors = 0  # GitHub answered with anything else (403/429, 5xx, ...)
+        self.errors = 0        # the backend failed
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def lookup(self, key):
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print("GitHub cache read failed:", repr(e))
+            self._count("errors")
+            return None
+        return entry
+
+    def store(self, key, entry):
+        try:
+            self.backend.set(key, entry)
+        except Exception as e:
+            print("GitHub cache write failed:", repr(e))
+            self._count("errors")
+
+    def record(self, cached, status_code):
+        # an error response says nothing about the cache, so it stays out of the hit rate
+        if status_code not in (200, 304):
+            self._count("upstream_errors")
+        elif cached is None:
+            self._count("misses")
+        elif status_code == 304:
+            self._count("hits")
+        else:
+            self._count("refreshes")
+
+    def stats(self):
+        try:
+            size = self.backend.size()
+        except Exception:
+            size = None
+        with self._lock:
+            lookups = self.hits + self.misses + self.refreshes
+            return {
+                "backend": self.backend.name,
+                "entries": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "upstream_errors": self.upstream_errors,
+                "errors": self.errors,
+                "evictions": self.backend.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+def make_cache():
+    """Build the cache from GITHUB_CACHE_* env vars; None when caching is off."""
+    kind = os.getenv("GITHUB_CACHE_BACKEND", "memory").lower()
+    max_entries = int(os.getenv("GITHUB_CACHE_MAX_ENTRIES", "5000"))
+    ttl = float(os.getenv("GITHUB_CACHE_TTL", "86400"))
+
+    if kind in ("none", "off", ""):
+        return None
+    if kind == "memory":
+        return GitHubCache(MemoryCacheBackend(max_entries, ttl))
+    if kind == "sqlite":
+        path = os.getenv("GITHUB_CACHE_PATH", os.path.join(tempfile.gettempdir(), "github_cache.sqlite3"))
+        return GitHubCache(SqliteCacheBackend(path, max_entries, ttl))
+    if kind == "postgres":
+        return GitHubCache(PostgresCacheBackend(max_entries, ttl))
+    raise ValueError(f"Unknown GITHUB_CACHE_BACKEND: {kind}")
@@ -0,0 +1,279 @@
+# Rate-limit-aware admission for GitHub calls.
+#
+# Every github_get goes through github_scheduler.acquire() before hitting the
+# network and release() afterwards. The scheduler
+#   * tracks X-RateLimit-Remaining / -Reset per token and resource class
+#     (core = 5000/h, search = 30/min, ...) and debits its local estimate as
+#     requests are admitted, so concurrent threads don't overshoot the budget;
+#   * keeps a slice of every budget in reserve for INTERACTIVE requests
+#     (page loads) -- BULK work (score refreshes) waits for the reset instead;
+#   * queues waiters by priority, so an interactive request admitted while a
+#     rescoring run is in progress goes ahead of every queued bulk request.
+#     Waiters queue FIFO per (priority, token, resource); a heap of those
+#     queues keyed on (priority, seq of their head) decides who goes next, so
+#     admitting one costs O(log queues) and only the admitted thread is woken;
+#   * backs off (with jitter) after primary and secondary rate-limit responses.
+
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from collections import deque
+
+INTERACTIVE = 0
+BULK = 1
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# secondary limits without Retry-After: GitHub asks for at least a minute
+SECONDARY_BACKOFF = 60.0
+SECONDARY_BACKOFF_MAX = 900.0
+
+
+class RateLimited(Exception):
+    """The budget won't free up within the caller's max wait."""
+
+    def __init__(self, resource: str, retry_after: float):
+        super().__init__(f"GitHub {resource} rate limit exhausted, retry in {retry_after:.0f}s")
+        self.resource = resource
+        self.retry_after = retry_after
+
+
+class SchedulerBusy(Exception):
+    """The budget was there, but no in-flight slot freed up within the caller's max wait."""
+
+    def __init__(self, waited: float):
+        super().__init__(f"All GitHub request slots stayed busy for {waited:.1f}s")
+        self.waited = waited
+
+
+def resource_for(endpoint: str) -> str:
+    if endpoint.startswith("/search/code"):
+        return "code_search"
+    if endpoint.startswith("/search/"):
+        return "search"
+    return "core"
+
+
+class _Waiter:
+    __slots__ = ("seq", "granted", "cond")
+
+    def __init__(self, seq, lock):
+        self.seq = seq
+        self.granted = False
+        self.cond = threading.Condition(lock)
+
+
+class _Bucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0.0            # epoch seconds
+        self.blocked_until = 0.0    # after a 403/429, nobody goes before this
+        self.secondary_hits = 0
+
+
+class GitHubScheduler:
+    def __init__(self, max_inflight: int, bulk_reserve: float, interactive_max_wait: float,
+                 bulk_max_wait: float):
+        self.max_inflight = max_inflight
+        self.bulk_reserve = bulk_reserve
+        self.max_wait = {INTERACTIVE: interactive_max_wait, BULK: bulk_max_wait}
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._inflight = 0
+        self._queues = {}   # (priority, scope, resource) -> deque of _Waiter, oldest first
+        self._heads = []    # heap of (priority, seq of the queue's head, scope, resource); may hold stale seqs
+        self._seq = itertools.count()
+
+        self._admitted = {INTERACTIVE: 0, BULK: 0}
+        self._delayed = {INTERACTIVE: 0, BULK: 0}
+        self._rejected = {INTERACTIVE: 0, BULK: 0}
+        self._busy = {INTERACTIVE: 0, BULK: 0}
+        self._rate_limited_responses = 0
+
+    def _bucket(self, scope, resource):
+        bucket = self._buckets.get((scope, resource))
+        if bucket is None:
+            bucket = self._buckets[(scope, resource)] = _Bucket()
+        return bucket
+
+    def _budget_wait(self, scope, resource, priority, now):
+        """Seconds until this request may spend from the budget (0 = now)."""
+        bucket = self._bucket(scope, resource)
+        if bucket.blocked_until > now:
+            return bucket.blocked_until - now
+        if bucket.remaining is None:
+            return 0.0
+        if now >= bucket.reset:
+            # window rolled over; trust the next response's headers
+            bucket.remaining = None
+            return 0.0
+        reserve = 0
+        if priority == BULK and bucket.limit:
+            reserve = math.ceil(bucket.limit * self.bulk_reserve)
+        if bucket.remaining > reserve:
+            return 0.0
+        return max(bucket.reset - now, 0.1)
+
+    def _dispatch(self):
+        """Admit waiters, best-placed first, while slots are free. Called with the lock held."""
+        now = time.time()
+        blocked = []
+        while self._heads and self._inflight < self.max_inflight:
+            priority, seq, scope, resource = heapq.heappop(self._heads)
+            key = (priority, scope, resource)
+            queue = self._queues.get(key)
+            if not queue:
+                self._queues.pop(key, None)
+                continue
+            if queue[0].seq != seq:
+                # its head left (gave up); requeue under the current head
+                heapq.heappush(self._heads, (priority, queue[0].seq, scope, resource))
+                continue
+            if self._budget_wait(scope, resource, priority, now) > 0:
+                # a blocked higher-priority queue doesn't hold up other buckets
+                blocked.append((priority, seq, scope, resource))
+                continue
+            waiter = queue.popleft()
+            waiter.granted = True
+            self._inflight += 1
+            bucket = self._bucket(scope, resource)
+            if bucket.remaining is not None:
+                bucket.remaining -= 1
+            self._admitted[priority] += 1
+            waiter.cond.notify()
+            if queue:
+                heapq.heappush(self._heads, (priority, queue[0].seq, scope, resource))
+            else:
+                del self._queues[key]
+        for head in blocked:
+            heapq.heappush(self._heads, head)
+
+    def _leave(self, key, waiter):
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        was_head = queue[0] is waiter
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[key]
+        elif was_head:
+            heapq.heappush(self._heads, (key[0], queue[0].seq, key[1], key[2]))
+
+    def acquire(self, scope: str, resource: str, priority: int = INTERACTIVE):
+        """
+        Block until the request may go out. Raises RateLimited if the budget
+        won't allow it in time, SchedulerBusy if no in-flight slot freed up in time.
+        """
+        start = time.monotonic()
+        deadline = start + self.max_wait[priority]
+        key = (priority, scope, resource)
+        with self._lock:
+            waiter = _Waiter(next(self._seq), self._lock)
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append(waiter)
+            if len(queue) == 1:
+                heapq.heappush(self._heads, (priority, waiter.seq, scope, resource))
+            try:
+                self._dispatch()
+                delayed = False
+                while not waiter.granted:
+                    delayed = True
+                    budget_wait = self._budget_wait(scope, resource, priority, time.time())
+                    remaining_wait = deadline - time.monotonic()
+                    if budget_wait > 0 and budget_wait > remaining_wait:
+                        self._rejected[priority] += 1
+                        raise RateLimited(resource, budget_wait)
+                    if remaining_wait <= 0:
+                        self._busy[priority] += 1
+                        raise SchedulerBusy(time.monotonic() - start)
+                    # woken when admitted; the timeout re-checks budgets that free up with time
+                    waiter.cond.wait(min(max(budget_wait, 0.05), remaining_wait, 1.0))
+                    if not waiter.granted:
+                        self._dispatch()
+                if delayed:
+                    self._delayed[priority] += 1
+            except BaseException:
+                if waiter.granted:
+                    # admitted just as we bailed out: hand the slot on
+                    self._inflight -= 1
+                else:
+                    self._leave(key, waiter)
+                self._dispatch()
+                raise
+
+    def release(self, scope: str, resource: str, status: int | None = None, headers=None,
+                text: str = "") -> float:
+        """Record the response. Returns how long to back off if it was rate limited, else 0."""
+        backoff = 0.0
+        now = time.time()
+        with self._lock:
+            self._inflight -= 1
+            if headers is not None:
+                resource = headers.get("X-RateLimit-Resource", resource)
+                bucket = self._bucket(scope, resource)
+                try:
+                    if "X-RateLimit-Limit" in headers:
+                        bucket.limit = int(headers["X-RateLimit-Limit"])
+                    if "X-RateLimit-Remaining" in headers:
+                        bucket.remaining = int(headers["X-RateLimit-Remaining"])
+                    if "X-RateLimit-Reset" in headers:
+                        bucket.reset = float(headers["X-RateLimit-Reset"])
+                except ValueError:
+                    pass
+
+                limited = status in (403, 429) and (
+                    bucket.remaining == 0 or "Retry-After" in headers or "rate limit" in text.lower()
+                )
+                if limited:
+                    self._rate_limited_responses += 1
+                    if bucket.remaining == 0 and bucket.reset > now:
+                        # primary limit: nothing to do until the window resets
+                        bucket.blocked_until = bucket.reset + random.uniform(0, 1)
+                    else:
+                        # secondary limit: honour Retry-After, else exponential backoff; jitter
+                        # spreads the retries of every thread that got throttled at once
+                        bucket.secondary_hits += 1
+                        try:
+                            wait = float(headers.get("Retry-After"))
+                        except (TypeError, ValueError):
+                            wait = min(SECONDARY_BACKOFF * 2 ** (bucket.secondary_hits - 1),
+                                       SECONDARY_BACKOFF_MAX)
+                        bucket.blocked_until = now + wait + random.uniform(0, wait * 0.1 + 1)
+                    backoff = bucket.blocked_until - now
+                elif status is not None and status < 400:
+                    bucket.secondary_hits = 0
+            self._dispatch()
+        return backoff
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "max_inflight": self.max_inflight,
+                "waiting": {name: sum(len(q) for (qp, _, _), q in self._queues.items() if qp == p)
+                            for p, name in PRIORITY_NAMES.items()},
+                "admitted": {PRIORITY_NAMES[p]: n for p, n in self._admitted.items()},
+                "delayed": {PRIORITY_NAMES[p]: n for p, n in self._delayed.items()},
+                "rejected": {PRIORITY_NAMES[p]: n for p, n in self._rejected.items()},
+                "busy": {PRIORITY_NAMES[p]: n for p, n in self._busy.items()},
+                "rate_limited_responses": self._rate_limited_responses,
+                "buckets": [
+                    {
+                        "token": scope,
+                        "resource": resource,
+                        "limit": b.limit,
+                        "remaining": b.remaining,
+                        "resets_in": round(max(b.reset - now, 0), 1) if b.reset else None,
+                        "blocked_for": round(max(b.blocked_until - now, 0), 1),
+                    }
+                    for (scope, resource), b in self._buckets.items()
+                ],
+            }
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# name -> HttpClient, so /api/metrics can report every upstream
+_clients = {}
+_clients_lock = threading.Lock()
+
+# how many recent calls the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+
+
+class HttpClient:
+    """Keep-alive HTTP client for one upstream service.
+
+    Wraps a requests.Session whose connection pool is sized for the number of
+    threads that talk to the upstream concurrently, so TCP/TLS handshakes are
+    paid once per connection instead of once per call. Safe to share between
+    threads. Every call's latency is recorded for ``stats()``.
+    """
+
+    def __init__(self, name: str, base_url: str, pool_size: int = 10, timeout: float = 30.0,
+                 connect_timeout: float = 5.0, headers: dict | None = None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._requests = 0
+        self._errors = 0
+        self._max = 0.0
+
+        with _clients_lock:
+            _clients[name] = self
+
+    def request(self, method: str, path: str, timeout: float | None = None, **kwargs) -> requests.Response:
+        """Send ``method`` to base_url + path. Raises requests exceptions like requests itself."""
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        read_timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        failed = False
+        try:
+            resp = self.session.request(method, url, timeout=(self.connect_timeout, read_timeout), **kwargs)
+            failed = resp.status_code >= 500
+            return resp
+        except requests.exceptions.RequestException:
+            failed = True
+            raise
+        finally:
+            self._record(time.monotonic() - start, failed)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def _record(self, elapsed: float, failed: bool):
+        with self._lock:
+            self._requests += 1
+            if failed:
+                self._errors += 1
+            self._latencies.append(elapsed)
+            self._max = max(self._max, elapsed)
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+            requests_total = self._requests
+            errors = self._errors
+            max_latency = self._max
+
+        def pct(p):
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+
+        return {
+            "base_url": self.base_url,
+            "pool_size": self.pool_size,
+            "requests": requests_total,
+            "errors": errors,
+            "avg_ms": round(sum(samples) / len(samples) * 1000, 1) if samples else 0.0,
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "max_ms": round(max_latency * 1000, 1),
+        }
+
+
+def upstream_stats():
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {c.name: c.stats() for c in clients}
@@ -1,10 +1,20 @@
+-- Runs on every start, so it only creates what's missing. Changes to existing
+-- tables go into migrations/ (migrate.py), which run once.
+
+-- leaderboard: Postgres keeps the overall score and the three rankings up to date
+-- on every INSERT/UPDATE, so reading a page is an index walk instead of a full sort
+-- (users_total_rank_idx is created by migrations/0003_upgrade_columns.sql)
 CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
     githubId VARCHAR(50) NOT NULL UNIQUE,
-    comment_score INTEGER DEFAULT 0,
-    code_score INTEGER DEFAULT 0
+    comment_score INTEGER NOT NULL DEFAULT 0,
+    code_score INTEGER NOT NULL DEFAULT 0,
+    total_score INTEGER GENERATED ALWAYS AS (code_score + comment_score) STORED
 );
 
+CREATE INDEX IF NOT EXISTS users_code_rank_idx ON users (code_score DESC, id DESC) INCLUDE (githubId);
+CREATE INDEX IF NOT EXISTS users_comment_rank_idx ON users (comment_score DESC, id DESC) INCLUDE (githubId);
+
 
 CREATE TABLE IF NOT EXISTS awards (
     id SERIAL PRIMARY KEY,
@@ -19,3 +29,95 @@ CREATE TABLE IF NOT EXISTS user_awards (
     FOREIGN KEY (userId) REFERENCES users (id) ON DELETE CASCADE,
     FOREIGN KEY (awardId) REFERENCES awards (id) ON DELETE CASCADE
 );
+
+-- GitHub response cache (only used with GITHUB_CACHE_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS github_cache (
+    key TEXT PRIMARY KEY,
+    entry JSONB NOT NULL,
+    stored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    accessed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS github_cache_accessed_idx ON github_cache (accessed_at);
+
+-- scoring ledger: one row per PR / comment already scored for a user, so score
+-- refreshes only analyze new or edited items and apply exact deltas
+CREATE TABLE IF NOT EXISTS scored_items (
+    userId INT NOT NULL,
+    item_kind VARCHAR(20) NOT NULL,   -- 'pr' | 'issue_comment' | 'review_comment'
+    item_id BIGINT NOT NULL,          -- GitHub id of the PR / comment
+    updated_at TIMESTAMPTZ NOT NULL,  -- GitHub updated_at of the version that was scored
+    content_hash CHAR(64) NOT NULL,   -- sha256 of the analyzed text
+    score INTEGER NOT NULL,
+    prev_score INTEGER NOT NULL DEFAULT 0,  -- score before the latest rescoring, so an upsert can return its delta
+    scored_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (userId, item_kind, item_id),
+    FOREIGN KEY (userId) REFERENCES users (id) ON DELETE CASCADE
+);
+
+-- append-only log of score changes (score_events.py); the compactor folds pending ones into users
+CREATE TABLE IF NOT EXISTS score_events (
+    id BIGSERIAL PRIMARY KEY,
+    userId INT NOT NULL,
+    field VARCHAR(10) NOT NULL,       -- 'code' | 'comment'
+    delta INTEGER NOT NULL,
+    source VARCHAR(20) NOT NULL,      -- 'analyze' | 'refresh' | 'rubric' | ...
+    item_kind VARCHAR(20),            -- scored_items key, for events about a ledger item
+    item_id BIGINT,
+    sentiment VARCHAR(10),            -- compute_score inputs, for events that come from an analysis
+    constructiveness DOUBLE PRECISION,
+    score INTEGER,                    -- compute_score(sentiment, constructiveness) at the time
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    applied_at TIMESTAMPTZ,           -- when the compactor added delta to users
+    FOREIGN KEY (userId) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS score_events_pending_idx ON score_events (userId) WHERE applied_at IS NULL;
+CREATE INDEX IF NOT EXISTS score_events_item_idx ON score_events (userId, item_kind, item_id, id DESC)
+    WHERE item_id IS NOT NULL;
+
+-- background score refreshes (jobs.py); progress/result hold refresh_user_scores stats
+CREATE TABLE IF NOT EXISTS score_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',  -- queued | running | succeeded | failed
+    progress JSONB NOT NULL DEFAULT '{}',
+    result JSONB,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- at most one pending job per user
+CREATE UNIQUE INDEX IF NOT EXISTS score_jobs_active_user_idx
+    ON score_jobs (username) WHERE status IN ('queued', 'running');
+
+-- scheduled rescoring of all users (rescoring.py); one row per run, plus its
+-- user snapshot, which doubles as the checkpoint an interrupted run resumes from
+CREATE TABLE IF NOT EXISTS rescore_runs (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'running',   -- running | finished
+    trigger VARCHAR(20) NOT NULL DEFAULT 'schedule', -- schedule | manual
+    workers INT NOT NULL,
+    total_users INT NOT NULL DEFAULT 0,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS rescore_run_users (
+    run_id BIGINT NOT NULL,
+    userId INT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',   -- pending | running | done | failed
+    analyzed_items INT NOT NULL DEFAULT 0,
+    skipped_items INT NOT NULL DEFAULT 0,
+    error TEXT,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    PRIMARY KEY (run_id, userId),
+    FOREIGN KEY (run_id) REFERENCES rescore_runs (id) ON DELETE CASCADE,
+    FOREIGN KEY (userId) REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS rescore_run_users_pending_idx
+    ON rescore_run_users (run_id, userId) WHERE status = 'pending';
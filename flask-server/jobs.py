@@ -0,0 +1,235 @@
+# Background score refreshes.
+#
+# POST /api/score/update only records a score_jobs row and hands the id to a
+# worker thread; clients poll GET /api/score/jobs/<id> for progress. Job state
+# lives in Postgres, so it's shared by every server instance and survives
+# restarts:
+#   * at most one queued/running job per user (partial unique index) -- a
+#     second submit for the same user returns the job that's already there;
+#   * a worker claims a job with an UPDATE ... WHERE status = 'queued', so a
+#     job never runs twice at once even if several instances pick it up;
+#   * a sweeper thread in every instance heartbeats the jobs it is running,
+#     however long the current item takes, and every SCORE_JOB_HEARTBEAT
+#     seconds picks up queued jobs and running jobs whose heartbeat went stale
+#     (their process died, even if it came straight back up). Re-running a
+#     half-done refresh is safe, the scored_items ledger skips whatever was
+#     already scored.
+
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_db
+from github_api import GitHubError
+from scoring import UserNotFound, refresh_user_scores
+
+SCORE_JOB_WORKERS = int(os.getenv("SCORE_JOB_WORKERS", "2"))
+# how often running jobs heartbeat and the sweeper looks for orphaned jobs (seconds)
+SCORE_JOB_HEARTBEAT = float(os.getenv("SCORE_JOB_HEARTBEAT", "30"))
+# running jobs without a heartbeat for this long are considered dead
+SCORE_JOB_STALE_AFTER = float(os.getenv("SCORE_JOB_STALE_AFTER", "120"))
+# progress is written to the database at most this often per job (seconds)
+SCORE_JOB_PROGRESS_INTERVAL = float(os.getenv("SCORE_JOB_PROGRESS_INTERVAL", "1"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+_JOB_COLUMNS = "id, username, status, progress, result, error, created_at, started_at, finished_at, updated_at"
+
+
+def _job_dict(row):
+    if row is None:
+        return None
+    job = dict(zip([c.strip() for c in _JOB_COLUMNS.split(",")], row))
+    for field in ("created_at", "started_at", "finished_at", "updated_at"):
+        if job[field] is not None:
+            job[field] = job[field].isoformat()
+    return job
+
+
+class ScoreJobQueue:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="score-job")
+        self._lock = threading.Lock()
+        self._local = set()    # job ids submitted to this process's executor
+        self._running = set()  # the ones this process claimed and is running
+
+    def submit(self, username: str):
+        """
+        Queue a refresh for username. Returns (job, created); created is False
+        when the user already had a queued or running job, which is returned instead.
+        Raises UserNotFound if there's no users row for them.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM users WHERE githubId = %s;", (username,))
+                if cur.fetchone() is None:
+                    raise UserNotFound(username)
+
+                cur.execute(
+                    f"""
+                    INSERT INTO score_jobs (username) VALUES (%s)
+                    ON CONFLICT (username) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING {_JOB_COLUMNS};
+                    """,
+                    (username,),
+                )
+                row = cur.fetchone()
+                created = row is not None
+                if not created:
+                    cur.execute(
+                        f"SELECT {_JOB_COLUMNS} FROM score_jobs "
+                        "WHERE username = %s AND status IN ('queued', 'running');",
+                        (username,),
+                    )
+                    row = cur.fetchone()
+            conn.commit()
+
+        job = _job_dict(row)
+        if job is None:
+            # the active job finished between the INSERT and the SELECT; queue a fresh one
+            return self.submit(username)
+        if created:
+            self._dispatch(job["id"])
+        return job, created
+
+    def get(self, job_id: int):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {_JOB_COLUMNS} FROM score_jobs WHERE id = %s;", (job_id,))
+                return _job_dict(cur.fetchone())
+
+    def recover(self):
+        """Re-queue jobs whose process died and start them, with any still queued. Returns how many were picked up."""
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE score_jobs SET status = 'queued', updated_at = now()
+                    WHERE status = 'running' AND updated_at < now() - make_interval(secs => %s);
+                    """,
+                    (SCORE_JOB_STALE_AFTER,),
+                )
+                cur.execute("SELECT id FROM score_jobs WHERE status = 'queued' ORDER BY id;")
+                ids = [r[0] for r in cur.fetchall()]
+            conn.commit()
+        for job_id in ids:
+            self._dispatch(job_id)
+        return len(ids)
+
+    def heartbeat(self):
+        """Mark the jobs this process is running as alive."""
+        with self._lock:
+            running = list(self._running)
+        if not running:
+            return
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE score_jobs SET updated_at = now() WHERE id = ANY(%s) AND status = 'running';",
+                    (running,),
+                )
+            conn.commit()
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.heartbeat()
+                self.recover()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(SCORE_JOB_HEARTBEAT)
+
+    def start_sweeper(self):
+        """Start the thread that heartbeats this process's jobs and recovers orphaned ones (right away, too)."""
+        thread = threading.Thread(target=self._sweep_loop, name="score-job-sweeper", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT status, COUNT(*) FROM score_jobs GROUP BY status;")
+                counts = dict(cur.fetchall())
+        with self._lock:
+            local = len(self._local)
+        return {"workers": self.workers, "in_this_process": local, "jobs": counts}
+
+    def _dispatch(self, job_id):
+        with self._lock:
+            if job_id in self._local:
+                return
+            self._local.add(job_id)
+        self._executor.submit(self._run, job_id)
+
+    def _claim(self, job_id):
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE score_jobs
+                    SET status = 'running', started_at = now(), updated_at = now()
+                    WHERE id = %s AND status = 'queued'
+                    RETURNING username;
+                    """,
+                    (job_id,),
+                )
+                row = cur.fetchone()
+            conn.commit()
+        return row[0] if row else None
+
+    def _update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = %s" for name in fields)
+        values = [json.dumps(v) if name in ("progress", "result") else v for name, v in fields.items()]
+        if "status" in fields and fields["status"] not in ACTIVE_STATUSES:
+            assignments += ", finished_at = now()"
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"UPDATE score_jobs SET {assignments}, updated_at = now() WHERE id = %s;",
+                    (*values, job_id),
+                )
+            conn.commit()
+
+    def _run(self, job_id):
+        try:
+            username = self._claim(job_id)
+            if username is None:
+                # another instance got to it first
+                return
+            with self._lock:
+                self._running.add(job_id)
+
+            last_write = 0.0
+
+            def progress(stats):
+                nonlocal last_write
+                now = time.monotonic()
+                if now - last_write >= SCORE_JOB_PROGRESS_INTERVAL:
+                    last_write = now
+                    self._update(job_id, progress=stats)
+
+            try:
+                result = refresh_user_scores(username, progress=progress)
+            except UserNotFound:
+                self._update(job_id, status="failed", error="User does not exist")
+            except GitHubError as e:
+                self._update(job_id, status="failed", error=f"Failed to fetch PRs: {e.err}")
+            except Exception as e:
+                traceback.print_exc()
+                self._update(job_id, status="failed", error=repr(e))
+            else:
+                self._update(job_id, status="succeeded", progress=result, result=result)
+        except Exception:
+            # database trouble while bookkeeping; the sweeper picks the job up once it goes stale
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._local.discard(job_id)
+                self._running.discard(job_id)
+
+
+score_jobs = ScoreJobQueue(SCORE_JOB_WORKERS)
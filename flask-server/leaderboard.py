@@ -0,0 +1,150 @@
+# Leaderboard reads.
+#
+# The ranking itself lives in Postgres (see init.sql): total_score is a stored
+# generated column and each leaderboard type has a (score DESC, id DESC) index
+# covering githubId. Every write to users -- addUser, updateUser, and the score
+# event compactor for /api/analyze and /api/score/update -- maintains those
+# indexes in O(log N), so there is nothing to rebuild here and a page of the
+# leaderboard is read straight off the index.
+
+import base64
+import binascii
+import os
+
+# ?type= -> column the ranking is ordered by
+LEADERBOARD_COLUMNS = {
+    "code": "code_score",
+    "comment": "comment_score",
+    "overall": "total_score",
+}
+
+
+# ---------------- pagination ----------------
+# Keyset pagination on (score, id): the cursor remembers the last row of the
+# previous page and the next page starts right after it in the index, so every
+# page costs O(limit) no matter how deep into the leaderboard it is.
+#
+# Ranks are counted, but only up to LEADERBOARD_RANK_EXACT_LIMIT index entries
+# ahead of a row. Further down they're approximate: the rank the cursor
+# carried, or for ?around= the planner's row estimate, clamped to at least the
+# limit and at most the table's estimated size. Responses say which they got.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+DEFAULT_AROUND = 5
+RANK_EXACT_LIMIT = int(os.getenv("LEADERBOARD_RANK_EXACT_LIMIT", "10000"))
+
+
+def encode_cursor(score: int, row_id: int, rank: int) -> str:
+    raw = f"{score}:{row_id}:{rank}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor. Raises ValueError on anything malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, row_id, rank = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+        return int(score), int(row_id), int(rank)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def _entry(row, rank):
+    return {"id": row[0], "name": row[1], "score": row[2], "rank": rank}
+
+
+def _rows_ahead(cur, column: str, score: int, row_id: int, claimed: int | None = None):
+    """(how many rows rank above (score, row_id), whether that's exact); see the note on ranks above."""
+    cur.execute(
+        f"SELECT count(*) FROM (SELECT 1 FROM users WHERE ({column}, id) > (%s, %s) LIMIT %s) AS ahead;",
+        (score, row_id, RANK_EXACT_LIMIT),
+    )
+    ahead = cur.fetchone()[0]
+    if ahead < RANK_EXACT_LIMIT:
+        return ahead, True
+    if claimed is None:
+        cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM users WHERE {column} > %s;", (score,))
+        claimed = int(cur.fetchone()[0][0]["Plan"]["Plan Rows"])
+    cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'users'::regclass;")
+    total = cur.fetchone()[0]
+    if total > 0:
+        claimed = min(claimed, total - 1)
+    return max(claimed, RANK_EXACT_LIMIT), False
+
+
+def fetch_page(cur, leaderboard_type: str, limit: int, cursor: str | None = None):
+    """One page of the leaderboard, the cursor for the next one (None at the end) and whether its ranks are exact."""
+    column = LEADERBOARD_COLUMNS[leaderboard_type]
+    start_rank, exact = 0, True
+    if cursor:
+        score, row_id, claimed_rank = decode_cursor(cursor)
+        # the cursor comes from the client: its rank is only used where it can't be counted
+        ahead, exact = _rows_ahead(cur, column, score, row_id, claimed=claimed_rank - 1)
+        start_rank = ahead + 1
+        cur.execute(
+            f"""
+            SELECT id, githubId, {column} FROM users
+            WHERE ({column}, id) < (%s, %s)
+            ORDER BY {column} DESC, id DESC
+            LIMIT %s;
+            """,
+            (score, row_id, limit + 1),
+        )
+    else:
+        cur.execute(
+            f"SELECT id, githubId, {column} FROM users ORDER BY {column} DESC, id DESC LIMIT %s;",
+            (limit + 1,),
+        )
+    rows = cur.fetchall()
+
+    page = [_entry(r, start_rank + i + 1) for i, r in enumerate(rows[:limit])]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[2], last[0], start_rank + limit)
+    return page, next_cursor, exact
+
+
+def fetch_around(cur, leaderboard_type: str, github_id: str, radius: int):
+    """A user's rank plus up to ``radius`` neighbours on each side, or None if unknown.
+
+    The rank is a COUNT over the index entries ahead of the user (an index-only
+    scan), estimated past RANK_EXACT_LIMIT; the neighbours are two bounded index
+    walks starting at the user.
+    """
+    column = LEADERBOARD_COLUMNS[leaderboard_type]
+    cur.execute(f"SELECT id, githubId, {column} FROM users WHERE githubId = %s;", (github_id,))
+    me = cur.fetchone()
+    if me is None:
+        return None
+    score, row_id = me[2], me[0]
+
+    ahead, exact = _rows_ahead(cur, column, score, row_id)
+    rank = ahead + 1
+
+    cur.execute(
+        f"""
+        SELECT id, githubId, {column} FROM users
+        WHERE ({column}, id) > (%s, %s)
+        ORDER BY {column} ASC, id ASC
+        LIMIT %s;
+        """,
+        (score, row_id, radius),
+    )
+    above = cur.fetchall()[::-1]
+    cur.execute(
+        f"""
+        SELECT id, githubId, {column} FROM users
+        WHERE ({column}, id) < (%s, %s)
+        ORDER BY {column} DESC, id DESC
+        LIMIT %s;
+        """,
+        (score, row_id, radius),
+    )
+    below = cur.fetchall()
+
+    entries = [_entry(r, rank - len(above) + i) for i, r in enumerate(above)]
+    entries.append(_entry(me, rank))
+    entries.extend(_entry(r, rank + i + 1) for i, r in enumerate(below))
+    return {"rank": rank, "rank_exact": exact, "user": _entry(me, rank), "leaderboard": entries}
@@ -0,0 +1,108 @@
+# Schema migrations.
+#
+# init.sql creates the tables and stays idempotent, so it is still what a new
+# database (and the Postgres container's initdb) gets. Changes from here on go
+# into migrations/NNNN_name.sql instead: each file runs once, in its own
+# transaction, and is recorded in schema_migrations with a checksum, so it can
+# hold statements that aren't safe to repeat and an edited file is noticed.
+# A transaction-level advisory lock keeps server instances starting together
+# from applying the same migration twice.
+
+import hashlib
+import os
+import re
+from collections import namedtuple
+
+from db import get_db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# pg_advisory_xact_lock key; any constant works as long as nothing else uses it
+MIGRATE_LOCK_KEY = 411_002
+
+_FILENAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+Migration = namedtuple("Migration", "version name path checksum")
+
+
+def available(directory: str = MIGRATIONS_DIR):
+    """Migrations on disk, oldest first."""
+    found = []
+    for filename in sorted(os.listdir(directory)):
+        m = _FILENAME.match(filename)
+        if m is None:
+            continue
+        path = os.path.join(directory, filename)
+        with open(path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        found.append(Migration(m.group(1), m.group(2), path, checksum))
+    versions = [migration.version for migration in found]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"two migrations share a version number in {directory}")
+    return found
+
+
+def _ensure_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(20) PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+
+def apply_migrations(conn, directory: str = MIGRATIONS_DIR):
+    """Apply pending migrations on conn. Returns the versions applied."""
+    applied = []
+    for migration in available(directory):
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATE_LOCK_KEY,))
+            _ensure_table(cur)
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (migration.version,))
+            if cur.fetchone() is not None:
+                conn.commit()
+                continue
+            with open(migration.path) as f:
+                cur.execute(f.read())
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s);",
+                (migration.version, migration.name, migration.checksum),
+            )
+        conn.commit()
+        applied.append(migration.version)
+    return applied
+
+
+def migrate():
+    """Apply pending migrations. Returns the versions applied."""
+    with get_db() as conn:
+        return apply_migrations(conn)
+
+
+def migration_status():
+    """[{version, name, applied_at, changed}] for every migration on disk or in the database."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            _ensure_table(cur)
+            cur.execute("SELECT version, name, checksum, applied_at FROM schema_migrations;")
+            done = {row[0]: row for row in cur.fetchall()}
+        conn.commit()
+
+    status = []
+    for migration in available():
+        row = done.pop(migration.version, None)
+        status.append({
+            "version": migration.version,
+            "name": migration.name,
+            "applied_at": row[3].isoformat() if row else None,
+            # the file was edited after it ran; the database has the old version
+            "changed": row is not None and row[2] != migration.checksum,
+        })
+    # applied here but missing on disk (e.g. a newer server ran against this database)
+    for version, name, _, applied_at in done.values():
+        status.append({"version": version, "name": name, "applied_at": applied_at.isoformat(), "changed": None})
+    return sorted(status, key=lambda entry: entry["version"])
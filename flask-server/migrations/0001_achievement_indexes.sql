@@ -0,0 +1,16 @@
+-- Indexes for the achievement lookups and for deletes that cascade.
+--
+-- achievements_by_nickname goes githubId -> users.id -> user_awards -> awards.
+-- users_githubid_key finds the user but has to visit the heap for the id;
+-- covering it makes the first step an index-only scan. get_user_achievements
+-- already reads user_awards off its (userId, awardId) primary key.
+CREATE INDEX IF NOT EXISTS users_githubid_covering_idx ON users (githubId) INCLUDE (id);
+
+-- who has an award, and what DELETE FROM awards cascades to; the primary key
+-- leads with userId, so both used to scan the whole table
+CREATE INDEX IF NOT EXISTS user_awards_award_idx ON user_awards (awardId, userId);
+
+-- deleting a user cascades to these by userId; score_events only had partial
+-- indexes and rescore_run_users' key leads with run_id
+CREATE INDEX IF NOT EXISTS score_events_user_idx ON score_events (userId);
+CREATE INDEX IF NOT EXISTS rescore_run_users_user_idx ON rescore_run_users (userId);
@@ -0,0 +1,26 @@
+-- Automatic achievements (achievements.py): an award with a rule is granted to
+-- every user whose metric reaches the threshold. backfilled_at is set once the
+-- rule has been evaluated against all existing users.
+CREATE TABLE IF NOT EXISTS achievement_rules (
+    id SERIAL PRIMARY KEY,
+    awardId INT NOT NULL UNIQUE,
+    metric VARCHAR(30) NOT NULL,      -- a key of achievements.METRICS
+    threshold INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    backfilled_at TIMESTAMPTZ,
+    FOREIGN KEY (awardId) REFERENCES awards (id) ON DELETE CASCADE
+);
+
+INSERT INTO awards (awardname, description) VALUES
+    ('First PR', 'Had a first pull request scored'),
+    ('Constructive Commenter', 'Wrote 100 constructive review comments'),
+    ('Top 10', 'Reached the top 10 of the overall leaderboard')
+ON CONFLICT (awardname) DO NOTHING;
+
+INSERT INTO achievement_rules (awardId, metric, threshold)
+SELECT a.id, r.metric, r.threshold
+FROM (VALUES ('First PR', 'prs', 1),
+             ('Constructive Commenter', 'constructive_comments', 100),
+             ('Top 10', 'overall_rank', 10)) AS r (awardname, metric, threshold)
+JOIN awards a ON a.awardname = r.awardname
+ON CONFLICT (awardId) DO NOTHING;
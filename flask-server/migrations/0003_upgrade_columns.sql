@@ -0,0 +1,16 @@
+-- Column changes init.sql used to repeat on every start.
+--
+-- Databases created before the leaderboard indexes existed allowed NULL scores
+-- and had no total_score; databases from before the score event log have no
+-- scored_items.prev_score. On a database init.sql created, every statement is
+-- a no-op.
+UPDATE users SET comment_score = 0 WHERE comment_score IS NULL;
+UPDATE users SET code_score = 0 WHERE code_score IS NULL;
+ALTER TABLE users ALTER COLUMN comment_score SET NOT NULL;
+ALTER TABLE users ALTER COLUMN code_score SET NOT NULL;
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS total_score INTEGER GENERATED ALWAYS AS (code_score + comment_score) STORED;
+CREATE INDEX IF NOT EXISTS users_total_rank_idx ON users (total_score DESC, id DESC) INCLUDE (githubId);
+
+ALTER TABLE scored_items ADD COLUMN IF NOT EXISTS prev_score INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,424 @@
+# Scheduled rescoring of every user.
+#
+# A run snapshots all user ids into rescore_run_users and works through them
+# inside the server process, in the stages of refresh_user_scores
+# (/api/score/update) but shared across users:
+#
+#   claim   users are claimed RESCORE_CLAIM_BATCH at a time (FOR UPDATE SKIP LOCKED)
+#   fetch   RESCORE_WORKERS threads page through each user's PRs and comments at
+#           BULK priority, on the process's github_scheduler and HTTP pools, so
+#           interactive requests keep their share of the rate limit and go first
+#   score   one thread checks the items against the scored_items ledger and sends
+#           what changed to the AI service AI_BATCH_SIZE at a time whoever they
+#           belong to, with up to RESCORE_AI_BATCHES batches in flight
+#   write   the scored rows of RESCORE_WRITE_USERS users go out in one
+#           write_item_scores statement, then those users are checkpointed
+#
+# A run interrupted by a restart carries on with the users it hadn't got to yet.
+#
+# Only one coordinator runs at a time across all server instances: starting or
+# resuming a run requires a Postgres advisory lock, held on a connection of its
+# own (not a pool slot) until the run ends.
+
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from db import db_pool, get_db
+from github_api import GitHubError
+from ai_client import AI_BATCH_SIZE, analyze_batch
+from scoring import iter_user_items, new_stats, scored_rows, unscored_items, write_scored_rows
+
+# threads fetching users from GitHub
+RESCORE_WORKERS = int(os.getenv("RESCORE_WORKERS", "4"))
+# hours between scheduled runs (counted from the start of the previous one); 0 turns the schedule off
+RESCORE_INTERVAL_HOURS = float(os.getenv("RESCORE_INTERVAL_HOURS", "24"))
+# how often the scheduler thread checks whether a run is due (seconds)
+RESCORE_CHECK_EVERY = float(os.getenv("RESCORE_CHECK_EVERY", "60"))
+# users claimed per round trip
+RESCORE_CLAIM_BATCH = int(os.getenv("RESCORE_CLAIM_BATCH", "50"))
+# AI batches waiting on the AI service at once
+RESCORE_AI_BATCHES = int(os.getenv("RESCORE_AI_BATCHES", "2"))
+# scored rows are written in one statement once this many users (or rows) are done
+RESCORE_WRITE_USERS = int(os.getenv("RESCORE_WRITE_USERS", "500"))
+RESCORE_WRITE_ROWS = int(os.getenv("RESCORE_WRITE_ROWS", "5000"))
+
+# pg_advisory_lock key; any constant works as long as nothing else uses it
+RESCORE_LOCK_KEY = 411_001
+
+
+class _AdvisoryLock:
+    """Session-level advisory lock on a dedicated connection, so a run doesn't pin a pool slot."""
+
+    def __init__(self, key):
+        self.key = key
+        self._conn = None
+
+    def try_acquire(self) -> bool:
+        conn = db_pool.dedicated()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (self.key,))
+                acquired = cur.fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        if acquired:
+            self._conn = conn
+        else:
+            conn.close()
+        return acquired
+
+    def release(self):
+        # ending the session releases the lock
+        self._conn.close()
+        self._conn = None
+
+
+def _claim_users(run_id, limit):
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE rescore_run_users r
+                SET status = 'running', started_at = now()
+                FROM users u
+                WHERE (r.run_id, r.userId) IN (
+                        SELECT run_id, userId FROM rescore_run_users
+                        WHERE run_id = %s AND status = 'pending'
+                        ORDER BY userId
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                  AND u.id = r.userId
+                RETURNING r.userId, u.githubId;
+                """,
+                (run_id, limit),
+            )
+            rows = cur.fetchall()
+        conn.commit()
+    return sorted(rows)
+
+
+def _finish_users(run_id, finished):
+    """Checkpoint [(user_id, status, stats, error)] in one statement."""
+    if not finished:
+        return
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE rescore_run_users r
+                SET status = t.status, analyzed_items = t.analyzed, skipped_items = t.skipped,
+                    error = t.error, finished_at = now()
+                FROM unnest(%s::int[], %s::varchar[], %s::int[], %s::int[], %s::text[])
+                    AS t (userId, status, analyzed, skipped, error)
+                WHERE r.run_id = %s AND r.userId = t.userId;
+                """,
+                (
+                    [user_id for user_id, _, _, _ in finished],
+                    [status for _, status, _, _ in finished],
+                    [stats.get("analyzed_items", 0) for _, _, stats, _ in finished],
+                    [stats.get("skipped_items", 0) for _, _, stats, _ in finished],
+                    [error for _, _, _, error in finished],
+                    run_id,
+                ),
+            )
+        conn.commit()
+
+
+class _Claims:
+    """Claim stage: users of a run, claimed in batches and handed out one at a time to the fetch threads."""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self._users = deque()
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def next(self):
+        """The next (user_id, username) to fetch, or None once the run has none left."""
+        with self._lock:
+            if not self._users and not self._exhausted:
+                self._users.extend(_claim_users(self.run_id, RESCORE_CLAIM_BATCH))
+                self._exhausted = not self._users
+            return self._users.popleft() if self._users else None
+
+
+def _fetch_stage(claims, events, stop):
+    """Fetch thread body: page through claimed users' items onto the events queue."""
+    try:
+        while not stop.is_set():
+            claimed = claims.next()
+            if claimed is None:
+                return
+            user_id, username = claimed
+            stats = new_stats()
+            events.put(("start", user_id, stats))
+            try:
+                for item in iter_user_items(user_id, username, stats):
+                    if stop.is_set():
+                        return
+                    events.put(("item", item))
+            except GitHubError as e:
+                events.put(("finish", user_id, "failed", f"Failed to fetch PRs: {e.err}"))
+            except Exception as e:
+                traceback.print_exc()
+                events.put(("finish", user_id, "failed", repr(e)))
+            else:
+                events.put(("finish", user_id, "done", None))
+    except Exception as e:
+        # claiming failed: the run can't be finished by this coordinator
+        events.put(("error", e))
+    finally:
+        events.put(("exit",))
+
+
+class _Batch:
+    """
+    Score and write stages: ledger checks and AI work gathered across every
+    user being fetched. Items go to the AI service AI_BATCH_SIZE at a time
+    whoever they belong to, and the scored rows of RESCORE_WRITE_USERS users
+    are written with a single write_item_scores statement before those users
+    are checkpointed.
+    """
+
+    def __init__(self, run_id, executor):
+        self.run_id = run_id
+        self.executor = executor
+        self.stats = {}
+        self.pending = []         # ledger candidates not checked yet
+        self.inflight = deque()   # (items, analyze_batch future), oldest first
+        self.rows = []            # scored, not written yet
+        self.finished = []        # (user_id, status, stats, error) waiting on the write
+
+    def add_item(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= AI_BATCH_SIZE:
+            self._analyze()
+        while self.inflight and self.inflight[0][1].done():
+            self._collect()
+
+    def _analyze(self):
+        todo = unscored_items(self.pending, self.stats)
+        self.pending = []
+        if not todo:
+            return
+        while len(self.inflight) >= RESCORE_AI_BATCHES:
+            self._collect()
+        self.inflight.append((todo, self.executor.submit(analyze_batch, [it["payload"] for it in todo])))
+
+    def _collect(self):
+        todo, future = self.inflight.popleft()
+        self.rows.extend(scored_rows(todo, future.result(), self.stats))
+
+    def finish(self, user_id, status, error=None):
+        self.finished.append((user_id, status, self.stats.get(user_id, {}), error))
+        if len(self.finished) >= RESCORE_WRITE_USERS or len(self.rows) >= RESCORE_WRITE_ROWS:
+            self.flush()
+
+    def flush(self):
+        self._analyze()
+        while self.inflight:
+            self._collect()
+        write_scored_rows(self.rows, self.stats)
+        self.rows = []
+        _finish_users(self.run_id, self.finished)
+        for user_id, _, _, _ in self.finished:
+            self.stats.pop(user_id, None)
+        self.finished = []
+
+
+def rescore_users(run_id: int, workers: int):
+    """Rescore the pending users of run_id until there are none left. Raises if the run couldn't be finished."""
+    # bounded, so fetching waits for scoring instead of piling items up in memory
+    events = queue.Queue(maxsize=AI_BATCH_SIZE * max(RESCORE_AI_BATCHES, 1) * 2)
+    stop = threading.Event()
+    claims = _Claims(run_id)
+    fetchers = [threading.Thread(target=_fetch_stage, args=(claims, events, stop), name=f"rescore-fetch-{i}",
+                                 daemon=True)
+                for i in range(workers)]
+    for thread in fetchers:
+        thread.start()
+
+    running = len(fetchers)
+    try:
+        with ThreadPoolExecutor(max_workers=max(RESCORE_AI_BATCHES, 1), thread_name_prefix="rescore-ai") as executor:
+            batch = _Batch(run_id, executor)
+            while running:
+                event = events.get()
+                if event[0] == "item":
+                    batch.add_item(event[1])
+                elif event[0] == "start":
+                    batch.stats[event[1]] = event[2]
+                elif event[0] == "finish":
+                    batch.finish(*event[1:])
+                elif event[0] == "error":
+                    raise event[1]
+                else:
+                    running -= 1
+            batch.flush()
+    finally:
+        # on an error, let the fetch threads see stop and wind down; their users stay 'running' until resumed
+        stop.set()
+        while running:
+            if events.get()[0] == "exit":
+                running -= 1
+
+
+def _open_run(trigger, workers):
+    """Resume the unfinished run if there is one, else snapshot all users into a new run."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM rescore_runs WHERE status = 'running' ORDER BY id LIMIT 1;")
+            row = cur.fetchone()
+            if row:
+                run_id = row[0]
+                # the previous coordinator died; whatever its workers had claimed starts over
+                cur.execute(
+                    "UPDATE rescore_run_users SET status = 'pending', started_at = NULL "
+                    "WHERE run_id = %s AND status = 'running';",
+                    (run_id,),
+                )
+                cur.execute("UPDATE rescore_runs SET workers = %s WHERE id = %s;", (workers, run_id))
+                resumed = True
+            else:
+                cur.execute(
+                    "INSERT INTO rescore_runs (trigger, workers) VALUES (%s, %s) RETURNING id;",
+                    (trigger, workers),
+                )
+                run_id = cur.fetchone()[0]
+                cur.execute(
+                    "INSERT INTO rescore_run_users (run_id, userId) SELECT %s, id FROM users;",
+                    (run_id,),
+                )
+                cur.execute("UPDATE rescore_runs SET total_users = %s WHERE id = %s;", (cur.rowcount, run_id))
+                resumed = False
+        conn.commit()
+    return run_id, resumed
+
+
+def _close_run(run_id):
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE rescore_runs SET status = 'finished', finished_at = now() WHERE id = %s;",
+                (run_id,),
+            )
+        conn.commit()
+
+
+def _run_due() -> bool:
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT bool_or(status = 'running')
+                    OR coalesce(max(started_at) < now() - make_interval(secs => %s), true)
+                FROM rescore_runs;
+                """,
+                (RESCORE_INTERVAL_HOURS * 3600,),
+            )
+            return cur.fetchone()[0]
+
+
+def run_rescore(trigger="manual", workers=None, only_if_due=False):
+    """
+    Rescore every user with ``workers`` fetch threads and wait for it to finish.
+
+    Returns the run's stats, or None if another instance holds the rescoring
+    lock (or, with only_if_due, no run is due yet).
+    """
+    workers = workers or RESCORE_WORKERS
+    lock = _AdvisoryLock(RESCORE_LOCK_KEY)
+    if not lock.try_acquire():
+        return None
+    try:
+        if only_if_due and not _run_due():
+            return None
+        run_id, resumed = _open_run(trigger, workers)
+        print(f"Rescoring run {run_id} {'resumed' if resumed else 'started'} with {workers} workers")
+
+        try:
+            rescore_users(run_id, workers)
+        except Exception:
+            # leave the run open; the next attempt resumes it
+            traceback.print_exc()
+            print(f"Rescoring run {run_id}: failed, run left open")
+        else:
+            _close_run(run_id)
+        return run_stats(run_id)
+    finally:
+        lock.release()
+
+
+def run_stats(run_id=None):
+    """Progress and throughput of run_id (default: the latest run), or None if there are no runs."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT r.id, r.status, r.trigger, r.workers, r.total_users, r.started_at, r.finished_at,
+                       count(*) FILTER (WHERE u.status = 'done'),
+                       count(*) FILTER (WHERE u.status = 'failed'),
+                       count(*) FILTER (WHERE u.status = 'running'),
+                       coalesce(sum(u.analyzed_items), 0),
+                       coalesce(sum(u.skipped_items), 0),
+                       extract(epoch FROM coalesce(r.finished_at, now()) - r.started_at)
+                FROM rescore_runs r
+                LEFT JOIN rescore_run_users u ON u.run_id = r.id
+                WHERE r.id = coalesce(%s, (SELECT max(id) FROM rescore_runs))
+                GROUP BY r.id;
+                """,
+                (run_id,),
+            )
+            row = cur.fetchone()
+    if row is None:
+        return None
+
+    (run_id, status, trigger, workers, total, started_at, finished_at,
+     done, failed, running, analyzed, skipped, elapsed) = row
+    minutes = max(float(elapsed), 1.0) / 60
+    return {
+        "run_id": run_id,
+        "status": status,
+        "trigger": trigger,
+        "workers": workers,
+        "total_users": total,
+        "done_users": done,
+        "failed_users": failed,
+        "running_users": running,
+        "pending_users": total - done - failed - running,
+        "analyzed_items": analyzed,
+        "skipped_items": skipped,
+        "started_at": started_at.isoformat(),
+        "finished_at": finished_at.isoformat() if finished_at else None,
+        "elapsed_seconds": round(float(elapsed), 1),
+        "users_per_min": round((done + failed) / minutes, 2),
+        "ai_items_per_min": round(analyzed / minutes, 2),
+    }
+
+
+def _scheduler_loop():
+    while True:
+        try:
+            stats = run_rescore(trigger="schedule", only_if_due=True)
+            if stats:
+                print("Scheduled rescoring finished:", stats)
+        except Exception:
+            traceback.print_exc()
+        time.sleep(RESCORE_CHECK_EVERY)
+
+
+def start_scheduler():
+    """Start the background thread that runs (or resumes) rescoring when due. No-op if the schedule is off."""
+    if RESCORE_INTERVAL_HOURS <= 0:
+        return None
+    thread = threading.Thread(target=_scheduler_loop, name="rescore-scheduler", daemon=True)
+    thread.start()
+    return thread
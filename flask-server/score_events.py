@@ -0,0 +1,167 @@
+# Score event log.
+#
+# Analyses don't touch users.code_score / comment_score themselves: every score
+# change is appended to score_events (user, field, delta, plus what it was
+# computed from), which only takes a key-share lock on the users row. A
+# compactor thread folds pending events into users every SCORE_COMPACT_EVERY
+# seconds, one statement per batch of up to SCORE_COMPACT_BATCH events, so a
+# popular user's row is updated by one writer a few times a minute instead of
+# by every concurrent analysis. The leaderboard indexes follow users as usual.
+#
+# Events are never changed except for applied_at, which marks them as folded
+# in. They stay as the audit trail of how every score came about, and hold the
+# compute_score inputs needed to recompute scores after a rubric change
+# (scoring.recompute_scores) without calling the AI again.
+#
+# Each batch also runs the achievement rules that depend on the fields it
+# changed, for the users it changed them for (achievements.py).
+
+import os
+import threading
+import time
+import traceback
+
+from achievements import evaluate_rules_isolated
+from db import get_db
+
+SCORE_COMPACT_EVERY = float(os.getenv("SCORE_COMPACT_EVERY", "2"))
+SCORE_COMPACT_BATCH = int(os.getenv("SCORE_COMPACT_BATCH", "10000"))
+
+
+def add_score_events(events, source: str) -> int:
+    """
+    Append (user_id, field, delta) events, field "code" or "comment", in one
+    statement. Returns how many were recorded (events for missing users are dropped).
+    """
+    if not events:
+        return 0
+    ids, fields, deltas = (list(col) for col in zip(*events))
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO score_events (userId, field, delta, source)
+                SELECT t.id, t.field, t.delta, %s
+                FROM unnest(%s::int[], %s::varchar[], %s::int[]) AS t (id, field, delta)
+                JOIN users u ON u.id = t.id;
+                """,
+                (source, ids, fields, deltas),
+            )
+            count = cur.rowcount
+        conn.commit()
+    return count
+
+
+def compact_events(batch: int = SCORE_COMPACT_BATCH) -> int:
+    """Fold pending events into users until none are left. Returns how many were applied."""
+    applied = 0
+    while True:
+        with get_db() as conn:
+            with conn.cursor() as cur:
+                # SKIP LOCKED: compactors in other server processes take other events
+                cur.execute(
+                    """
+                    WITH batch AS (
+                        UPDATE score_events SET applied_at = now()
+                        WHERE id IN (
+                            SELECT id FROM score_events
+                            WHERE applied_at IS NULL
+                            ORDER BY id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING userId, field, delta
+                    ), sums AS (
+                        SELECT userId,
+                               coalesce(sum(delta) FILTER (WHERE field = 'code'), 0) AS code,
+                               coalesce(sum(delta) FILTER (WHERE field = 'comment'), 0) AS comment,
+                               bool_or(field = 'code') AS code_changed,
+                               bool_or(field = 'comment') AS comment_changed,
+                               count(*) AS events
+                        FROM batch
+                        GROUP BY userId
+                    ), moved AS (
+                        UPDATE users u
+                        SET code_score = u.code_score + s.code,
+                            comment_score = u.comment_score + s.comment
+                        FROM sums s
+                        WHERE u.id = s.userId
+                        RETURNING s.userId, s.code_changed, s.comment_changed, s.events
+                    )
+                    SELECT * FROM moved;
+                    """,
+                    (batch,),
+                )
+                moved = cur.fetchall()
+                count = sum(events for _, _, _, events in moved)
+                changed = {
+                    "code": [user for user, code, _, _ in moved if code],
+                    "comment": [user for user, _, comment, _ in moved if comment],
+                }
+                if moved:
+                    # awards earned by these scores go in with them; a broken rule mustn't hold scores up
+                    evaluate_rules_isolated(cur, changed)
+            conn.commit()
+        applied += count
+        if count < batch:
+            return applied
+
+
+def current_scores(user_id: int):
+    """(code_score, comment_score) including events not folded in yet, or None if there's no such user."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT u.code_score + coalesce(sum(e.delta) FILTER (WHERE e.field = 'code'), 0),
+                       u.comment_score + coalesce(sum(e.delta) FILTER (WHERE e.field = 'comment'), 0)
+                FROM users u
+                LEFT JOIN score_events e ON e.userId = u.id AND e.applied_at IS NULL
+                WHERE u.id = %s
+                GROUP BY u.id;
+                """,
+                (user_id,),
+            )
+            return cur.fetchone()
+
+
+_applied_total = 0
+_last_error = None
+
+
+def event_stats():
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT count(*), extract(epoch FROM now() - min(created_at))
+                FROM score_events WHERE applied_at IS NULL;
+                """
+            )
+            pending, oldest = cur.fetchone()
+    return {
+        "pending_events": pending,
+        "oldest_pending_age_seconds": round(float(oldest), 1) if oldest is not None else None,
+        "applied_by_this_process": _applied_total,
+        "compact_every_seconds": SCORE_COMPACT_EVERY,
+        "last_error": _last_error,
+    }
+
+
+def _compactor_loop():
+    global _applied_total, _last_error
+    while True:
+        try:
+            _applied_total += compact_events()
+            _last_error = None
+        except Exception as e:
+            traceback.print_exc()
+            _last_error = repr(e)
+        time.sleep(SCORE_COMPACT_EVERY)
+
+
+def start_compactor():
+    """Start the background thread that folds score events into users."""
+    thread = threading.Thread(target=_compactor_loop, name="score-compactor", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,403 @@
+# Score refreshes for one user (/api/score/update).
+#
+# Every PR and comment that has been scored is recorded in the scored_items
+# ledger with the GitHub updated_at and a hash of the text that was analyzed.
+# A refresh only sends items to the AI service that are new, or edited since
+# they were scored, and moves the user's totals by the exact difference between
+# the new and the previously recorded score. Running it twice in a row is a
+# no-op, and the AI work per refresh is proportional to new activity.
+#
+# Score changes are written by one statement per batch, which may span many
+# users: write_item_scores() upserts the ledger rows and appends the resulting
+# deltas to the score_events log in the same statement (see score_events.py
+# for how they reach users). Concurrent writers can't lose each other's
+# updates, and a batch costs one round-trip however big it is.
+
+import hashlib
+from datetime import datetime
+
+from ai_client import AI_BATCH_SIZE, analyze_batch
+from db import get_db
+from github_api import BULK, GitHubError, github_paginate, iter_pr_comments
+from score_events import current_scores
+
+
+class UserNotFound(Exception):
+    pass
+
+
+def compute_score(sentiment: str, constructiveness: float) -> float:
+    """Compute score based on rubric."""
+    if sentiment is None:
+        sentiment = "neutral"
+    sentiment_value = {
+        "positive": 1.0,
+        "neutral": 0.5,
+        "negative": 0.0
+    }.get(sentiment.lower(), 0.5)
+
+    score = (constructiveness * 0.6 + sentiment_value * 0.4) * 100
+
+    intScore = int(round(score,2)) #database only accepts ints, no decimals
+    return intScore
+
+
+def score_inputs(analysis: dict):
+    """(sentiment, constructiveness) from the "data" part of an AI-service result."""
+    sentiment = str(analysis.get("sentiment") or "neutral").lower()
+    if sentiment not in ("positive", "neutral", "negative"):
+        # compute_score rates anything else as neutral anyway
+        sentiment = "neutral"
+    raw_construct = analysis.get("constructiveness_score", 0.5)
+    try:
+        constructiveness = float(raw_construct)
+    except (TypeError, ValueError):
+        constructiveness = 0.5
+    return sentiment, constructiveness
+
+
+def score_from_analysis(analysis: dict) -> int:
+    """Score the "data" part of an AI-service result."""
+    return compute_score(*score_inputs(analysis))
+
+
+def _github_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _ledger_item(user_id, kind, github_obj, text, analysis_type):
+    return {
+        "user_id": user_id,
+        "kind": kind,
+        "item_id": github_obj["id"],
+        "updated_at": _github_time(github_obj.get("updated_at") or github_obj["created_at"]),
+        "hash": _content_hash(text),
+        "payload": {"type": analysis_type, "content": text, "file": github_obj.get("html_url", "unknown")},
+    }
+
+
+def _comment_kind(comment: dict) -> str:
+    # issue and review comments have separate id spaces on GitHub
+    return "review_comment" if "pull_request_review_id" in comment else "issue_comment"
+
+
+def new_stats() -> dict:
+    return {
+        "prs_fetched": 0,
+        "comments_fetched": 0,
+        "added_code_score": 0,
+        "added_comment_score": 0,
+        "analyzed_items": 0,
+        "skipped_items": 0,
+        "failed_analyses": 0,
+        "failed_fetches": [],
+    }
+
+
+def unscored_items(items: list, stats: dict) -> list:
+    """
+    The items (of any number of users) that are new or changed since they were
+    scored, checked against the ledger in one query. Skips are counted in
+    stats[user_id].
+    """
+    if not items:
+        return []
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT s.userId, s.item_kind, s.item_id, s.updated_at, s.content_hash
+                FROM unnest(%s::int[], %s::varchar[], %s::bigint[]) AS t (userId, item_kind, item_id)
+                JOIN scored_items s USING (userId, item_kind, item_id);
+                """,
+                ([it["user_id"] for it in items], [it["kind"] for it in items], [it["item_id"] for it in items]),
+            )
+            known = {(r[0], r[1], r[2]): r[3:] for r in cur.fetchall()}
+
+    todo = []
+    for it in items:
+        prev = known.get((it["user_id"], it["kind"], it["item_id"]))
+        # unchanged if nothing was edited since, or an edit didn't change the text
+        if prev and (prev[0] >= it["updated_at"] or prev[1] == it["hash"]):
+            stats[it["user_id"]]["skipped_items"] += 1
+        else:
+            todo.append(it)
+    return todo
+
+
+def analyze_items(todo: list, stats: dict) -> list:
+    """Analyze items with one AI batch call; the write_item_scores rows for those that succeeded."""
+    return scored_rows(todo, analyze_batch([it["payload"] for it in todo]), stats)
+
+
+def scored_rows(todo: list, results: list, stats: dict) -> list:
+    """The write_item_scores rows for todo's analyze_batch results, counting them in stats."""
+    rows = []
+    for it, result in zip(todo, results):
+        user_stats = stats[it["user_id"]]
+        user_stats["analyzed_items"] += 1
+        if not result.get("success"):
+            user_stats["failed_analyses"] += 1
+            continue
+        sentiment, constructiveness = score_inputs(result.get("data") or {})
+        score = compute_score(sentiment, constructiveness)
+        rows.append((it["user_id"], it["kind"], it["item_id"], it["updated_at"], it["hash"], score,
+                     sentiment, constructiveness))
+    return rows
+
+
+def write_item_scores(rows) -> dict:
+    """
+    Record scored ledger rows (user_id, kind, item_id, updated_at, hash, score,
+    sentiment, constructiveness) and log their score deltas as score_events,
+    in one statement.
+
+    A row only replaces a recorded version that is older, and its delta is
+    taken against the recorded score at the moment of the write (row-locked by
+    the upsert), not against an earlier read. Returns {user_id: (code_delta,
+    comment_delta)} for the users whose totals moved.
+    """
+    # one row per item (the newest), in key order so concurrent batches lock rows in the same order
+    latest = {}
+    for row in rows:
+        key = row[:3]
+        if key not in latest or latest[key][3] < row[3]:
+            latest[key] = row
+    rows = [latest[key] for key in sorted(latest)]
+    if not rows:
+        return {}
+
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH incoming AS (
+                    SELECT * FROM unnest(%s::int[], %s::varchar[], %s::bigint[], %s::timestamptz[],
+                                         %s::char(64)[], %s::int[], %s::varchar[], %s::float8[])
+                        AS t (userId, item_kind, item_id, updated_at, content_hash, score,
+                              sentiment, constructiveness)
+                ), upserted AS (
+                    INSERT INTO scored_items AS s (userId, item_kind, item_id, updated_at, content_hash, score)
+                    SELECT userId, item_kind, item_id, updated_at, content_hash, score FROM incoming
+                    ON CONFLICT (userId, item_kind, item_id) DO UPDATE
+                        SET updated_at = EXCLUDED.updated_at,
+                            content_hash = EXCLUDED.content_hash,
+                            prev_score = s.score,
+                            score = EXCLUDED.score,
+                            scored_at = now()
+                        WHERE s.updated_at < EXCLUDED.updated_at
+                    RETURNING s.userId, s.item_kind, s.item_id, s.score, s.score - s.prev_score AS delta
+                )
+                INSERT INTO score_events (userId, field, delta, source, item_kind, item_id,
+                                          sentiment, constructiveness, score)
+                -- PRs count towards code_score, comments towards comment_score
+                SELECT u.userId, CASE WHEN u.item_kind = 'pr' THEN 'code' ELSE 'comment' END, u.delta,
+                       'refresh', u.item_kind, u.item_id, i.sentiment, i.constructiveness, u.score
+                FROM upserted u
+                JOIN incoming i USING (userId, item_kind, item_id)
+                RETURNING userId, field, delta;
+                """,
+                [list(col) for col in zip(*rows)],
+            )
+            events = cur.fetchall()
+        conn.commit()
+
+    moved = {}
+    for user_id, field, delta in events:
+        code, comment = moved.get(user_id, (0, 0))
+        moved[user_id] = (code + delta, comment) if field == "code" else (code, comment + delta)
+    return moved
+
+
+def write_scored_rows(rows: list, stats: dict):
+    """write_item_scores, adding each user's deltas to stats[user_id]."""
+    # a version a concurrent refresh already recorded is left alone and adds nothing
+    for user_id, (code, comment) in write_item_scores(rows).items():
+        stats[user_id]["added_code_score"] += code
+        stats[user_id]["added_comment_score"] += comment
+
+
+def iter_user_items(user_id: int, username: str, stats: dict, progress=None):
+    """
+    Ledger candidates for username's open PRs and their comments, yielded as
+    the PRs are fetched. Raises GitHubError if not even the first page of PRs
+    could be fetched; later failures are recorded in stats["failed_fetches"].
+    """
+    # Get PRs (lazily, page by page); scoring is bulk work, page loads go first
+    prs = github_paginate(
+        f"/search/issues?q=type:pr+author:{username}+is:open",
+        token=None,
+        priority=BULK,
+    )
+
+    #stream comments PR by PR; only a window of PRs is in memory at once
+    try:
+        for entry in iter_pr_comments(prs, username, stats["failed_fetches"], priority=BULK):
+            pr = entry["pr"]
+            stats["prs_fetched"] += 1
+            stats["comments_fetched"] += len(entry["comments"])
+
+            # entry["comments"] only holds the user's own comments
+            for c in entry["comments"]:
+                yield _ledger_item(user_id, _comment_kind(c), c, c.get("body") or "", "comment")
+
+            pr_text = (pr.get("title") or "") + "\n" + (pr.get("body") or "")
+            yield _ledger_item(user_id, "pr", pr, pr_text, "pr")
+            if progress:
+                progress(stats)
+    except GitHubError as e:
+        if stats["prs_fetched"] == 0:
+            raise
+        # later search page failed: keep what we already scored
+        stats["failed_fetches"].append({"endpoint": "/search/issues", "error": e.err})
+
+
+def _score_items(items: list, stats: dict):
+    """Analyze the items that changed since they were scored and apply the deltas."""
+    todo = unscored_items(items, stats)
+    if todo:
+        write_scored_rows(analyze_items(todo, stats), stats)
+
+
+def user_id_for(username: str) -> int:
+    """users.id of username. Raises UserNotFound if there's no users row for them."""
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM users WHERE githubId = %s;", (username,))
+            row = cur.fetchone()
+    if not row:
+        raise UserNotFound(username)
+    return row[0]
+
+
+def finish_stats(user_id: int, stats: dict) -> dict:
+    if stats["failed_fetches"]:
+        print("Some GitHub fetches failed:", stats["failed_fetches"])
+    if stats["failed_analyses"]:
+        print("AI analysis failed for", stats["failed_analyses"], "items")
+
+    final = current_scores(user_id)
+    stats["final_code_score"] = final[0] if final else None
+    stats["final_comment_score"] = final[1] if final else None
+    return stats
+
+
+def refresh_user_scores(username: str, progress=None) -> dict:
+    """
+    Score username's new or edited open PRs and comments.
+
+    ``progress``, if given, is called with the running stats dict as PRs are
+    fetched and items scored. Raises UserNotFound if there's no users row for
+    them, and GitHubError if not even the first page of their PRs could be fetched.
+    """
+    user_id = user_id_for(username)
+    stats = new_stats()
+    by_user = {user_id: stats}
+
+    # ledger candidates, checked and analyzed AI_BATCH_SIZE at a time
+    pending = []
+    for item in iter_user_items(user_id, username, stats, progress):
+        pending.append(item)
+        if len(pending) >= AI_BATCH_SIZE:
+            _score_items(pending, by_user)
+            pending.clear()
+
+    if pending:
+        _score_items(pending, by_user)
+        if progress:
+            progress(stats)
+
+    return finish_stats(user_id, stats)
+
+
+def recompute_scores() -> dict:
+    """
+    Re-apply compute_score to every logged analysis after a rubric change,
+    without calling the AI again, and log the differences as "rubric" events.
+
+    Ledger items are rescored from the inputs of their latest event; /api/analyze
+    scores (events without an item) are corrected per user. Items scored before
+    the event log existed have no inputs on record and keep their score.
+    """
+    stats = {"items_changed": 0, "items_without_inputs": 0, "users_corrected": 0, "events": 0}
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            # one consistent snapshot, and no refresh may move the ledger underneath us
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+            cur.execute("LOCK TABLE scored_items IN SHARE ROW EXCLUSIVE MODE;")
+
+            cur.execute(
+                """
+                SELECT s.userId, s.item_kind, s.item_id, s.score, e.sentiment, e.constructiveness
+                FROM scored_items s
+                LEFT JOIN LATERAL (
+                    SELECT sentiment, constructiveness FROM score_events
+                    WHERE userId = s.userId AND item_kind = s.item_kind AND item_id = s.item_id
+                      AND sentiment IS NOT NULL
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) e ON true;
+                """
+            )
+            item_events = []
+            for user_id, kind, item_id, old, sentiment, constructiveness in cur.fetchall():
+                if sentiment is None:
+                    stats["items_without_inputs"] += 1
+                    continue
+                new = compute_score(sentiment, constructiveness)
+                if new != old:
+                    field = "code" if kind == "pr" else "comment"
+                    item_events.append((user_id, field, new - old, kind, item_id, sentiment, constructiveness, new))
+
+            # scores from /api/analyze: what they add up to now vs. under the current rubric
+            cur.execute(
+                """
+                SELECT userId, field, sum(delta),
+                       array_agg(sentiment) FILTER (WHERE source = 'analyze'),
+                       array_agg(constructiveness) FILTER (WHERE source = 'analyze')
+                FROM score_events
+                WHERE item_id IS NULL AND source IN ('analyze', 'rubric')
+                GROUP BY userId, field;
+                """
+            )
+            user_events = []
+            for user_id, field, current, sentiments, constructiveness in cur.fetchall():
+                target = sum(compute_score(se, c) for se, c in zip(sentiments or [], constructiveness or []))
+                if target != current:
+                    user_events.append((user_id, field, target - current, None, None, None, None, None))
+
+            events = item_events + user_events
+            if events:
+                cur.execute(
+                    """
+                    INSERT INTO score_events (userId, field, delta, source, item_kind, item_id,
+                                              sentiment, constructiveness, score)
+                    SELECT userId, field, delta, 'rubric', item_kind, item_id, sentiment, constructiveness, score
+                    FROM unnest(%s::int[], %s::varchar[], %s::int[], %s::varchar[], %s::bigint[],
+                                %s::varchar[], %s::float8[], %s::int[])
+                        AS t (userId, field, delta, item_kind, item_id, sentiment, constructiveness, score);
+                    """,
+                    [list(col) for col in zip(*events)],
+                )
+            if item_events:
+                cur.execute(
+                    """
+                    UPDATE scored_items s
+                    SET prev_score = s.score, score = t.score
+                    FROM unnest(%s::int[], %s::varchar[], %s::bigint[], %s::int[])
+                        AS t (userId, item_kind, item_id, score)
+                    WHERE (s.userId, s.item_kind, s.item_id) = (t.userId, t.item_kind, t.item_id);
+                    """,
+                    ([e[0] for e in item_events], [e[3] for e in item_events],
+                     [e[4] for e in item_events], [e[7] for e in item_events]),
+                )
+        conn.commit()
+
+    stats["items_changed"] = len(item_events)
+    stats["users_corrected"] = len({e[0] for e in user_events})
+    stats["events"] = len(events)
+    return stats
@@ -1,41 +1,155 @@
-from flask import Flask, jsonify, request
-import psycopg2
+from flask import Flask, Response, jsonify, request
 from flasgger import Swagger
 from flask_cors import CORS
 import traceback
 import requests
 import os
+import json
+import click
+import threading
+
+from achievements import (achievement_stats, add_rule, backfill_rules, delete_rule, evaluate_rules_isolated, list_rules,
+                          start_backfill)
+from ai_client import OVERLOADED, ai_http
+from bulk import EXPORTS, FORMATS, IMPORTS, BulkError, export_rows, import_rows
+from db import PoolTimeout, db_pool, get_db
+from github_api import (GitHubError, github_cache, github_get, github_paginate, github_scheduler, iter_pr_comments,
+                        pr_files_diff)
+from http_client import upstream_stats
+from jobs import score_jobs
+from leaderboard import (DEFAULT_AROUND, DEFAULT_PAGE_SIZE, LEADERBOARD_COLUMNS, MAX_PAGE_SIZE,
+                         fetch_around, fetch_page)
+from migrate import migrate, migration_status
+import rescoring
+from score_events import compact_events, event_stats, start_compactor
+from scoring import UserNotFound, compute_score, recompute_scores, score_inputs
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init.sql")
+
+
+# runs at startup; init.sql only creates what's missing, and the migrations in migrations/
+# then bring the schema (including older databases) the rest of the way
+def initdb():
+    db_pool.warm()
+    with open(SCHEMA_FILE) as f:
+        schema = f.read()
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(schema)
+        conn.commit()
+    migrate()
 
 
-# run this only once pls
-def initdb():
-    conn = psycopg2.connect(
-        host="postgres",
-        database="mydb",
-        user="user",
-        password="password"
-    )
-    cur = conn.cursor()
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-# this is the connection for da database
-def getdbconnection():
-    conn = psycopg2.connect(
-        host="postgres",
-        database="mydb",
-        user="user",
-        password="password"
-    )
-    return conn
+def start_background_work():
+    # keep this process's score jobs alive and pick up those whose process died
+    score_jobs.start_sweeper()
+    rescoring.start_scheduler()
+    start_compactor()
+    # rules added by a migration haven't been checked against existing users yet
+    start_backfill()
+
+
+_background_pid = None
+_background_lock = threading.Lock()
+
+
+def ensure_background_work():
+    """Start the background work once per process; a worker forked by gunicorn starts its own."""
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid != os.getpid():
+            start_background_work()
+            _background_pid = os.getpid()
 
 
 app = Flask(__name__)
 swagger = Swagger(app)
 CORS(app, origins=["http://localhost:3000"])
 
+
+# whatever serves the app (python server.py, flask run, gunicorn) starts it by the first request at the latest
+@app.before_request
+def _start_background_work():
+    ensure_background_work()
+
+
+@app.cli.command("rescore")
+@click.option("--workers", type=int, default=None, help="GitHub fetch threads (default RESCORE_WORKERS).")
+def rescore_command(workers):
+    """Rescore every user now (or resume the interrupted run) and wait for it to finish."""
+    stats = rescoring.run_rescore(trigger="manual", workers=workers)
+    if stats is None:
+        click.echo("Another instance is already rescoring.")
+        return
+    click.echo(json.dumps(stats, indent=2))
+
+
+@app.cli.command("compact-scores")
+def compact_scores_command():
+    """Fold all pending score events into users now."""
+    click.echo(f"Applied {compact_events()} score events.")
+
+
+@app.cli.command("recompute-scores")
+def recompute_scores_command():
+    """Re-apply compute_score to every logged analysis (after a rubric change) and fold the differences in."""
+    stats = recompute_scores()
+    stats["applied_events"] = compact_events()
+    click.echo(json.dumps(stats, indent=2))
+
+
+@app.cli.command("evaluate-achievements")
+def evaluate_achievements_command():
+    """Check every achievement rule against all users (e.g. after editing the database by hand) and grant what's due."""
+    granted = backfill_rules(everything=True)
+    click.echo(f"Granted {sum(granted.values())} awards from {len(granted)} rules.")
+
+
+@app.cli.command("migrate")
+@click.option("--status", is_flag=True, help="List migrations and whether they ran instead of applying them.")
+def migrate_command(status):
+    """Create/upgrade the schema (init.sql) and apply pending migrations."""
+    if status:
+        click.echo(json.dumps(migration_status(), indent=2))
+        return
+    initdb()
+    click.echo("Schema is up to date.")
+
+
+@app.cli.command("import")
+@click.argument("table", type=click.Choice(list(IMPORTS)))
+@click.argument("file", type=click.File("rb"))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default=None,
+              help="File format (default: from the file extension, else csv).")
+def import_command(table, file, fmt):
+    """Upsert users, awards or user_awards from a CSV or NDJSON FILE ("-" for stdin)."""
+    if fmt is None:
+        fmt = "ndjson" if file.name.endswith((".ndjson", ".jsonl")) else "csv"
+    try:
+        click.echo(json.dumps(import_rows(table, file, fmt), indent=2))
+    except BulkError as e:
+        raise click.ClickException(str(e))
+
+
+@app.cli.command("export")
+@click.argument("name", type=click.Choice(EXPORTS))
+@click.argument("file", type=click.File("wb"), default="-")
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="csv")
+@click.option("--type", "leaderboard_type", type=click.Choice(list(LEADERBOARD_COLUMNS)), default="overall",
+              help="Ranking for the leaderboard export.")
+def export_command(name, file, fmt, leaderboard_type):
+    """Write users, awards, user_awards or the leaderboard to FILE (default stdout)."""
+    for chunk in export_rows(name, fmt, leaderboard_type):
+        file.write(chunk)
+
+
+@app.errorhandler(PoolTimeout)
+def db_pool_exhausted(e):
+    print("DB pool exhausted:", e)
+    return jsonify({"error": "Database busy, try again"}), 503
+
 @app.route('/api/')
 def default():
     return "default"
@@ -49,9 +163,12 @@ def dashboard():
 @app.route('/api/users', methods=['GET'])
 def getUsers():
     """
-    Gets all users / Get the leaderboard
-    Optional query parameter:
+    Gets a page of users / Get the leaderboard
+    Optional query parameters:
       type: "code", "comment", or "overall" (default: "overall")
+      limit: page size (default 100, max 500)
+      cursor: next_cursor from the previous page
+      around: githubId to centre the page on (returns their rank and neighbours)
     ---
     parameters:
       - name: type
@@ -59,6 +176,21 @@ def getUsers():
         type: string
         required: false
         description: Leaderboard type ("code", "comment", "overall")
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size, or neighbours on each side when "around" is set (default 5 there)
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor returned as next_cursor by the previous page
+      - name: around
+        in: query
+        type: string
+        required: false
+        description: githubId whose rank and neighbours should be returned
     responses:
       200:
         description: Returns leaderboard
@@ -78,28 +210,48 @@ def getUsers():
                         type: string
                       score:
                         type: integer
+                      rank:
+                        type: integer
+                next_cursor:
+                  type: string
+                rank:
+                  type: integer
+                rank_exact:
+                  type: boolean
+                  description: false when ranks are estimated (beyond LEADERBOARD_RANK_EXACT_LIMIT)
+      400:
+        description: Invalid type, limit or cursor
+      404:
+        description: "around" user not found
     """
     leaderboard_type = request.args.get("type", "overall").lower()
-    if leaderboard_type not in ["code", "comment", "overall"]:
+    if leaderboard_type not in LEADERBOARD_COLUMNS:
         return jsonify({"error": "Invalid leaderboard type"}), 400
 
-    conn = getdbconnection()
-    cur = conn.cursor()
-
-    if leaderboard_type == "code":
-        cur.execute("SELECT id, githubId, code_score FROM users ORDER BY code_score DESC;")
-    if leaderboard_type == "comment":
-        cur.execute("SELECT id, githubId, comment_score FROM users ORDER BY comment_score DESC;")
-    if leaderboard_type == "overall":
-        cur.execute(
-            "SELECT id, githubId, (code_score + comment_score) AS total_score FROM users ORDER BY total_score DESC;")
-
-    # cur.execute('SELECT id , name, score FROM leaderboard ORDER BY score DESC;')
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    data = [{"id": r[0], "name": r[1], "score": r[2]} for r in rows]
-    return jsonify({"leaderboard": data})
+    around = request.args.get("around")
+    default_limit = DEFAULT_AROUND if around else DEFAULT_PAGE_SIZE
+    try:
+        limit = int(request.args.get("limit", default_limit))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            if around:
+                result = fetch_around(cur, leaderboard_type, around, limit)
+                if result is None:
+                    return jsonify({"error": "User not found"}), 404
+                return jsonify(result)
+
+            try:
+                data, next_cursor, exact = fetch_page(cur, leaderboard_type, limit, request.args.get("cursor"))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+    return jsonify({"leaderboard": data, "next_cursor": next_cursor, "rank_exact": exact})
 
 
 @app.route('/api/users', methods=['POST'])
@@ -137,11 +289,10 @@ def addUser():
         """
     data = request.get_json()
     github_id = data.get('githubId')
-    comment_score = data.get('comment_score')
-    code_score = data.get('code_score')
+    comment_score = data.get('comment_score') or 0
+    code_score = data.get('code_score') or 0
 
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -158,10 +309,11 @@ def addUser():
             if new_row is None:
                 cur.execute("SELECT id FROM users WHERE githubId = %s;", (github_id,))
                 new_row = cur.fetchone()
+            elif code_score or comment_score:
+                # scores written directly skip score_events, so check the rules here
+                evaluate_rules_isolated(cur, {"code": [new_row[0]], "comment": [new_row[0]]})
             new_id = new_row[0]
         conn.commit()
-    finally:
-        conn.close()
 
     return jsonify({"id": new_id}), 201
 
@@ -194,14 +346,11 @@ def deleteUser(entry_id):
               type: string
               example: Entry not found
     """
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM users WHERE id = %s RETURNING id;", (entry_id,))
             deleted = cur.fetchone()
         conn.commit()
-    finally:
-        conn.close()
 
     if deleted:
         return jsonify({"message": "Entry deleted successfully"}), 200
@@ -270,17 +419,20 @@ def updateUser(entry_id):
 
     query = f"UPDATE users SET {set_clause} WHERE id = %s RETURNING id;"
 
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(query, tuple(values))
             updated = cur.fetchone()
+            if updated:
+                # scores written directly skip score_events, so check the rules here
+                evaluate_rules_isolated(cur, {
+                    "code": [updated[0]] if code_score is not None else [],
+                    "comment": [updated[0]] if comment_score is not None else [],
+                })
             conn.commit()
 
             if not updated:
                 return jsonify({"error": "Not found"}), 404
-    finally:
-        conn.close()
 
     return jsonify({"message": f"Entry {entry_id} updated successfully"}), 200
 
@@ -312,13 +464,10 @@ def getAchievements():
                         type: string
     """
 
-    conn = getdbconnection()
-    cur = conn.cursor()
-
-    cur.execute('SELECT id , awardname, description FROM awards')
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id , awardname, description FROM awards')
+            rows = cur.fetchall()
     data = [{"id": r[0], "awardname": r[1], "description": r[2]} for r in rows]
     return jsonify({"leaderboard": data})
 
@@ -359,8 +508,7 @@ def addAchievements():
     awardname = data.get('awardname')
     description = data.get('description')
 
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -375,8 +523,6 @@ def addAchievements():
             new_row = cur.fetchone()[0]
 
         conn.commit()
-    finally:
-        conn.close()
 
     return jsonify({"id": new_row}), 201
 
@@ -410,14 +556,11 @@ def deleteachievements(entry_id):
               type: string
               example: Entry not found
     """
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM awards WHERE id = %s RETURNING id;", (entry_id,))
             deleted = cur.fetchone()
         conn.commit()
-    finally:
-        conn.close()
 
     if deleted:
         return jsonify({"message": "Entry deleted successfully"}), 200
@@ -452,8 +595,7 @@ def get_user_achievements(user_id):
               description:
                 type: string
     """
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -468,8 +610,6 @@ def get_user_achievements(user_id):
                 {"id": row[0], "awardname": row[1], "description": row[2]}
                 for row in cur.fetchall()
             ]
-    finally:
-        conn.close()
 
     return jsonify(achievements), 200
 
@@ -519,8 +659,7 @@ def give_user_achievement(user_id):
     if not award_id:
         return jsonify({"error": "awardId is required"}), 400
 
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -531,15 +670,12 @@ def give_user_achievement(user_id):
                 (user_id, award_id)
             )
         conn.commit()
-    finally:
-        conn.close()
 
     return jsonify({"message": "Achievement granted"}), 201
 
 @app.route('/api/users/by-nickname/<nickname>/achievements', methods=['GET'])
 def achievements_by_nickname(nickname):
-    conn = getdbconnection()
-    try:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -554,49 +690,220 @@ def achievements_by_nickname(nickname):
             rows = cur.fetchall()
             data = [{"id": r[0], "awardname": r[1], "description": r[2]} for r in rows]
             return jsonify(data)
-    finally:
-        conn.close()
-
-@app.route('/api/settings')
-def settings():
-    return "Settings"
 
-AI_SERVICE_URL = "http://ai-service:8000/api"
-GITHUB_API = "https://api.github.com"
-GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 
-def github_get(endpoint: str, token: str | None = None):
-    # Default to app-level PAT
-    if token is None:
-        token = GITHUB_TOKEN
+# =============== automatic achievements section =================
+@app.route('/api/achievements/rules', methods=['GET'])
+def get_achievement_rules():
+    """
+    List the rules that grant awards automatically
+    ---
+    responses:
+      200:
+        description: Rules with their award and how many users hold it
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              id:
+                type: integer
+              awardId:
+                type: integer
+              awardname:
+                type: string
+              metric:
+                type: string
+              threshold:
+                type: integer
+              backfilled_at:
+                type: string
+              holders:
+                type: integer
+    """
+    return jsonify(list_rules()), 200
 
-    headers = {"Accept": "application/vnd.github+json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
 
+@app.route('/api/achievements/rules', methods=['POST'])
+def add_achievement_rule():
+    """
+    Grant an award automatically once a user's metric reaches a threshold
+    Replaces the award's existing rule. Users who already qualify get the award right away.
+    Metrics: code_score, comment_score, total_score (score >= threshold); prs, comments,
+    constructive_comments (scored items >= threshold); code_rank, comment_rank, overall_rank
+    (rank <= threshold, at most 500).
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - awardId
+            - metric
+            - threshold
+          properties:
+            awardId:
+              type: integer
+            metric:
+              type: string
+            threshold:
+              type: integer
+          example:
+            awardId: 1
+            metric: prs
+            threshold: 1
+    responses:
+      201:
+        description: Rule created
+        schema:
+          type: object
+          properties:
+            id:
+              type: integer
+            granted:
+              type: integer
+      400:
+        description: Unknown metric or bad threshold
+      404:
+        description: Award not found
+    """
+    data = request.get_json()
     try:
-        r = requests.get(f"{GITHUB_API}{endpoint}", headers=headers, timeout=30)
-    except Exception as e:
-        # Network or request error → 500 from our API
-        print("GitHub request failed:", e)
-        return None, {"error": "request_failed", "detail": str(e)}
+        created = add_rule(data.get('awardId'), data.get('metric'), data.get('threshold'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if created is None:
+        return jsonify({"error": "Award not found"}), 404
+    rule_id, granted = created
+    return jsonify({"id": rule_id, "granted": granted}), 201
+
+
+@app.route('/api/achievements/rules/<int:rule_id>', methods=['DELETE'])
+def delete_achievement_rule(rule_id):
+    """
+    Stop granting an award automatically (users keep it)
+    ---
+    parameters:
+      - name: rule_id
+        in: path
+        type: integer
+        required: true
+    responses:
+      200:
+        description: Rule deleted
+      404:
+        description: Rule not found
+    """
+    if delete_rule(rule_id):
+        return jsonify({"message": "Rule deleted successfully"}), 200
+    return jsonify({"error": "Rule not found"}), 404
+
+
+# =============== bulk import / export section =================
+MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def bulk_format(default: str = "csv") -> str:
+    fmt = request.args.get("format")
+    if fmt:
+        return fmt
+    return "ndjson" if "ndjson" in (request.content_type or "") else default
 
+
+@app.route('/api/import/<table>', methods=['POST'])
+def bulk_import(table):
+    """
+    Upsert many users, awards or user_awards at once
+    The body is the file itself: CSV with a header line, or NDJSON (one object per line).
+    Rows are matched on githubId / awardname; user_awards rows are (githubId, awardname).
+    ---
+    consumes:
+      - text/csv
+      - application/x-ndjson
+    parameters:
+      - name: table
+        in: path
+        type: string
+        required: true
+        enum: [users, awards, user_awards]
+      - name: format
+        in: query
+        type: string
+        required: false
+        description: '"csv" or "ndjson" (default: from Content-Type, else csv)'
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: string
+          example: "githubId,comment_score,code_score\\nalice,10,20\\nbob,,5"
+    responses:
+      200:
+        description: Import counts
+        schema:
+          type: object
+          properties:
+            table:
+              type: string
+            rows:
+              type: integer
+            inserted:
+              type: integer
+            updated:
+              type: integer
+            skipped:
+              type: integer
+      400:
+        description: Malformed file; nothing was imported
+    """
     try:
-        data = r.json()
-    except ValueError:
-        # Not JSON (e.g. HTML error page)
-        print("GitHub returned non-JSON:", r.status_code, r.text[:200])
-        return None, {
-            "error": "invalid_json",
-            "status": r.status_code,
-            "text": r.text,
-        }
+        result = import_rows(table, request.stream, bulk_format())
+    except BulkError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result), 200
 
-    if r.status_code != 200:
-        print("GitHub API error:", r.status_code, data)
-        return None, {"status": r.status_code, "body": data}
 
-    return data, None
+@app.route('/api/export/<name>', methods=['GET'])
+def bulk_export(name):
+    """
+    Stream users, awards, user_awards or the leaderboard as CSV or NDJSON
+    users, awards and user_awards come out in the format /api/import takes.
+    ---
+    parameters:
+      - name: name
+        in: path
+        type: string
+        required: true
+        enum: [users, awards, user_awards, leaderboard]
+      - name: format
+        in: query
+        type: string
+        required: false
+        description: '"csv" (default) or "ndjson"'
+      - name: type
+        in: query
+        type: string
+        required: false
+        description: Leaderboard type ("code", "comment", "overall") for the leaderboard export
+    responses:
+      200:
+        description: The rows, streamed
+      400:
+        description: Unknown export, format or leaderboard type
+    """
+    fmt = request.args.get("format", "csv")
+    try:
+        chunks = export_rows(name, fmt, request.args.get("type", "overall"))
+    except BulkError as e:
+        return jsonify({"error": str(e)}), 400
+    return Response(chunks, mimetype=MIMETYPES[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+
+@app.route('/api/settings')
+def settings():
+    return "Settings"
 
 @app.route("/api/github/user/prs")
 def get_user_prs():
@@ -608,16 +915,17 @@ def get_user_prs():
     if not username:
         return jsonify({"error": "Missing username"}), 400
 
-    prs, err = github_get(
-        f"/search/issues?q=type:pr+author:{username}+is:open",
-        token=None,  # force use of PAT
-    )
-
-    if err:
+    try:
+        items = list(github_paginate(
+            f"/search/issues?q=type:pr+author:{username}+is:open",
+            token=None,  # force use of PAT
+        ))
+    except GitHubError as e:
         # Bubble up the GitHub error so you can see it in the browser
-        return jsonify({"error": "Failed to fetch PRs", "details": err}), 500
+        return jsonify({"error": "Failed to fetch PRs", "details": e.err}), 500
 
-    return jsonify(prs)
+    # same shape as a single GitHub search page, but with every page's items
+    return jsonify({"total_count": len(items), "incomplete_results": False, "items": items})
 
 @app.route("/api/github/user/prs/comments")
 def get_user_comments():
@@ -630,61 +938,28 @@ def get_user_comments():
         return jsonify({"error": "Missing username"}), 400
 
 
-    prs, err = github_get(
+    prs = github_paginate(
         f"/search/issues?q=type:pr+author:{username}+is:open",
         token=None,  # force use of PAT
     )
 
-    #comments in a PR
-
-    comments = []
-
-    for pr in prs["items"]:
-        print(pr)
-        #owner = pr["base"]["repo"]["owner"]["login"]
-        # owner = pr.get("repo_owner")
-        # repo = pr.get("repo_name")
-        repo_url = pr.get("repository_url")  # e.g., https://api.github.com/repos/ynydara/411-Project
-        owner, repo = repo_url.split("/")[-2:]
-        pr_number = pr["number"]
-        print(pr_number)
-       # review_comments = github_get(f"/repos/{owner}/{repo}/pulls/{pr_number}/comments", token=NONE)
-       #  review_comments = github_get(f"/repos/{owner}/{repo}/pulls/{pr_number}/comments", token=None)
-        #issue_comments = github_get(f"/repos/{owner}/{repo}/issues/{pr_number}/comments", token=None)
-
-        # Conversation comments
-        issue_comments, err1 = github_get(f"/repos/{owner}/{repo}/issues/{pr_number}/comments", token=None)
-        # Review comments (inline)
-        review_comments, err2 = github_get(f"/repos/{owner}/{repo}/pulls/{pr_number}/comments", token=None)
-
-        all_comments = []
-        if issue_comments: all_comments.extend(issue_comments)
-        if review_comments: all_comments.extend(review_comments)
-
-        my_comments = [c for c in all_comments if c.get("user", {}).get("login") == username]
-
-        if issue_comments is None:
-            review_comments = []
-
-        # my_comments = [
-        #     c for c in issue_comments
-        #     if c is not None and c.get("user", {}).get("login") == username
-        # ]
-        # my_comments = [c for c in review_comments if c["user"]["login"] == username]
-        if my_comments:
-            comments.append({
-                "pr_number": pr_number,
-                "repo": f"{owner}/{repo}",
-                "comments": my_comments
-            })
-            print(jsonify(comments))
-            print(my_comments)
-
-    if err:
+    #comments in a PR, streamed page by page and fetched concurrently
+    failures = []
+    try:
+        comments = [
+            {"pr_number": p["pr_number"], "repo": f"{p['owner']}/{p['repo']}", "comments": p["comments"]}
+            for p in iter_pr_comments(prs, username, failures) if p["comments"]
+        ]
+    except GitHubError as e:
         # Bubble up the GitHub error so you can see it in the browser
-        return jsonify({"error": "Failed to fetch PRs and their comments", "details": err}), 500
-
-    return jsonify(comments)
+        return jsonify({"error": "Failed to fetch PRs and their comments", "details": e.err}), 500
+
+    resp = jsonify(comments)
+    if failures:
+        print("Some comment fetches failed:", failures)
+        # body stays a plain list for the dashboard; the count tells callers it's partial
+        resp.headers["X-Partial-Failures"] = str(len(failures))
+    return resp
 # ---------------------- REPO PRs -------------------------
 @app.route("/api/github/repos/<owner>/<repo>/prs")
 def get_repo_prs(owner, repo):
@@ -693,10 +968,10 @@ def get_repo_prs(owner, repo):
         return jsonify({"error": "Missing GitHub OAuth token"}), 401
 
     token = auth.replace("Bearer ", "")
-    prs, err = github_get(f"/repos/{owner}/{repo}/pulls", token)
-
-    if err:
-        return jsonify({"error": "Failed to fetch repo PRs", "details": err}), 400
+    try:
+        prs = list(github_paginate(f"/repos/{owner}/{repo}/pulls", token))
+    except GitHubError as e:
+        return jsonify({"error": "Failed to fetch repo PRs", "details": e.err}), 400
 
     return jsonify(prs)
 
@@ -713,15 +988,148 @@ def get_pr_details(owner, repo, number):
     if err:
         return jsonify({"error": "Failed to fetch PR", "details": err}), 400
 
-    files, err2 = github_get(f"/repos/{owner}/{repo}/pulls/{number}/files", token)
-    if err2:
-        return jsonify({"error": "Failed to fetch PR files", "details": err2}), 400
+    try:
+        files = list(github_paginate(f"/repos/{owner}/{repo}/pulls/{number}/files", token))
+    except GitHubError as e:
+        return jsonify({"error": "Failed to fetch PR files", "details": e.err}), 400
 
     return jsonify({"pr": pr, "files": files})
 
 
+def apply_analysis_score(result: dict, user_id=None, github_id=None) -> dict:
+    """Score an AI-service result, attach the score to result["data"] and log it towards the user's code_score."""
+    # Our ai-service returns { model, success, data: {...}, insight: {...} }
+    analysis = result.get("data") or {}
+    sentiment, constructiveness = score_inputs(analysis)
+    score = compute_score(sentiment, constructiveness)
+
+    # Attach score so frontend can see it
+    analysis["score"] = score
+    result["data"] = analysis
+
+    # ------------------ Log score event (code_score) ------------------
+    # an append, not an UPDATE of the user's row; the compactor adds it to code_score
+    with get_db() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO score_events (userId, field, delta, source, sentiment, constructiveness, score)
+                SELECT id, 'code', %s, 'analyze', %s, %s, %s
+                FROM users
+                WHERE id = coalesce(%s, (SELECT id FROM users WHERE githubId = %s))
+                RETURNING userId;
+                """,
+                (score, sentiment, constructiveness, score, user_id, github_id),
+            )
+            updated = cursor.fetchone()
+        conn.commit()
+
+    if updated:
+        print("Logged code_score event for user:", updated[0], score)
+    else:
+        print("No user found for user_id / githubId; skipping DB update:", user_id, github_id)
+
+    return result
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def iter_sse(resp):
+    """(event, data) pairs from a text/event-stream response."""
+    event, data = "message", []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line:
+            field, _, value = line.partition(":")
+            if field == "event":
+                event = value.strip()
+            elif field == "data":
+                data.append(value[1:] if value.startswith(" ") else value)
+        elif data:
+            yield event, "\n".join(data)
+            event, data = "message", []
+
+
+def stream_analysis(payload: dict, user_id=None, github_id=None):
+    """
+    Proxy the AI service's /analyze/stream: "start" and "token" events pass
+    straight through, the terminal "result" is scored like a normal /api/analyze
+    response before it goes out.
+    """
+    try:
+        resp = ai_http.post("/analyze/stream", json=payload, timeout=60, stream=True)
+    except requests.exceptions.RequestException as e:
+        print("Error contacting AI service:", e)
+        return jsonify({"error": str(e)}), 500
+    if resp.status_code in OVERLOADED:
+        resp.close()
+        return (jsonify({"error": "AI service busy, try again"}), resp.status_code,
+                {"Retry-After": resp.headers.get("Retry-After", "5")})
+    if resp.status_code != 200:
+        print("AI error response text:", resp.text)
+        return jsonify({"error": f"AI service returned {resp.status_code}"}), 500
+
+    def events():
+        try:
+            for event, data in iter_sse(resp):
+                if event == "result":
+                    try:
+                        result = apply_analysis_score(json.loads(data), user_id, github_id)
+                    except Exception as e:
+                        traceback.print_exc()
+                        yield sse("error", {"status": 500, "detail": str(e)})
+                        continue
+                    yield sse("result", result)
+                else:
+                    yield f"event: {event}\ndata: {data}\n\n"
+        except requests.exceptions.RequestException as e:
+            print("AI stream broke off:", e)
+            yield sse("error", {"status": 502, "detail": str(e)})
+        finally:
+            resp.close()
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/api/analyze", methods=["POST"])
 def analyze():
+    """
+    Analyze a PR, comment or code snippet and add its score to the user
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            content:
+              type: string
+            type:
+              type: string
+            file:
+              type: string
+            githubId:
+              type: string
+            stream:
+              type: boolean
+              description: answer with server-sent events ("start", "token"..., then "result"); same as sending Accept text/event-stream
+            chunked:
+              type: boolean
+              description: analyze a multi-file diff per file, in parallel, and merge the results (never streamed)
+            files:
+              type: array
+              items:
+                type: object
+              description: a PR's files list (as from /api/github/pr/...), used as the diff when content is empty
+    responses:
+      200:
+        description: The AI-service result with data.score, or an event stream ending in it
+      429:
+        description: AI service overloaded; retry after Retry-After
+    """
     try:
         data = request.get_json(force=True) or {}
         print("Incoming /api/analyze payload:", data)
@@ -732,6 +1140,10 @@ def analyze():
 
         content = data.get("content")
         analysis_type = data.get("type", "text")
+        chunked = bool(data.get("chunked"))
+
+        if not content and data.get("files"):
+            content = pr_files_diff(data["files"])
 
         if not content:
             return jsonify({"error": "Missing content"}), 400
@@ -739,9 +1151,16 @@ def analyze():
         # Payload for AI-service
         payload = {"type": analysis_type, "content": content, "file": data.get("file", "unknown")}
 
+        if not chunked and (data.get("stream") or request.accept_mimetypes.best == "text/event-stream"):
+            return stream_analysis(payload, user_id, github_id)
+
         # ------------------ Call AI service ------------------
         try:
-            resp = requests.post(f"{AI_SERVICE_URL}/analyze", json=payload, timeout=60)
+            resp = ai_http.post("/analyze/chunked" if chunked else "/analyze", json=payload, timeout=60)
+            if resp.status_code in OVERLOADED:
+                # pass the AI service's backpressure on instead of turning it into a 500
+                return (jsonify({"error": "AI service busy, try again"}), resp.status_code,
+                        {"Retry-After": resp.headers.get("Retry-After", "5")})
             resp.raise_for_status()
         except requests.exceptions.RequestException as e:
             print("Error contacting AI service:", e)
@@ -763,212 +1182,104 @@ def analyze():
 
         print("AI Service response:", result)
 
-        # Our ai-service returns { model, success, data: {...}, insight: {...} }
-        analysis = result.get("data") or {}
-        sentiment = analysis.get("sentiment", "neutral")
-
-        raw_construct = analysis.get("constructiveness_score", 0.5)
-        try:
-            constructiveness = float(raw_construct)
-        except (TypeError, ValueError):
-            constructiveness = 0.5
-
-        score = compute_score(sentiment, constructiveness)
-
-        # Attach score so frontend can see it
-        analysis["score"] = score
-        result["data"] = analysis
-
-        # ------------------ Update DB (code_score) ------------------
-        resolved_user_id = None
-
-        if user_id is not None:
-            resolved_user_id = user_id
-        elif github_id:
-            conn = getdbconnection()
-            try:
-                with conn.cursor() as cursor:
-                    cursor.execute("SELECT id FROM users WHERE githubId = %s;", (github_id,))
-                    row = cursor.fetchone()
-                    if row:
-                        resolved_user_id = row[0]
-            finally:
-                conn.close()
-
-        if resolved_user_id is not None:
-            conn = getdbconnection()
-            try:
-                with conn.cursor() as cursor:
-                    cursor.execute(
-                        """
-                        UPDATE users
-                        SET code_score = code_score + %s
-                        WHERE id = %s
-                        RETURNING id, code_score;
-                        """,
-                        (score, resolved_user_id),
-                    )
-                    updated = cursor.fetchone()
-                    if not updated:
-                        conn.rollback()
-                        print("No user row found for id:", resolved_user_id)
-                    else:
-                        conn.commit()
-                        print("Updated user code_score:", updated)
-            finally:
-                conn.close()
-        else:
-            print("No user_id / githubId resolved; skipping DB update")
-
         # Return AI result (with score in data) to frontend
-        return jsonify(result)
+        return jsonify(apply_analysis_score(result, user_id, github_id))
 
     except Exception as e:
         print("Unhandled exception in /api/analyze:", e)
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
-def compute_score(sentiment: str, constructiveness: float) -> float:
-    """Compute score based on rubric."""
-    if sentiment is None:
-        sentiment = "neutral"
-    sentiment_value = {
-        "positive": 1.0,
-        "neutral": 0.5,
-        "negative": 0.0
-    }.get(sentiment.lower(), 0.5)
-
-    score = (constructiveness * 0.6 + sentiment_value * 0.4) * 100
-
-    intScore = int(round(score,2)) #database only accepts ints, no decimals
-    return intScore
-
-
 @app.route("/api/score/update", methods=["POST"])
 def update_scores_from_analysis():
+    """
+    Queue a score refresh for a user
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            username:
+              type: string
+    responses:
+      202:
+        description: Job queued (or the user's already pending job); poll status_url for progress
+      404:
+        description: User does not exist
+    """
     data = request.json
     username = data.get("username")
 
     if not username:
         return jsonify({"error": "Missing username"}), 400
 
-    # Get PRs
-    prs, err = github_get(
-        f"/search/issues?q=type:pr+author:{username}+is:open",
-        token=None
-    )
-
-    if err:
-        return jsonify({"error": "Failed to fetch PRs", "details": err}), 500
-
-    total_code_score = 0
-    total_comment_score = 0
-
- #fetch comments
-    for pr in prs["items"]:
-
-        repo_url = pr["repository_url"]
-        owner, repo = repo_url.split("/")[-2:]
-        pr_number = pr["number"]
-
-        issue_comments, _ = github_get(
-            f"/repos/{owner}/{repo}/issues/{pr_number}/comments",
-            token=None
-        )
-        review_comments, _ = github_get(
-            f"/repos/{owner}/{repo}/pulls/{pr_number}/comments",
-            token=None
-        )
-
-        all_comments = []
-        if issue_comments: all_comments.extend(issue_comments)
-        print("The issue comments are: ", issue_comments)
-
-        if review_comments: all_comments.extend(review_comments)
-        print("The review comments are: ", review_comments)
-
-        # Keep only comments made by the user
-        user_comments = [c for c in all_comments
-                         if c["user"]["login"] == username]
-
-        for c in user_comments:
-            text = c.get("body", "")
-
-            # Call AI microservice
-            resp = requests.post(
-                f"{AI_SERVICE_URL}/analyze",
-                json={"content": text},
-                timeout=30
-            )
-            analysis = resp.json()
-            sentiment = analysis.get("sentiment")
-            constructiveness = float(analysis.get("constructiveness", 0))
-
-            score = compute_score(sentiment, constructiveness)
-            total_comment_score += score
-
-        pr_text = pr.get("title", "") + "\n" + pr.get("body", "")
-
-        resp = requests.post(
-            f"{AI_SERVICE_URL}/analyze",
-            json={"content": pr_text},
-            timeout=30
-        )
-        analysis = resp.json()
-        sentiment = analysis.get("sentiment")
-        constructiveness = float(analysis.get("constructiveness", 0))
-        pr_score = compute_score(sentiment, constructiveness)
-        total_code_score += pr_score
-
-    # ------- 4. Update user in DB -------
-    conn = getdbconnection()
     try:
-        with conn.cursor() as cur:
-
-            # 1. Get existing scores
-            cur.execute("""
-                        SELECT code_score, comment_score
-                        FROM users
-                        WHERE githubId = %s
-                        """, (username,))
-            row = cur.fetchone()
-
-            if not row:
-                return jsonify({"error": "User does not exist"}), 404
-
-            existing_code = row[0]
-            existing_comment = row[1]
-
-            # 2. Add (increment)
-            new_code_score = existing_code + total_code_score
-            new_comment_score = existing_comment + total_comment_score
-
-            # 3. Save updated totals
-            cur.execute("""
-                        UPDATE users
-                        SET code_score    = %s,
-                            comment_score = %s
-                        WHERE githubId = %s RETURNING id;
-                        """, (new_code_score, new_comment_score, username))
-
-            conn.commit()
-    finally:
-        conn.close()
+        job, created = score_jobs.submit(username)
+    except UserNotFound:
+        return jsonify({"error": "User does not exist"}), 404
 
     return jsonify({
-        "message": "Scores updated",
-        "added_code_score": total_code_score,
-        "added_comment_score": total_comment_score,
-        "final_code_score": new_code_score,
-        "final_comment_score": new_comment_score
-    }), 200
+        "message": "Score update queued" if created else "Score update already in progress",
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/api/score/jobs/{job['id']}",
+    }), 202
 
 
+@app.route("/api/score/jobs/<int:job_id>")
+def score_job_status(job_id):
+    """
+    Status and progress of a score refresh job
+    ---
+    parameters:
+      - name: job_id
+        in: path
+        type: integer
+        required: true
+    responses:
+      200:
+        description: status (queued/running/succeeded/failed), progress counters (prs_fetched, comments_fetched, analyzed_items, ...), result or error
+      404:
+        description: No such job
+    """
+    job = score_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
 
 @app.route("/health")
 def health():
     return {"status": "ok"}
 
+
+@app.route("/api/metrics")
+def metrics():
+    """
+    Runtime metrics for sizing the backend
+    ---
+    responses:
+      200:
+        description: DB pool saturation/wait times, per-upstream HTTP latency, GitHub cache hit rates and rate-limit budgets
+    """
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "upstreams": upstream_stats(),
+        "github_cache": github_cache.stats() if github_cache is not None else None,
+        "github_rate_limit": github_scheduler.stats(),
+        "score_jobs": score_jobs.stats(),
+        "rescoring": rescoring.run_stats(),
+        "score_events": event_stats(),
+        "achievements": achievement_stats(),
+    })
+
 if __name__ == '__main__':
     initdb()
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    debug = True
+    # with the reloader (debug) this file runs in a watcher process and again in the child that
+    # actually serves requests; everything but the watcher starts the workers right away
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        ensure_background_work()
+    app.run(host="0.0.0.0", port=5000, debug=debug)
\ No newline at end of file